@@ -7,6 +7,7 @@ sys.path.append('/Users/kenzatazi/Documents/CDT/Code')  # noqa
 
 from load import era5, data_dir
 import scipy as sp
+import scipy.stats
 import numpy as np
 import xarray as xr
 import pandas as pd
@@ -15,13 +16,11 @@ import cartopy.crs as ccrs
 import cartopy.feature as cf
 import matplotlib.pyplot as plt
 
-from tqdm import tqdm
-
 
 # Filepaths
 mask_filepath = data_dir + "/Masks/ERA5_Upper_Indus_mask.nc"
 eof_filepath = "/gws/nopw/j04/bas_climate/users/ktazi/z200_EOF2.nc"
-corr_filepath = "_Data/Performance/EOF_corr_pval.csv"
+corr_filepath = "_Data/Performance/EOF_corr_pval.nc"
 
 
 def input_correlation_heatmap():
@@ -68,101 +67,189 @@ def input_correlation_heatmap():
     return corr
 
 
-def cluster_correlation_heatmap():
-    """Plot correlation heatmap for the three clusters."""
+def cluster_correlation_heatmap(max_lag=6):
+    """
+    Plot lagged correlation heatmaps (variable x lag) of precipitation for the three clusters,
+    leaving out correlations with p >= 0.05.
 
+    Returns:
+        xr.Dataset: lagged correlation cube, see lagged_correlation.
+    """
     masks = ["Khyber_mask.nc", "Gilgit_mask.nc", "Ngari_mask.nc"]
-    names = ["Gilgit regime", "Ngari regime", "Khyber regime"]
-
-    for i in range(3):
-        cluster_df = era5.download_data(masks[i])
-
-        # create lags
-        cluster_df["CGTI-1"] = cluster_df["CGTI"].shift(periods=1)
-        cluster_df["CGTI-2"] = cluster_df["CGTI"].shift(periods=2)
-        cluster_df["CGTI-3"] = cluster_df["CGTI"].shift(periods=3)
-        cluster_df["CGTI-4"] = cluster_df["CGTI"].shift(periods=4)
-        cluster_df["CGTI-5"] = cluster_df["CGTI"].shift(periods=5)
-        cluster_df["CGTI-6"] = cluster_df["CGTI"].shift(periods=6)
-        """'
-        df_combined['N34-1'] = df_combined['N34'].shift(periods=1)
-        df_combined['N34-2'] = df_combined['N34'].shift(periods=2)
-        df_combined['N34-3'] = df_combined['N34'].shift(periods=3)
-        df_combined['N34-4'] = df_combined['N34'].shift(periods=4)
-        df_combined['N34-5'] = df_combined['N34'].shift(periods=5)
-        df_combined['N34-6'] = df_combined['N34'].shift(periods=6)
-
-        df_combined['N4-1'] = df_combined['N4'].shift(periods=1)
-        df_combined['N4-2'] = df_combined['N4'].shift(periods=2)
-        df_combined['N4-3'] = df_combined['N4'].shift(periods=3)
-        df_combined['N4-4'] = df_combined['N4'].shift(periods=4)
-        df_combined['N4-5'] = df_combined['N4'].shift(periods=5)
-        df_combined['N4-6'] = df_combined['N4'].shift(periods=6)
-        """
-        df = cluster_df(columns=["expver", "time"])
-        df_clean = df.dropna()
-        df_sorted = df_clean.sort_index(axis=1)
-
-        # Correlation matrix
-        corr = df_sorted.corr()
-
-        # Plot
-        sns.set(style="white")
-
-        plt.subplots(figsize=(11, 9))
-        cmap = sns.diverging_palette(220, 10, as_cmap=True)
-
-        # Draw the heatmap with the mask and correct aspect ratio
-        mask = np.triu(
-            np.ones_like(corr, dtype=np.bool)
-        )  # generate a mask for the upper triangle
+    names = ["Khyber regime", "Gilgit regime", "Ngari regime"]
+
+    frames = {}
+    for mask, name in zip(masks, names):
+        cluster_df = era5.download_data(mask)
+        frames[name] = cluster_df.drop(columns=["expver"], errors="ignore").set_index("time")
+
+    cube = lagged_correlation(frames, target="tp", max_lag=max_lag)
+
+    # Plot
+    sns.set(style="white")
+    cmap = sns.diverging_palette(220, 10, as_cmap=True)
+    fig, axs = plt.subplots(1, len(names), figsize=(4 * len(names), 9), sharey=True)
+
+    for ax, name in zip(axs, names):
+        corr = cube.corr.sel(region=name).to_pandas()
         sns.heatmap(
             corr,
-            mask=mask,
+            mask=(cube.pvalue.sel(region=name) >= 0.05).values,
             cmap=cmap,
             center=0,
             vmin=-1,
             vmax=1,
-            square=True,
+            fmt="0.2f",
+            annot=True,
+            annot_kws={"size": 5},
             linewidths=0.5,
-            cbar_kws={"shrink": 0.5},
+            cbar=False,
+            ax=ax,
         )
-
-        plt.title(names[i] + "\n")
+        ax.set_title(name + "\n")
 
     plt.show()
 
-
-def eof_correlation(eof_filepath, mask_filepath):
-    """ Returns plot and DataArray of areas with p<0.05."""
-
+    return cube
+
+
+def pearson(y, X, chunk_size=None) -> tuple:
+    """
+    Pearson correlation coefficients and two-sided p-values of each column of X against y.
+
+    The columns are processed chunk_size at a time as one matrix product each. Time steps with a
+    NaN in y or in a column are left out for that column only. The p-values come from the t
+    distribution with n - 2 degrees of freedom, as in scipy.stats.pearsonr.
+
+    Args:
+        y (np.ndarray): series (T)
+        X (np.ndarray): series to correlate with y (T x M)
+        chunk_size (int, optional): columns per chunk. Defaults to None, i.e. all at once.
+
+    Returns:
+        tuple: correlations (M) and p-values (M)
+    """
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    X = np.asarray(X).reshape(len(y), -1)
+    M = X.shape[1]
+    chunk_size = M if not chunk_size else chunk_size
+
+    r, n = np.empty(M), np.empty(M)
+    for start in range(0, M, chunk_size):
+        cols = slice(start, start + chunk_size)
+        x = np.asarray(X[:, cols], dtype=np.float64)
+        valid = ~np.isnan(x) & ~np.isnan(y)[:, None]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if valid.all():
+                dy = y - y.mean()
+                dx = x - x.mean(axis=0)
+                n[cols] = len(y)
+                r[cols] = (dy @ dx) / np.sqrt((dy @ dy) * np.einsum("ij,ij->j", dx, dx))
+            else:
+                n_c = valid.sum(axis=0)
+                dx = np.where(valid, x - np.where(valid, x, 0).sum(axis=0) / n_c, 0)
+                dy = np.where(valid, y[:, None] - np.where(valid, y[:, None], 0).sum(axis=0) / n_c, 0)
+                n[cols] = n_c
+                r[cols] = np.sum(dx * dy, axis=0) / np.sqrt(np.sum(dx**2, axis=0) * np.sum(dy**2, axis=0))
+
+    r = np.clip(r, -1, 1)
+    return r, _pvalue(r, n)
+
+
+def _pvalue(r, n):
+    """ Returns two-sided p-values of correlations r over n samples, from the t distribution """
+    dof = n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.abs(r) * np.sqrt(dof / (1 - r**2))
+    return np.where(dof > 0, 2 * sp.stats.t.sf(t, np.maximum(dof, 1)), np.nan)
+
+
+def _xcorr(a, b, n_lags, nfft):
+    """ Returns sum_t a[r, t] b[r, v, t - k] for lags k = 0..n_lags, with a (R x T) and b (R x V x T) """
+    A = np.fft.rfft(a, nfft)[:, None]
+    B = np.fft.rfft(b, nfft)
+    return np.fft.irfft(A * np.conj(B), nfft)[..., :n_lags + 1]
+
+
+def lagged_correlation(frames: dict, target="tp", max_lag=6) -> xr.Dataset:
+    """
+    Correlations and p-values of the target series of each region against every other variable
+    lagged by 0 to max_lag time steps, i.e. corr(target(t), variable(t - lag)).
+
+    All the lags come from FFT cross-correlations of the (mean removed) series, their squares
+    and their missing value masks, so that each correlation only uses the time steps where both
+    series are present, for all regions, variables and lags in one pass.
+
+    Args:
+        frames (dict): region name to DataFrame indexed by (evenly spaced) time, with the target
+            and variable columns.
+        target (str, optional): target column. Defaults to "tp".
+        max_lag (int, optional): largest lag. Defaults to 6.
+
+    Returns:
+        xr.Dataset: corr, pvalue and number of samples n (region x variable x lag).
+    """
+    regions = list(frames)
+    variables = sorted({c for df in frames.values() for c in df.columns if c != target})
+    time = sorted(set().union(*[df.index for df in frames.values()]))
+
+    y = np.stack([frames[k][target].reindex(time).values for k in regions]).astype(float)
+    x = np.stack([frames[k].reindex(index=time, columns=variables).values.T for k in regions]).astype(float)
+
+    my, mx = ~np.isnan(y), ~np.isnan(x)
+    y = np.where(my, y - np.nanmean(y, axis=-1, keepdims=True), 0)
+    x = np.where(mx, x - np.nanmean(x, axis=-1, keepdims=True), 0)
+    my, mx = my.astype(float), mx.astype(float)
+
+    nfft = 2 ** int(np.ceil(np.log2(len(time) + max_lag)))
+    n = np.rint(_xcorr(my, mx, max_lag, nfft))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sy, sx = _xcorr(y, mx, max_lag, nfft) / n, _xcorr(my, x, max_lag, nfft) / n
+        cov = _xcorr(y, x, max_lag, nfft) / n - sy * sx
+        var_y = _xcorr(y**2, mx, max_lag, nfft) / n - sy**2
+        var_x = _xcorr(my, x**2, max_lag, nfft) / n - sx**2
+        r = np.clip(cov / np.sqrt(var_y * var_x), -1, 1)
+
+    dims = ("region", "variable", "lag")
+    return xr.Dataset({"corr": (dims, r), "pvalue": (dims, _pvalue(r, n)), "n": (dims, n.astype(int))},
+                      coords={"region": regions, "variable": variables, "lag": np.arange(max_lag + 1)})
+
+
+def eof_correlation(eof_filepath, mask_filepath, filepath=corr_filepath, chunk_size=100000):
+    """
+    Correlation and p-value of the EOF at every grid point against the precipitation averaged
+    over the mask, saved to a gridded NetCDF file. The EOF is read chunk_size grid points (whole
+    latitude rows) at a time.
+
+    Returns:
+        str: filepath
+    """
     print("processing precipitation")
     da = era5.download_data(mask_filepath, xarray=True)
-    tp_ds = da.mean(dim=["latitude", "longitude"]).tp
-    tp = tp_ds.assign_coords(time=(tp_ds.time.astype("datetime64")))
-    tp_df = tp.to_dataframe()
+    tp = da.mean(dim=["latitude", "longitude"]).tp
+    tp = tp.assign_coords(time=tp.time.astype("datetime64[ns]")).dropna(dim="time")
 
     print("processing EOF")
     eof_da = xr.open_dataset(eof_filepath)
-    eof_ds = eof_da.EOF
-    eof = eof_ds.assign_coords(time=(eof_ds.time.astype("datetime64")))
-    eof_df = eof.to_dataframe()
-    eof_pv = pd.pivot_table(
-        eof_df, values="EOF", index=["time"], columns=["latitude", "longitude"]
-    )
-    eof_reset = eof_pv.reset_index()
-    eof_reset["time"] -= np.timedelta64(12, "h")
-
-    print("combining")
-    df_combined = pd.merge_ordered(tp_df, eof_reset, on="time")
-    df_clean = df_combined.dropna()
-
-    corr_s = df_clean.corrwith(df_clean["tp"])
-    corr_df = corr_s.to_frame(name="corr")
-    corr_df["pvalue"] = pvalue(df_clean)
-
-    filepath = "_Data/EOF_corr_pval.csv"
-    corr_df.to_csv(filepath)
+    eof = eof_da.EOF.assign_coords(time=eof_da.time.astype("datetime64[ns]") - np.timedelta64(12, "h"))
+    tp, eof = xr.align(tp, eof, join="inner")
+    eof = eof.transpose("time", "latitude", "longitude")
+
+    print("correlating")
+    nlat, nlon = eof.sizes["latitude"], eof.sizes["longitude"]
+    rows = max(1, chunk_size // nlon)
+    corr, pval = np.empty((nlat, nlon)), np.empty((nlat, nlon))
+    for start in range(0, nlat, rows):
+        block = eof.isel(latitude=slice(start, start + rows)).values
+        r, p = pearson(tp.values, block.reshape(len(tp.time), -1))
+        corr[start:start + rows] = r.reshape(-1, nlon)
+        pval[start:start + rows] = p.reshape(-1, nlon)
+
+    coords = {"latitude": eof.latitude.values, "longitude": eof.longitude.values}
+    ds = xr.Dataset({"corr": (("latitude", "longitude"), corr), "pvalue": (("latitude", "longitude"), pval)},
+                    coords=coords, attrs={"n_months": len(tp.time)})
+    ds.to_netcdf(filepath)
 
     return filepath
 
@@ -170,28 +257,15 @@ def eof_correlation(eof_filepath, mask_filepath):
 def eof_correlation_map(corr_filepath):
     """Plots map of correlation for EOFs."""
 
-    raw_df = pd.read_csv(corr_filepath, names=["coords", "corr", "pvalue"])
-    corr_df = raw_df[2:]
-
-    corr_array = corr_df["corr"].values.reshape(721, 1440).astype(float)
-    pval_array = corr_df["pvalue"].values.reshape(721, 1440).astype(float)
-    lat = np.linspace(-90, 90, 721)
-    lon = np.linspace(-180, 180, 1440)
-
-    corr_da = xr.DataArray(
-        data=corr_array, coords=[("latitude", lat), ("longitude", lon)]
-    )
-    pval_da = xr.DataArray(
-        data=pval_array, coords=[("latitude", lat), ("longitude", lon)]
-    )
+    ds = xr.open_dataset(corr_filepath)
 
     plt.figure()
     ax = plt.subplot(projection=ccrs.PlateCarree())
-    corr_da.plot(
+    ds.corr.plot(
         cbar_kwargs={"label": "\n Correlation",
                      "extend": "neither", "pad": 0.10}
     )
-    pval_da.plot.contour(levels=[0.05])
+    ds.pvalue.plot.contour(levels=[0.05])
     ax.add_feature(cf.BORDERS)
     ax.coastlines()
     ax.gridlines(draw_labels=True)
@@ -203,13 +277,7 @@ def eof_correlation_map(corr_filepath):
 def pvalue(df):
     """ Returns array of pvalues """
     df1 = df.drop(["time"], axis=1)
-    pval_list = []
-
-    for c in tqdm(list(df1)):
-        _, pval = sp.stats.pearsonr(df1[c], df1["tp"])
-        pval_list.append(pval)
-
-    return np.array(pval_list)
+    return pearson(df1["tp"].values, df1.values.astype(float))[1]
 
 
 def dataset_correlation(timeseries):
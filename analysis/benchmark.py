@@ -6,11 +6,11 @@ sys.path.append('/Users/kenzatazi/Documents/CDT/Code')  # noqa
 sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction')  # noqa
 
 import gp.data_prep as dp
+from utils.streaming import regression_stats
 #import gp.gp_models as gp
 import analysis.pdf as pdf
 import analysis.timeseries as tims
 from load import beas_sutlej_gauges, era5, cru, beas_sutlej_wrf, gpm, aphrodite, data_dir
-from sklearn.metrics import mean_squared_error, r2_score
 from tqdm import tqdm
 from scipy import stats
 import xarray as xr
@@ -57,8 +57,8 @@ def model_prep(location, data_filepath='_Data/model_pred_test.csv',
     return model_ds
 
 
-def dataset_stats(datasets, ref_ds=None, ret=False):
-    """Print mean, standard deviations and slope for datasets."""
+def dataset_stats(datasets, ref_ds=None, ret=False, chunk_size=None):
+    """Print mean, standard deviations and slope for datasets. Metrics are streamed over chunks of chunk_size values if given."""
 
     r2_list = []
     rmse_list = []
@@ -92,26 +92,11 @@ def dataset_stats(datasets, ref_ds=None, ret=False):
             y_true = df['tp_ref'].values
             y_pred = df['tp'].values
 
-            # all values
-            r2 = r2_score(y_true, y_pred)
-            rmse = mean_squared_error(y_true, y_pred, squared=False)
-
-            # 5th percentile
-            p5 = np.percentile(y_true, 5.0)
-            indx = [y_true <= p5][0]
-            y_true_p5 = y_true[indx]
-            y_pred_p5 = y_pred[indx]
-            r2_p5 = r2_score(y_true_p5, y_pred_p5)
-            rmse_p5 = mean_squared_error(y_true_p5, y_pred_p5, squared=False)
-
-            # 95th percentile
-            p95 = np.percentile(y_true, 95.0)
-            indx = [y_true >= p95][0]
-            y_true_p95 = y_true[indx]
-            y_pred_p95 = y_pred[indx]
-            r2_p95 = r2_score(y_true_p95, y_pred_p95)
-            rmse_p95 = mean_squared_error(
-                y_true_p95, y_pred_p95, squared=False)
+            # all values, 5th and 95th percentiles
+            scores = regression_stats(y_true, y_pred, chunk_size=chunk_size)
+            r2, rmse = scores['R2'], scores['RMSE']
+            r2_p5, rmse_p5 = scores['R2_p5'], scores['RMSE_p5']
+            r2_p95, rmse_p95 = scores['R2_p95'], scores['RMSE_p95']
 
             # Print and append
             '''
@@ -2,6 +2,12 @@
 import sys
 sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction')  # noqa
 
+import os
+import hashlib
+import multiprocessing as mp
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import xarray as xr
 import pandas as pd
@@ -18,19 +24,35 @@ import matplotlib.ticker as mticker
 # Filepaths
 mask_filepath = data_dir + "Masks/ERA5_Upper_Indus_mask.nc"
 dem_filepath = data_dir + "Elevation/elev.0.25-deg.nc"
+cache_dir = data_dir + "Masks/cache/"
 
 
 # Function inputs
 
-# Digital Elevation Model data
-dem = xr.open_dataset(dem_filepath)
-dem_da = (dem.data).sum(dim="time")
-sliced_dem = dem_da.sel(lat=slice(38, 30), lon=slice(71.25, 82.75))
+@lru_cache(maxsize=None)
+def load_dem() -> xr.DataArray:
+    """ Returns the Digital Elevation Model data over the UIB box, loaded on first call """
+    dem = xr.open_dataset(dem_filepath)
+    dem_da = (dem.data).sum(dim="time")
+    return dem_da.sel(lat=slice(38, 30), lon=slice(71.25, 82.75))
+
+
+@lru_cache(maxsize=None)
+def load_tp() -> xr.DataArray:
+    """ Returns the UIB precipitation data, loaded on first call """
+    da = era5.download_data('uib', xarray=True)
+    loc_ds = location_sel.select_basin(da, 'uib')
+    return loc_ds.tp
+
+
+def __getattr__(name):
+    """ Lazy module attributes for the data previously loaded on import """
+    if name == "sliced_dem":
+        return load_dem()
+    if name == "tp_ds":
+        return load_tp()
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
 
-# Precipitation data
-da = era5.download_data('uib', xarray=True)
-loc_ds = location_sel.select_basin(da, 'uib')
-tp_ds = loc_ds.tp
 
 # Decade list
 decades = [1980, 1990, 2000, 2010]
@@ -39,6 +61,108 @@ decades = [1980, 1990, 2000, 2010]
 N = np.arange(2, 11, 1)
 
 
+def season_masks(UIB_cum) -> dict:
+    """ Returns the precipitation data masked to each season (JFM, AMJ, JAS, OND) """
+    month = UIB_cum.time.dt.month
+    return {"JFM": UIB_cum.where(month <= 3),
+            "AMJ": UIB_cum.where((month > 3) & (month < 7)),
+            "JAS": UIB_cum.where((month > 6) & (month < 10)),
+            "OND": UIB_cum.where(month >= 10)}
+
+
+def decade_features(da, d, timeseries=False) -> tuple:
+    """
+    Feature matrix of one decade and the flat (lat, lon) indices of its rows, without going
+    through DataFrames: the decade median per cell, or the cell timeseries (interpolated over
+    time) if timeseries. Cells without positive precipitation are left out.
+    """
+    da_d = da.sel(time=slice(str(d) + "-01-01T12:00:00", str(d + 10) + "-01-01T12:00:00"))
+
+    if timeseries is False:
+        values = da_d.median(dim="time").transpose("lat", "lon").values.reshape(-1)
+        idx = np.flatnonzero(values > 0)
+        return values[idx].reshape(-1, 1), idx
+
+    values = da_d.transpose("lat", "lon", "time").values
+    values = values.reshape(-1, values.shape[-1])
+    values = np.where(values > 0, values, np.nan)
+    idx = np.flatnonzero(~np.all(np.isnan(values), axis=1))
+    X = pd.DataFrame(values[idx]).interpolate(axis=1, limit_direction="both").values
+    return X, idx
+
+
+def _fit_kmeans(task) -> tuple:
+    """ Worker: K-means labels and maximum soft k-means weights for one K """
+    X, n = task
+    kmeans = KMeans(n_clusters=n, random_state=0).fit(X)
+    weights = soft_clustering_weights(X, kmeans.cluster_centers_)
+    return kmeans.labels_, np.amax(weights, axis=1)
+
+
+def cluster_sweep(da, N, decades, seasonal=False, timeseries=False, filter=0, n_workers=None) -> xr.DataArray:
+    """
+    K-means cluster labels for every season, decade and number of clusters.
+
+    The feature matrix of each (season, decade) is prepared once and shared by all the K values,
+    which are fitted in parallel processes.
+
+    Args:
+        da (xr.DataArray): cumulative monthly precipitation (time, lat, lon)
+        N (list): numbers of clusters
+        decades (list): first years of the decades
+        seasonal (bool, optional): cluster each season separately. Defaults to False (annual).
+        timeseries (bool, optional): cluster the cell timeseries rather than the decade medians.
+            Defaults to False.
+        filter (float, optional): soft k-means threshold, cells with a lower maximum weight are
+            left unlabelled. Defaults to 0 (no filtering).
+        n_workers (int, optional): number of processes. Defaults to one per CPU.
+
+    Returns:
+        xr.DataArray: labels (season x decade x N x lat x lon), NaN outside the clusters.
+    """
+    seasons = season_masks(da) if seasonal is True else {"annual": da}
+    shape = (len(seasons), len(decades), len(N), da.sizes["lat"] * da.sizes["lon"])
+    labels = np.full(shape, np.nan)
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("spawn")) as executor:
+        for s, season_da in enumerate(seasons.values()):
+            for j, d in enumerate(decades):
+                X, idx = decade_features(season_da, d, timeseries=timeseries)
+                for k, (labels_k, weights) in enumerate(executor.map(_fit_kmeans, [(X, n) for n in N])):
+                    keep = weights > filter if filter > 0 else np.ones(len(idx), dtype=bool)
+                    labels[s, j, k, idx[keep]] = labels_k[keep]
+
+    return xr.DataArray(labels.reshape(shape[:3] + (da.sizes["lat"], da.sizes["lon"])),
+                        coords={"season": list(seasons), "Decade": [str(d) + "s" for d in decades],
+                                "N": list(N), "lat": da.lat.values, "lon": da.lon.values},
+                        dims=["season", "Decade", "N", "lat", "lon"], name="labels")
+
+
+def plot_cluster_cube(cube, sliced_dem, rows=3, cmaps=None, **plot_kwargs):
+    """
+    FacetGrid plots (N x Decade, rows values of N per figure) of a cluster_sweep cube for each
+    season, overlayed with the local topography contours.
+    """
+    cmaps = cmaps or {}
+    for season in cube.season.values:
+        for start in range(0, cube.sizes["N"], rows):
+            g = cube.sel(season=season).isel(N=slice(start, start + rows)).plot(
+                x="lon",
+                y="lat",
+                col="Decade",
+                row="N",
+                subplot_kws={"projection": ccrs.PlateCarree()},
+                cmap=cmaps.get(season),
+                add_colorbar=False,
+                **plot_kwargs
+            )
+            for ax in g.axes.flat:
+                ax.set_extent([71, 83, 30, 38])
+                sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
+
+    plt.show()
+
+
 def seasonal_clusters(tp_ds, sliced_dem, N, decades):
     """
     K-means clustering of precipitation data as a function of seasons, decades
@@ -54,122 +178,11 @@ def seasonal_clusters(tp_ds, sliced_dem, N, decades):
     Returns:
         FacetGrid plots
     """
-
     UIB_cum = cumulative_monthly(tp_ds)
-
-    # Seperation into seasons
-    JFM = UIB_cum.where(UIB_cum.time.dt.month <= 3)
-    OND = UIB_cum.where(UIB_cum.time.dt.month >= 10)
-    AMJ = UIB_cum.where(UIB_cum.time.dt.month < 7).where(
-        UIB_cum.time.dt.month > 3)
-    JAS = UIB_cum.where(UIB_cum.time.dt.month < 10).where(
-        UIB_cum.time.dt.month > 6)
-
-    seasons = [JFM, AMJ, JAS, OND]
-    scmap = {0: "Reds", 1: "Oranges", 2: "Blues", 3: "Greens"}
-
-    # Loop over seasons, cluster numbers and decades
-
-    for s in range(4):
-        UIB_cluster_list = []
-
-        for n in N:
-            UIB_dec_list = []
-
-            for d in decades:
-                # Median cumulative rainfall for decades
-                UIB_d = seasons[s].sel(
-                    time=slice(
-                        str(d) + "-01-01T12:00:00", str(d + 10) +
-                        "-01-01T12:00:00"
-                    )
-                )
-                UIB_median = UIB_d.median(dim="time")
-
-                # To DataFrame
-                multi_index_df = UIB_median.to_dataframe("Precipitation")
-                df = multi_index_df.reset_index()
-                df_clean = df[df["Precipitation"] > 0]
-                X = (df_clean["Precipitation"].values).reshape(-1, 1)
-
-                # K-means
-                kmeans = KMeans(n_clusters=n, random_state=0).fit(X)
-                df_clean["labels"] = kmeans.labels_
-
-                # To DataArray
-                df_plot = df_clean[["labels", "lat", "lon"]]
-                df_pv = df_plot.pivot(index="lat", columns="lon")
-                df_pv = df_pv.droplevel(0, axis=1)
-                da = xr.DataArray(data=df_pv, name=str(d) + "s")
-
-                UIB_dec_list.append(da)
-
-            UIB_cluster_list.append(
-                xr.concat(
-                    UIB_dec_list,
-                    pd.Index(["1980s", "1990s", "2000s",
-                             "2010s"], name="Decade"),
-                )
-            )
-
-        # Combine data for plot formatting
-        UIB_clusters1 = xr.concat(
-            UIB_cluster_list[0:3], pd.Index(np.arange(2, 5), name="N")
-        )
-        UIB_clusters2 = xr.concat(
-            UIB_cluster_list[3:6], pd.Index(np.arange(5, 8), name="N")
-        )
-        UIB_clusters3 = xr.concat(
-            UIB_cluster_list[6:9], pd.Index(np.arange(8, 11), name="N")
-        )
-
-        # Plots
-        g = UIB_clusters1.plot(
-            x="lon",
-            y="lat",
-            col="Decade",
-            row="N",
-            vmin=-2,
-            vmax=10,
-            subplot_kws={"projection": ccrs.PlateCarree()},
-            cmap=scmap[s],
-            add_colorbar=False,
-        )
-        for ax in g.axes.flat:
-            ax.set_extent([71, 83, 30, 38])
-            sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-        g = UIB_clusters2.plot(
-            x="lon",
-            y="lat",
-            col="Decade",
-            row="N",
-            vmin=-2,
-            vmax=10,
-            subplot_kws={"projection": ccrs.PlateCarree()},
-            cmap=scmap[s],
-            add_colorbar=False,
-        )
-        for ax in g.axes.flat:
-            ax.set_extent([71, 83, 30, 38])
-            sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-        g = UIB_clusters3.plot(
-            x="lon",
-            y="lat",
-            col="Decade",
-            row="N",
-            vmin=-2,
-            vmax=10,
-            subplot_kws={"projection": ccrs.PlateCarree()},
-            cmap=scmap[s],
-            add_colorbar=False,
-        )
-        for ax in g.axes.flat:
-            ax.set_extent([71, 83, 30, 38])
-            sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-    plt.show()
+    cube = cluster_sweep(UIB_cum, N, decades, seasonal=True)
+    scmap = {"JFM": "Reds", "AMJ": "Oranges", "JAS": "Blues", "OND": "Greens"}
+    plot_cluster_cube(cube, sliced_dem, cmaps=scmap, vmin=-2, vmax=10)
+    return cube
 
 
 def annual_clusters(UIB_cum, sliced_dem, N, decades):
@@ -187,96 +200,9 @@ def annual_clusters(UIB_cum, sliced_dem, N, decades):
     Returns:
         FacetGrid plots
     """
-    # Loop over cluster numbers and decades
-
-    UIB_cluster_list = []
-
-    for n in N:
-        UIB_dec_list = []
-
-        for d in decades:
-            # Median cumulative rainfall for decades
-            UIB_d = UIB_cum.sel(
-                time=slice(str(d) + "-01-01T12:00:00",
-                           str(d + 10) + "-01-01T12:00:00")
-            )
-            UIB_median = UIB_d.median(dim="time")
-
-            # To DataFrame
-            multi_index_df = UIB_median.to_dataframe("Precipitation")
-            df = multi_index_df.reset_index()
-            df_clean = df[df["Precipitation"] > 0]
-
-            X = (df_clean["Precipitation"].values).reshape(-1, 1)
-
-            # K-means
-            kmeans = KMeans(n_clusters=n, random_state=0).fit(X)
-            df_clean["labels"] = kmeans.labels_
-
-            # To DataArray
-            df_plot = df_clean[["labels", "lat", "lon"]]
-            df_pv = df_plot.pivot(index="lat", columns="lon")
-            df_pv = df_pv.droplevel(0, axis=1)
-            da = xr.DataArray(data=df_pv, name=str(d) + "s")
-
-            UIB_dec_list.append(da)
-
-        UIB_cluster_list.append(
-            xr.concat(
-                UIB_dec_list,
-                pd.Index(["1980s", "1990s", "2000s", "2010s"], name="Decade"),
-            )
-        )
-
-    # Combine data for plot formatting
-    UIB_clusters1 = xr.concat(
-        UIB_cluster_list[0:3], pd.Index(np.arange(2, 5), name="N")
-    )
-    UIB_clusters2 = xr.concat(
-        UIB_cluster_list[3:6], pd.Index(np.arange(5, 8), name="N")
-    )
-    UIB_clusters3 = xr.concat(
-        UIB_cluster_list[6:9], pd.Index(np.arange(8, 11), name="N")
-    )
-
-    # Plots
-    g = UIB_clusters1.plot(
-        x="lon",
-        y="lat",
-        col="Decade",
-        row="N",
-        add_colorbar=False,
-        subplot_kws={"projection": ccrs.PlateCarree()},
-    )
-    for ax in g.axes.flat:
-        ax.set_extent([71, 83, 30, 38])
-        sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-    g = UIB_clusters2.plot(
-        x="lon",
-        y="lat",
-        col="Decade",
-        row="N",
-        add_colorbar=False,
-        subplot_kws={"projection": ccrs.PlateCarree()},
-    )
-    for ax in g.axes.flat:
-        ax.set_extent([71, 83, 30, 38])
-        sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-    g = UIB_clusters3.plot(
-        x="lon",
-        y="lat",
-        col="Decade",
-        row="N",
-        add_colorbar=False,
-        subplot_kws={"projection": ccrs.PlateCarree()},
-    )
-    for ax in g.axes.flat:
-        ax.set_extent([71, 83, 30, 38])
-        sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-    plt.show()
+    cube = cluster_sweep(UIB_cum, N, decades)
+    plot_cluster_cube(cube, sliced_dem)
+    return cube
 
 
 def timeseries_clusters(UIB_cum, sliced_dem, N, decades, filter=0.7):
@@ -296,115 +222,147 @@ def timeseries_clusters(UIB_cum, sliced_dem, N, decades, filter=0.7):
     Returns:
         FacetGrid plots
     """
+    cube = cluster_sweep(UIB_cum, N, decades, timeseries=True, filter=filter)
+    plot_cluster_cube(cube, sliced_dem)
+    return cube
 
-    # Loop over cluster numbers and decades
-    UIB_cluster_list = []
 
-    for n in N:
-        UIB_dec_list = []
+def data_hash(da: xr.DataArray) -> str:
+    """ Returns a hash of the values and coordinates of a (time, lat, lon) DataArray """
+    if not isinstance(da, xr.DataArray):
+        raise TypeError("data_hash expects an xr.DataArray, not " + type(da).__name__)
+    h = hashlib.sha1()
+    for name in ["time", "lat", "lon"]:
+        h.update(np.ascontiguousarray(da[name].values).tobytes())
+    h.update(np.ascontiguousarray(da.transpose("time", "lat", "lon").values).tobytes())
+    return h.hexdigest()
 
-        for d in decades:
-            # Median cumulative rainfall for decades
-            UIB_d = UIB_cum.sel(
-                time=slice(str(d) + "-01-01T12:00:00",
-                           str(d + 10) + "-01-01T12:00:00")
-            )
 
-            # To DataFrame
-            multi_index_df = UIB_d.to_dataframe("Precipitation")
-            df = multi_index_df.reset_index()
-            df_clean = df[df["Precipitation"] > 0]
-            table = pd.pivot_table(
-                df_clean,
-                values="Precipitation",
-                index=["lat", "lon"],
-                columns=["time"],
-            )
-            X = table.interpolate()
+def _save(filepath, **arrays):
+    """ Saves arrays to an .npz file, atomically so interrupted runs leave no partial cache """
+    tmp = filepath + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.replace(tmp, filepath)
 
-            # K-means
-            kmeans = KMeans(n_clusters=n, random_state=0).fit(X)
 
-            if filter == 0:
-                X["labels"] = kmeans.labels_
-                filtered_df = X
+def cached_features(da: xr.DataArray, key=None, cache_dir=cache_dir) -> tuple:
+    """
+    Cells x months feature matrix of uib_clusters (positive precipitation, interpolated and
+    with incomplete cells dropped), cached on disk under the data hash. The matrix is
+    returned memory-mapped, so further calls do not read it into memory.
 
-            if filter > 0:
-                filtered_df = filtering(X, kmeans, thresh=filter)
+    Returns:
+        tuple: features (memory-mapped array), flat (lat, lon) indices of the rows, lat and lon
+            coordinates (ascending) and the data hash.
+    """
+    key = data_hash(da) if key is None else key
+    features_filepath = os.path.join(cache_dir, "features_" + key + ".npy")
+    cells_filepath = os.path.join(cache_dir, "cells_" + key + ".npz")
 
-            # To DataArray
-            df_plot = filtered_df.reset_index(
-            )[["labels", "lat", "lon"]]
-            df_pv = df_plot.pivot(index="lat", columns="lon")
-            df_pv = df_pv.droplevel(0, axis=1)
-            da = xr.DataArray(data=df_pv, name=str(d) + "s")
+    if not (os.path.exists(features_filepath) and os.path.exists(cells_filepath)):
+        os.makedirs(cache_dir, exist_ok=True)
+        da = da.sortby(["lat", "lon"])
+        values = da.transpose("lat", "lon", "time").values
+        values = np.where(values > 0, values, np.nan).reshape(-1, values.shape[-1])
 
-            UIB_dec_list.append(da)
+        # Same table as pivoting the positive values (cells and months without any are left out)
+        rows = np.flatnonzero(~np.all(np.isnan(values), axis=1))
+        months = ~np.all(np.isnan(values[rows]), axis=0)
+        table = pd.DataFrame(values[rows][:, months]).interpolate()
+        complete = table.notna().all(axis=1).values
 
-        UIB_cluster_list.append(
-            xr.concat(
-                UIB_dec_list,
-                pd.Index(["1980s", "1990s", "2000s", "2010s"], name="Decade"),
-            )
-        )
+        tmp = features_filepath + ".tmp.npy"
+        np.save(tmp, table.values[complete])
+        os.replace(tmp, features_filepath)
+        _save(cells_filepath, cells=rows[complete], lat=da.lat.values, lon=da.lon.values)
 
-    # Combine data for plot formatting
-    UIB_clusters1 = xr.concat(
-        UIB_cluster_list[0:3], pd.Index(np.arange(2, 5), name="N")
-    )
-    UIB_clusters2 = xr.concat(
-        UIB_cluster_list[3:6], pd.Index(np.arange(5, 8), name="N")
-    )
-    UIB_clusters3 = xr.concat(
-        UIB_cluster_list[6:9], pd.Index(np.arange(8, 11), name="N")
-    )
-
-    # Plots
-    g = UIB_clusters1.plot(
-        x="lon",
-        y="lat",
-        col="Decade",
-        row="N",
-        add_colorbar=False,
-        subplot_kws={"projection": ccrs.PlateCarree()},
-    )
-    for ax in g.axes.flat:
-        ax.set_extent([71, 83, 30, 38])
-        sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-    g = UIB_clusters2.plot(
-        x="lon",
-        y="lat",
-        col="Decade",
-        row="N",
-        add_colorbar=False,
-        subplot_kws={"projection": ccrs.PlateCarree()},
-    )
-    for ax in g.axes.flat:
-        ax.set_extent([71, 83, 30, 38])
-        sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
-
-    g = UIB_clusters3.plot(
-        x="lon",
-        y="lat",
-        col="Decade",
-        row="N",
-        add_colorbar=False,
-        subplot_kws={"projection": ccrs.PlateCarree()},
-    )
-    for ax in g.axes.flat:
-        ax.set_extent([71, 83, 30, 38])
-        sliced_dem.plot.contour(x="lon", y="lat", ax=ax, cmap="bone_r")
+    with np.load(cells_filepath) as f:
+        cells, lat, lon = f["cells"], f["lat"], f["lon"]
+    return np.load(features_filepath, mmap_mode="r"), cells, lat, lon, key
 
-    plt.show()
+
+def cached_kmeans(X: np.ndarray, N: int, key: str, cache_dir=cache_dir) -> dict:
+    """
+    K-means labels, cluster centres and maximum soft k-means weights of the feature matrix with
+    hash key, cached on disk so that any filter threshold can be applied without refitting.
+    """
+    filepath = os.path.join(cache_dir, "kmeans_" + key + "_" + str(N) + ".npz")
+    if not os.path.exists(filepath):
+        os.makedirs(cache_dir, exist_ok=True)
+        kmeans = KMeans(n_clusters=N, random_state=0).fit(X)
+        weights = soft_clustering_weights(X, kmeans.cluster_centers_, chunk_size=10000)
+        _save(filepath, labels=kmeans.labels_, centres=kmeans.cluster_centers_, weights=np.amax(weights, axis=1))
+    with np.load(filepath) as f:
+        return dict(f)
+
+
+def cluster_masks(da: xr.DataArray, N=3, filter=None, names=None, filepath=None, cache_dir=cache_dir) -> xr.Dataset:
+    """
+    Precipitation cluster masks in one Dataset: an integer 'labels' layer (-1 outside the
+    clusters), the maximum soft k-means 'weights' and one mask variable per cluster (1 inside,
+    NaN outside). The feature matrix and K-means fits are cached under the data hash, so only a
+    change of the data refits anything; a new filter threshold only reapplies the weights.
+
+    Args:
+        da (xr.DataArray | xr.Dataset): precipitation data (time, lat, lon), or a Dataset with
+            a 'tp' variable.
+        N (int, optional): number of clusters. Defaults to 3.
+        filter (float, optional): soft k-means threshold between 0 and 1. Defaults to None (no
+            filtering).
+        names (dict, optional): mask variable name of each label. Defaults to the UIB regime
+            names for N=3 and "cluster_<label>" otherwise.
+        filepath (str, optional): NetCDF file to write the masks to. Defaults to None (not saved).
+        cache_dir (str, optional): cache directory.
+
+    Returns:
+        xr.Dataset: masks (lat x lon).
+    """
+    da = da["tp"] if isinstance(da, xr.Dataset) else da
+    if names is None:
+        names = {0: "Khyber", 1: "Ngari", 2: "Gilgit"} if N == 3 else {i: "cluster_" + str(i) for i in range(N)}
+
+    X, cells, lat, lon, key = cached_features(da, cache_dir=cache_dir)
+    fit = cached_kmeans(X, N, key, cache_dir=cache_dir)
+
+    keep = fit["weights"] > filter if filter is not None else np.ones(len(cells), dtype=bool)
+    labels = np.full(len(lat) * len(lon), -1, dtype=np.int8)
+    labels[cells[keep]] = fit["labels"][keep]
+    weights = np.full(len(lat) * len(lon), np.nan)
+    weights[cells] = fit["weights"]
+    labels, weights = labels.reshape(len(lat), len(lon)), weights.reshape(len(lat), len(lon))
+
+    masks = xr.Dataset({"labels": (("lat", "lon"), labels), "weights": (("lat", "lon"), weights)},
+                       coords={"lat": lat, "lon": lon},
+                       attrs={"data_hash": key, "N": N, "filter": -1 if filter is None else filter})
+    masks["labels"].attrs["unlabelled"] = -1
+    for i in range(N):
+        masks[names[i]] = (("lat", "lon"), np.where(labels == i, 1., np.nan))
+
+    if filepath is not None:
+        masks.to_netcdf(filepath)
+    return masks
+
+
+def write_region_masks(masks: xr.Dataset, filter=None, directory=data_dir + "Masks/") -> list:
+    """ Writes each cluster of cluster_masks to its own single 'overlap' mask file, as read by load.era5 """
+    filepaths = []
+    for name in masks.data_vars:
+        if name in ["labels", "weights"]:
+            continue
+        suffix = "_mask.nc" if filter is None else "_mask_" + str(filter) + ".nc"
+        filepaths.append(directory + name + suffix)
+        masks[name].to_dataset(name="overlap").to_netcdf(filepaths[-1])
+    return filepaths
 
 
 def uib_clusters(tp_ds:xr.Dataset, N:int=3, filter:float= None, plot_clusters=False, plot_weights=False) -> list:
     """
-    Generate precipiation clusters for UIB.
+    Generate precipiation clusters for UIB. All the masks are also saved to one file, see
+    cluster_masks, and to one file per cluster.
 
     Args:
-        tp_ds (xr.Dataset): Precipitation data.
+        tp_ds (xr.Dataset | xr.DataArray): Precipitation data, a Dataset with a 'tp' variable or
+            the tp DataArray.
         N (int, optional):  Number of clusters. Defaults to 3.
         filter (floatorNone, optional): soft k-means filtering threshold, float between 0 (no
         filtering) and 1. Defaults to None in which case only k-means is performed.
@@ -414,40 +372,13 @@ def uib_clusters(tp_ds:xr.Dataset, N:int=3, filter:float= None, plot_clusters=Fa
     Returns:
         list: cluster masks as data arrays.
     """
-    names = {0: "Khyber", 1: "Ngari", 2: "Gilgit"}
-
-    multi_index_df = tp_ds.to_dataframe()
-    df = multi_index_df.reset_index()
-    df_clean = df[df["tp"] > 0]
-    table = pd.pivot_table(
-        df_clean, values="tp", index=["lat", "lon"],
-        columns=["time"])
-    X = table.interpolate().dropna()
-
-    # Soft k-means
-    kmeans = KMeans(n_clusters=N, random_state=0).fit(X)
+    suffix = str(N) if filter is None else str(N) + "_" + str(filter)
+    masks = cluster_masks(tp_ds, N=N, filter=filter, filepath=data_dir + "Masks/uib_clusters_" + suffix + ".nc")
+    write_region_masks(masks, filter=filter)
+    clusters = [masks[name].to_dataset(name="overlap") for name in masks.data_vars
+                if name not in ["labels", "weights"]]
+    ds = masks.where(masks.labels >= 0)
 
-    if filter != None:
-        filtered_df = filtering(X, kmeans, thresh=filter)
-        # Seperate labels and append as DataArray
-        reset_df = filtered_df.reset_index()[["labels", "lat", "lon"]]
-    else:
-        table['labels'] = kmeans.predict(X)
-        reset_df = table.reset_index()[["labels", "lat", "lon"]]
-
-    ds = reset_df.set_index(["lon", "lat"]).to_xarray()
-
-    clusters = []
-    for i in range(N):
-        cluster_ds = ds.where(ds.labels == i)
-        cluster_ds = cluster_ds.rename({"labels": "overlap"})
-        cluster_ds = cluster_ds.where(cluster_ds.overlap !=i, 1)
-        clusters.append(cluster_ds)
-        if filter != None:
-            cluster_ds.to_netcdf(path= data_dir + "Masks/" + names[i] + "_mask_" + str(filter) + ".nc")
-        else:
-            cluster_ds.to_netcdf(path= data_dir + "Masks/" + names[i] + "_mask.nc")
-    
     if plot_clusters is True:
         # Plot
         plt.figure(figsize=(4, 2))
@@ -477,18 +408,7 @@ def uib_clusters(tp_ds:xr.Dataset, N:int=3, filter:float= None, plot_clusters=Fa
         plt.show()
 
     if plot_weights is True:
-        df_clean = df[df["tp"] > 0]
-        table = pd.pivot_table(
-            df_clean, values="tp", index=["lat", "lon"],
-            columns=["time"])
-        X = table.interpolate()
-
-        unfiltered_df = filtering(X, kmeans, thresh=0)
-        conf_df = unfiltered_df.reset_index(
-        )[["weights", "lat", "lon"]]
-        df_pv = conf_df.pivot(index="lat", columns="lon")
-        df_pv = df_pv.droplevel(0, axis=1)
-        conf_da = xr.DataArray(data=df_pv, name="Confidence")
+        conf_da = masks.weights.rename("Confidence")
 
         # Plot
         plt.figure()
@@ -512,7 +432,7 @@ def uib_clusters(tp_ds:xr.Dataset, N:int=3, filter:float= None, plot_clusters=Fa
     return clusters
 
 
-def soft_clustering_weights(data, cluster_centres, **kwargs):
+def soft_clustering_weights(data, cluster_centres, m=2, dtype=np.float64, chunk_size=None):
     """
     Taken from:
     https://towardsdatascience.com/confidence-in-k-means-d7d3a13ca856
@@ -522,32 +442,38 @@ def soft_clustering_weights(data, cluster_centres, **kwargs):
         F Features
     cluster_centres: array of cluster centres. shape = Nc x F, for Nc number
         of clusters. Input kmeans.cluster_centres_ directly.
-    param: m - keyword argument, fuzziness of the clustering. Default 2
+    m: fuzziness of the clustering, m>=1 where m=1 => hard segmentation. Default 2
+    dtype: computation dtype, e.g. np.float32 for large matrices. Default np.float64
+    chunk_size: number of data points per chunk, bounding memory to chunk_size x Nc.
+        Default None (all at once)
+
+    The squared distances D are computed with |x|^2 - 2 x.c + |c|^2 (no copies of the
+    data) and the weights 1 / (D_ij^p sum_k D_ik^-p), with p = 2 / (m - 1), as
+    (D_i,min / D_ij)^p normalised over clusters, which does not overflow. Points on a
+    cluster centre get weight one (shared between coincident centres).
     """
+    X = np.asarray(data, dtype=dtype)
+    C = np.asarray(cluster_centres, dtype=dtype)
+    p = 2 / (m - 1)
 
-    # Fuzziness parameter m>=1. Where m=1 => hard segmentation
-    m = 2
-    if "m" in kwargs:
-        m = kwargs["m"]
-
-    Nclusters = cluster_centres.shape[0]
-    Ndp = data.shape[0]
-    # Nfeatures = data.shape[1]
-
-    # Get distances from the cluster centres for each data point and each
-    # cluster
-    EuclidDist = np.zeros((Ndp, Nclusters))
-    for i in range(Nclusters):
-        EuclidDist[:, i] = np.sum(
-            (data - np.tile(cluster_centres[i], (Ndp, 1))) ** 2, axis=1
-        )
+    Ndp = X.shape[0]
+    chunk_size = Ndp if not chunk_size else chunk_size
+    c2 = np.einsum("ij,ij->i", C, C)
+
+    Weight = np.empty((Ndp, C.shape[0]), dtype=dtype)
+    for start in range(0, Ndp, chunk_size):
+        x = X[start:start + chunk_size]
+
+        # Squared distances from the cluster centres for each data point
+        EuclidDist = np.einsum("ij,ij->i", x, x)[:, None] - 2 * x @ C.T + c2
+        np.maximum(EuclidDist, 0, out=EuclidDist)
+
+        zero = EuclidDist == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = (EuclidDist.min(axis=1, keepdims=True) / EuclidDist) ** p
+        ratio = np.where(zero.any(axis=1, keepdims=True), zero, ratio)
 
-    # Denominator of the weight from wikipedia:
-    invWeight = EuclidDist ** (2 / (m - 1)) * np.tile(
-        np.sum((1.0 / EuclidDist) ** (2 / (m - 1)), axis=1).reshape(-1, 1),
-        (1, Nclusters),
-    )
-    Weight = 1.0 / invWeight
+        Weight[start:start + chunk_size] = ratio / ratio.sum(axis=1, keepdims=True)
 
     return Weight
 
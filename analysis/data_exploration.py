@@ -1,5 +1,7 @@
 # Data Exploration
 
+from functools import lru_cache
+
 import numpy as np
 import xarray as xr
 import pandas as pd
@@ -12,10 +14,15 @@ from load import era5, location_sel
 import gp.data_prep as dp
 
 
-data_filepath = era5.update_cds_monthly_data()
 mask_filepath = "_Data/ERA5_Upper_Indus_mask.nc"
 
 
+@lru_cache(maxsize=None)
+def cds_monthly_filepath() -> str:
+    """ Returns the path of the monthly CDS data, updated on first call rather than on import """
+    return era5.update_cds_monthly_data()
+
+
 def sample_timeseries(
         data_filepath, variable="tp", longname="Total precipitation [m/day]"):
     """ Timeseries for Gilgit, Skardu and Leh"""
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Block sampling benchmark
+# by_loc sampling of random_location_and_time_sampler against the previous implementation
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import numpy as np
+import pandas as pd
+
+import gp.sampling as sa
+
+
+def legacy_sampler(df, length=1000, seed=42):
+    """ Previous by_loc implementation, growing the index array with np.append """
+    np.random.seed(seed)
+    df_sorted = df.sort_values(by='time')
+    J = np.random.randint(len(df)-36, size=int(length/36))
+    for j in J:
+        J = np.append(J, np.arange(j+1, j+36))
+    return df_sorted.iloc[J]
+
+
+def timeit(f, repeat=5):
+    """ Returns best wall time of repeat calls """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+
+    # Synthetic monthly data on a 30 x 30 grid over 50 years
+    lat, lon, t = np.meshgrid(np.arange(30) * 0.25, np.arange(30) * 0.25,
+                              pd.date_range('1970', periods=600, freq='MS').values.astype(np.int64), indexing='ij')
+    df = pd.DataFrame({'time': t.ravel(), 'lat': lat.ravel(), 'lon': lon.ravel(),
+                       'tp': np.random.default_rng(0).gamma(2, size=t.size)})
+
+    length = 14000
+    results = {'legacy': timeit(lambda: legacy_sampler(df, length=length)),
+               'block': timeit(lambda: sa.random_location_and_time_sampler(df, length=length, by_loc=True)),
+               'block within location': timeit(lambda: sa.random_location_and_time_sampler(
+                   df, length=length, by_loc=True, within_location=True))}
+
+    df_results = pd.Series(results, name='time (s)').to_frame()
+    df_results['speed up'] = results['legacy'] / df_results['time (s)']
+    print(f'{len(df)} rows, length={length}')
+    print(df_results)
+
+    # Same number of rows and contiguous windows
+    sample = sa.random_location_and_time_sampler(df, length=length, by_loc=True, within_location=True)
+    assert len(sample) == len(legacy_sampler(df, length=length))
+    windows = sample.groupby(np.arange(len(sample)) // 36)
+    assert (windows[['lat', 'lon']].nunique() == 1).all().all()
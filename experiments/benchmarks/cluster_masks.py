@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Cluster mask pipeline benchmark
+# Cold and cached mask generation against the previous pivot table implementation, on synthetic
+# monthly precipitation (480 months x 60 x 90 cells)
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+from sklearn.cluster import KMeans
+
+from analysis.cluster import cluster_masks, filtering
+
+
+def synthetic_tp(n_months=480, n_lat=60, n_lon=90, seed=0) -> xr.DataArray:
+    """ Returns three precipitation regimes with dry (zero) months and a dry corner """
+    rng = np.random.default_rng(seed)
+    lat, lon = np.linspace(38, 30, n_lat), np.linspace(71, 83, n_lon)
+    regime = (np.arange(n_lon)[None, :] * 3 // n_lon + np.zeros((n_lat, 1), dtype=int))
+    t = np.arange(n_months)
+    cycles = np.stack([np.sin(2 * np.pi * t / 12 + phase) + 1.2 for phase in [0, 2, 4]])
+    values = cycles[regime].transpose(2, 0, 1) + rng.gamma(1, 0.3, size=(n_months, n_lat, n_lon))
+    values[rng.random(values.shape) < 0.05] = 0
+    values[:, :5, :5] = 0
+    return xr.DataArray(values, coords={"time": pd.date_range("1980-01-01", periods=n_months, freq="MS"),
+                                        "lat": lat, "lon": lon}, dims=["time", "lat", "lon"], name="tp")
+
+
+def legacy_labels(da, N=3, filter=None) -> xr.DataArray:
+    """ Previous uib_clusters labels """
+    df = da.to_dataframe().reset_index()
+    df_clean = df[df["tp"] > 0]
+    table = pd.pivot_table(df_clean, values="tp", index=["lat", "lon"], columns=["time"])
+    X = table.interpolate().dropna()
+    kmeans = KMeans(n_clusters=N, random_state=0).fit(X)
+    filtered_df = filtering(X, kmeans, thresh=0 if filter is None else filter)
+    ds = filtered_df.reset_index()[["labels", "lat", "lon"]].set_index(["lat", "lon"]).to_xarray()
+    return ds.labels
+
+
+if __name__ == '__main__':
+
+    da = synthetic_tp()
+
+    t0 = time.perf_counter()
+    old = legacy_labels(da, filter=0.7)
+    print(f"legacy:             {time.perf_counter() - t0:.2f} s")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        t0 = time.perf_counter()
+        masks = cluster_masks(da, N=3, filter=0.7, cache_dir=cache_dir)
+        print(f"cold cache:         {time.perf_counter() - t0:.2f} s")
+
+        for filter in [0.5, 0.8, 0.9]:
+            t0 = time.perf_counter()
+            cluster_masks(da, N=3, filter=filter, cache_dir=cache_dir)
+            print(f"new filter {filter}:     {time.perf_counter() - t0:.2f} s")
+
+        t0 = time.perf_counter()
+        cluster_masks(da, N=4, filter=0.7, cache_dir=cache_dir)
+        print(f"new N (4):          {time.perf_counter() - t0:.2f} s")
+
+    new = masks.labels.where(masks.labels >= 0).reindex_like(old)
+    assert np.array_equal(np.isnan(new.values), np.isnan(old.values))
+    assert np.array_equal(new.values[~np.isnan(new.values)], old.values[~np.isnan(old.values)])
+    print("labels match the previous implementation")
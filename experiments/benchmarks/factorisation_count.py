@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Factorisations per model scoring call
+# Counts Cholesky factorisations when scoring a fitted GPR with and without the shared factor
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import numpy as np
+import gpflow
+import tensorflow as tf
+
+import utils.metrics as me
+
+
+class CholeskyCounter():
+    """ Counts calls to tf.linalg.cholesky while active """
+
+    def __init__(self):
+        self.count = 0
+        self._cholesky = tf.linalg.cholesky
+
+    def __enter__(self):
+        def counted(*args, **kwargs):
+            self.count += 1
+            return self._cholesky(*args, **kwargs)
+        tf.linalg.cholesky = counted
+        return self
+
+    def __exit__(self, *exc):
+        tf.linalg.cholesky = self._cholesky
+
+
+def separate_scores(m, xval, yval):
+    """ Previous pattern: each score builds its own factorisation """
+    x, y = m.data
+    K = m.kernel(x)
+    L = tf.linalg.cholesky(gpflow.utilities.add_likelihood_noise_cov(K, m.likelihood, x))
+    lml = tf.reduce_sum(gpflow.logdensities.multivariate_normal(y, m.mean_function(x), L))
+    bic = len(m.trainable_variables) * np.log(len(x)) - 2 * lml
+    y_pred, y_var = m.predict_y(xval)
+    return {'BIC': float(bic), 'log_marg_likelihood': float(m.log_marginal_likelihood()),
+            'R2': me.R2(yval, y_pred.numpy()), 'MLL': me.MLL(yval.reshape(-1, 1), y_pred.numpy(), y_var.numpy())}
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    n, n_val = 3000, 500
+    x = rng.uniform(size=(n + n_val, 3))
+    y = np.sin(10 * x[:, :1]) + x[:, 1:2] + 0.1 * rng.normal(size=(n + n_val, 1))
+
+    m = gpflow.models.GPR(data=(x[:n], y[:n]), kernel=gpflow.kernels.Matern32(lengthscales=[0.2, 0.2, 0.2]))
+    xval, yval = x[n:], y[n:]
+
+    for name, f in [('separate', separate_scores), ('shared factor', me.score_model)]:
+        with CholeskyCounter() as counter:
+            t0 = time.perf_counter()
+            scores = f(m, xval, yval)
+            elapsed = time.perf_counter() - t0
+        print(f'{name}: {counter.count} Cholesky factorisations, {elapsed:.2f} s')
+        print({k: round(float(v), 4) for k, v in scores.items()})
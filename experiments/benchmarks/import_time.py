@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Import time benchmark
+# Imports each analysis, maps and gp module in a fresh interpreter and checks that it is quick
+# and opens no data files, sockets or subprocesses. Third-party libraries are imported before
+# the clock starts, so only the module's own import-time work is measured.
+
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+PACKAGES = ['analysis', 'maps', 'gp']
+PRELOAD = ['numpy', 'scipy.stats', 'pandas', 'xarray', 'matplotlib.pyplot', 'sklearn.cluster',
+           'sklearn.decomposition', 'cartopy.crs', 'cartopy.feature', 'tensorflow', 'tensorflow_probability',
+           'gpflow', 'torch', 'gpytorch', 'seaborn', 'tqdm', 'load']
+THRESHOLD = 1.0  # seconds
+
+CHILD = r'''
+import sys, os, json, time, importlib
+module, root, preload = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+sys.path.insert(0, root)
+for lib in preload:
+    try:
+        importlib.import_module(lib)
+    except Exception:
+        pass
+
+allowed = tuple({sys.prefix, sys.base_prefix, sys.exec_prefix} | {p for p in sys.path if 'site-packages' in p})
+code = ('.py', '.pyc', '.so', '.pyd', '.pth')
+events = []
+
+def hook(event, args):
+    if event == 'open':
+        path = args[0]
+        if isinstance(path, bytes):
+            path = path.decode(errors='replace')
+        if isinstance(path, str) and not path.endswith(code) and not os.path.abspath(path).startswith(allowed):
+            events.append('open ' + path)
+    elif event in ('socket.connect', 'socket.getaddrinfo', 'subprocess.Popen', 'urllib.Request'):
+        events.append(event + ' ' + repr(args[:2]))
+
+sys.addaudithook(hook)
+status = 'ok'
+t0 = time.perf_counter()
+try:
+    importlib.import_module(module)
+except ModuleNotFoundError as e:
+    status = 'skipped (missing ' + str(e.name) + ')'
+except Exception as e:
+    status = 'error (' + type(e).__name__ + ': ' + str(e)[:80] + ')'
+elapsed = time.perf_counter() - t0
+print(json.dumps({'module': module, 'status': status, 'time': elapsed, 'io': events}))
+'''
+
+
+def modules(root=ROOT, packages=PACKAGES) -> list:
+    """ Returns the dotted names of the modules of packages """
+    names = []
+    for package in packages:
+        for filename in sorted(os.listdir(os.path.join(root, package))):
+            if filename.endswith('.py') and filename != '__init__.py':
+                names.append(package + '.' + filename[:-3])
+    return names
+
+
+def import_report(module: str, root=ROOT, preload=PRELOAD) -> dict:
+    """ Returns the import time, status and I/O events of module, imported in a fresh interpreter """
+    out = subprocess.run([sys.executable, '-c', CHILD, module, root, json.dumps(preload)],
+                         capture_output=True, text=True, cwd=root)
+    lines = out.stdout.strip().splitlines()
+    if out.returncode != 0 or not lines:
+        return {'module': module, 'status': 'crashed', 'time': float('nan'), 'io': [out.stderr.strip()[-200:]]}
+    return json.loads(lines[-1])
+
+
+if __name__ == '__main__':
+
+    threshold = float(sys.argv[1]) if len(sys.argv) > 1 else THRESHOLD
+    failures = []
+
+    for module in modules():
+        report = import_report(module)
+        failed = report['status'] != 'ok' and not report['status'].startswith('skipped')
+        failed |= report['time'] > threshold or len(report['io']) > 0
+        if failed:
+            failures.append(module)
+        print(f"{module:35s} {report['time']:7.3f} s  {report['status']}{'  FAIL' if failed else ''}")
+        for event in report['io']:
+            print('    ', event)
+
+    print(f"\n{len(failures)} module(s) over {threshold} s or doing I/O on import" + (': ' + ', '.join(failures)
+                                                                                      if failures else ''))
+    assert not failures
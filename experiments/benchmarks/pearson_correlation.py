@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Vectorised Pearson correlation benchmark
+# Chunked matrix correlations and p-values against a scipy.stats.pearsonr loop, with and without
+# missing values
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import numpy as np
+from scipy.stats import pearsonr
+
+from analysis.Correlation import pearson
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    T, M = 500, 200000
+    y = rng.normal(size=T)
+    X = 0.1 * y[:, None] * rng.normal(size=M) + rng.normal(size=(T, M))
+
+    t0 = time.perf_counter()
+    r, p = pearson(y, X, chunk_size=20000)
+    print(f"vectorised, {M} columns:  {time.perf_counter() - t0:.2f} s")
+
+    n_loop = 2000
+    t0 = time.perf_counter()
+    reference = np.array([pearsonr(y, X[:, j]) for j in range(n_loop)])
+    elapsed = time.perf_counter() - t0
+    print(f"pearsonr loop, {n_loop} columns: {elapsed:.2f} s (~{elapsed * M / n_loop:.0f} s for all)")
+
+    assert np.allclose(r[:n_loop], reference[:, 0], atol=1e-12)
+    assert np.allclose(p[:n_loop], reference[:, 1], rtol=1e-8, atol=1e-300)
+
+    # Missing values are left out per column
+    X[rng.random(X.shape) < 0.05] = np.nan
+    r, p = pearson(y, X[:, :200], chunk_size=64)
+    for j in range(200):
+        valid = ~np.isnan(X[:, j])
+        r_j, p_j = pearsonr(y[valid], X[valid, j])
+        assert np.isclose(r[j], r_j, atol=1e-12) and np.isclose(p[j], p_j, rtol=1e-8)
+
+    print("correlations and p-values match scipy.stats.pearsonr")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Probabilistic metrics check and benchmark
+# Vectorized scores against slow reference implementations, and their run times
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import numpy as np
+from scipy.integrate import quad
+from scipy.stats import norm
+
+import utils.probabilistic_metrics as pm
+
+
+def spread_skill_reference(y, samples):
+    T, N = samples.shape
+    S2, eta2 = 0., 0.
+    for t in range(T):
+        mu = sum(samples[t]) / N
+        S2 += sum((samples[t, n] - mu)**2 for n in range(N)) / (N - 1)
+        eta2 += (y[t] - mu)**2
+    S2, eta2 = S2 / T, eta2 / T
+    return np.sqrt(S2 / (eta2 - S2 / N))
+
+
+def crps_samples_reference(y, samples):
+    T, N = samples.shape
+    crps = np.empty(T)
+    for t in range(T):
+        term1 = sum(abs(samples[t, i] - y[t]) for i in range(N)) / N
+        term2 = sum(abs(samples[t, i] - samples[t, j]) for i in range(N) for j in range(N)) / (2 * N**2)
+        crps[t] = term1 - term2
+    return crps
+
+
+def crps_gaussian_reference(y, mu, var):
+    integrand = lambda x, yt, mt, st: (norm.cdf(x, mt, st) - (x >= yt))**2
+    crps = np.empty(len(y))
+    for t in range(len(y)):
+        args = (y[t], mu[t], np.sqrt(var[t]))
+        lower, upper = mu[t] - 12 * args[2], mu[t] + 12 * args[2]
+        crps[t] = quad(integrand, lower, y[t], args=args)[0] + quad(integrand, y[t], upper, args=args)[0]
+    return crps
+
+
+def pit_samples_reference(y, samples):
+    T, N = samples.shape
+    return np.array([sum((s < y[t]) + 0.5 * (s == y[t]) for s in samples[t]) / N for t in range(T)])
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = f(*args, **kwargs)
+    return out, time.perf_counter() - t0
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+
+    # Small problem for the references
+    T, N = 200, 50
+    y = rng.normal(size=T)
+    samples = rng.normal(size=(T, N)) * 1.2 + 0.1
+    mu, var = rng.normal(size=T) * 0.1, rng.uniform(0.5, 2, size=T)
+
+    checks = {
+        'spread_skill': (pm.spread_skill(y, samples, chunk_size=64), spread_skill_reference(y, samples)),
+        'crps_samples': (pm.crps_samples(y, samples, chunk_size=64), crps_samples_reference(y, samples)),
+        'crps_gaussian': (pm.crps_gaussian(y, mu, var), crps_gaussian_reference(y, mu, var)),
+        'pit_samples': (pm.pit_samples(y, samples, chunk_size=64), pit_samples_reference(y, samples)),
+        'pit_gaussian': (pm.pit_gaussian(y, mu, var), norm.cdf(y, mu, np.sqrt(var))),
+    }
+    for name, (fast, reference) in checks.items():
+        assert np.allclose(fast, reference, atol=1e-6), name
+        print(f'{name}: max abs difference {np.max(np.abs(np.asarray(fast) - reference)):.2e}')
+
+    # Calibrated Gaussian predictions: coverage close to the nominal levels, flat PIT histogram
+    mu, var = np.zeros(100000), np.ones(100000)
+    y = rng.normal(size=100000)
+    print('coverage', pm.coverage_gaussian(y, mu, var))
+    print('PIT density', np.round(pm.pit_histogram(pm.pit_gaussian(y, mu, var))[0], 2))
+    samples = rng.normal(size=(2000, 500))
+    print('sample coverage', pm.coverage_samples(y[:2000], samples, chunk_size=500))
+
+    # Timings on a large ensemble
+    T, N = 20000, 1000
+    y = rng.normal(size=T)
+    samples = rng.normal(size=(T, N)).astype(np.float32)
+    for name, f in [('spread_skill', pm.spread_skill), ('crps_samples', pm.crps_samples),
+                    ('pit_samples', pm.pit_samples), ('coverage_samples', pm.coverage_samples)]:
+        _, t = timed(f, y, samples, chunk_size=2000)
+        print(f'{name} on {T} x {N}: {t:.2f} s')
+    _, t = timed(spread_skill_reference, y[:20], samples[:20].astype(np.float64))
+    print(f'reference spread_skill on 20 x {N}: {t:.2f} s')
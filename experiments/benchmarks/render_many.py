@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Figure pipeline smoke test
+# Renders 400 per-cell model figures from precomputed arrays, serially and in a process pool
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import os
+import time
+import tempfile
+import numpy as np
+
+from utils.figures import render_many
+
+
+def cell_tasks(directory, n_cells=400, n_months=36, seed=0) -> list:
+    """ Returns model figure tasks with synthetic predictions and data for n_cells cells """
+    rng = np.random.default_rng(seed)
+    t = 2005 + np.arange(n_months) / 12
+    tasks = []
+    for c in range(n_cells):
+        y_mean = 2 + np.sin(2 * np.pi * t) + rng.normal(scale=0.1)
+        y = y_mean + rng.normal(scale=0.5, size=n_months)
+        tasks.append({"kind": "model", "filepath": os.path.join(directory, "cell_" + str(c) + ".png"),
+                      "t": t, "y_mean": y_mean, "y_lower": y_mean - 1, "y_upper": y_mean + 1,
+                      "t_train": t[:12], "y_train": y[:12], "t_val": t[12:], "y_val": y[12:],
+                      "title": "Cell " + str(c), "dpi": 50})
+    return tasks
+
+
+if __name__ == '__main__':
+
+    with tempfile.TemporaryDirectory() as directory:
+        tasks = cell_tasks(directory)
+
+        t0 = time.perf_counter()
+        render_many(tasks[:40], n_workers=1)
+        serial = (time.perf_counter() - t0) * len(tasks) / 40
+        print(f"serial (extrapolated):  {serial:.1f} s")
+
+        t0 = time.perf_counter()
+        filepaths = render_many(tasks)
+        print(f"process pool:           {time.perf_counter() - t0:.1f} s")
+
+        assert filepaths == [task["filepath"] for task in tasks]
+        assert all(os.path.getsize(f) > 0 for f in filepaths)
+        print(f"{len(filepaths)} figures rendered")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Soft k-means weights benchmark
+# Broadcast implementation against the previous tiling loop on a 400 x 600 (cells x months) matrix
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import numpy as np
+from sklearn.cluster import KMeans
+
+from analysis.cluster import soft_clustering_weights
+
+
+def legacy_weights(data, cluster_centres, m=2):
+    """ Previous implementation """
+    Nclusters = cluster_centres.shape[0]
+    Ndp = data.shape[0]
+    EuclidDist = np.zeros((Ndp, Nclusters))
+    for i in range(Nclusters):
+        EuclidDist[:, i] = np.sum((data - np.tile(cluster_centres[i], (Ndp, 1))) ** 2, axis=1)
+    invWeight = EuclidDist ** (2 / (m - 1)) * np.tile(
+        np.sum((1.0 / EuclidDist) ** (2 / (m - 1)), axis=1).reshape(-1, 1), (1, Nclusters))
+    return 1.0 / invWeight
+
+
+def best_time(f, repeat=20):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    X = rng.gamma(2, size=(400, 600))
+    centres = KMeans(n_clusters=10, random_state=0, n_init=10).fit(X).cluster_centers_
+
+    reference = legacy_weights(X, centres)
+    for kwargs in [{}, {'dtype': np.float32}, {'chunk_size': 64}]:
+        w = soft_clustering_weights(X, centres, **kwargs)
+        assert np.allclose(w, reference, rtol=1e-3 if kwargs.get('dtype') == np.float32 else 1e-8), kwargs
+
+    t_legacy = best_time(lambda: legacy_weights(X, centres))
+    print(f'legacy: {t_legacy * 1e3:.2f} ms')
+    for kwargs in [{}, {'dtype': np.float32}, {'chunk_size': 64}]:
+        t = best_time(lambda: soft_clustering_weights(X, centres, **kwargs))
+        print(f'broadcast {kwargs}: {t * 1e3:.2f} ms ({t_legacy / t:.1f}x)')
+
+    # A point on a cluster centre: weight one instead of NaN
+    w = soft_clustering_weights(np.vstack([centres[:1], X[:5]]), centres)
+    print('weights of a centre:', np.round(w[0], 3), 'legacy:', np.round(legacy_weights(centres[:1], centres)[0], 3))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Streaming metrics check
+# Chunked and merged accumulators against the batch functions of utils.metrics
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import numpy as np
+
+import utils.metrics as me
+import utils.streaming as st
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    n = 1000000
+    y = rng.gamma(2, size=n)
+    y_pred = y + rng.normal(scale=0.5, size=n)
+    y_var = rng.uniform(0.1, 1, size=n)
+
+    # Four "workers" each streaming chunks of their share, then merged
+    shares = np.array_split(np.arange(n), 4)
+    accs = []
+    for share in shares:
+        acc = st.RegressionAccumulator()
+        for rows in np.array_split(share, 25):
+            acc.update(y[rows], y_pred[rows], y_var[rows])
+        accs.append(acc)
+    streamed = st.merge_all(accs).finalize()
+
+    batch = {'R2': me.R2(y, y_pred), 'RMSE': me.RMSE(y, y_pred), 'MLL': me.MLL(y, y_pred, y_var),
+             'bias': np.mean(y_pred - y)}
+    for k, v in batch.items():
+        print(f'{k}: streamed {streamed[k]:.10f}, batch {v:.10f}')
+        assert np.isclose(streamed[k], v, rtol=1e-9, atol=1e-12), k
+
+    # Percentile sketch
+    sketch = st.merge_all([st.HistogramSketch(0, 20).update(y[share]) for share in shares])
+    approx = sketch.percentile([5, 50, 95])
+    exact = np.percentile(y, [5, 50, 95])
+    print('percentiles', approx, exact)
+    assert np.all(np.abs(approx - exact) <= 20 / 10000 + 1e-12)
+
+    exact_stats = st.regression_stats(y, y_pred)
+    chunked_stats = st.regression_stats(y, y_pred, chunk_size=100000)
+    print({k: (round(exact_stats[k], 5), round(chunked_stats[k], 5)) for k in exact_stats})
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Active learning of the UIB training set
+# Points are chosen from a large random pool by predictive variance until the budget is reached
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import numpy as np
+import tensorflow as tf
+
+import gp.data_prep as dp
+from gp.active_learning import active_learning
+
+
+tf.random.set_seed(42)
+
+### Load data, the training sample is used as the candidate pool
+dataset = dp.areal_model_new('uib', length=20000, var='uib')
+xpool, xval, xtest, ypool, yval_tr, ytest_tr = dataset.sets()
+
+model, selected, history = active_learning(xpool, ypool, xval, yval_tr, n_seed=200, batch_size=50,
+                                           budget=3000, refit_every=5)
+
+history.to_csv('experiments/wbm/active_learning_uib.csv')
+np.save('experiments/wbm/active_learning_uib_idx.npy', selected)
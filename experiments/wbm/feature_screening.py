@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Screening proxies for kernel feature selection
+# Agreement of the cheap proxies with the exhaustive forward selection and wall time saved on UIB
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import pandas as pd
+import tensorflow as tf
+
+import gp.data_prep as dp
+import gp.feature_selection as fs
+
+
+methods = ['mll', 'rff', 'ard']
+top_k = 3
+
+
+if __name__ == '__main__':
+
+    tf.random.set_seed(42)
+
+    ### Load
+    dataset = dp.areal_model_new(location='uib', length=5000, maxyear='2020', var='all')
+    xtrain, xval, xtest, ytrain_tr, yval_tr, ytest_tr = dataset.sets()
+    candidates = range(3, xtrain.shape[1])
+
+    ### Exhaustive selection
+    t0 = time.perf_counter()
+    exhaustive = fs.forward_selection(xtrain, xval, ytrain_tr, yval_tr, candidates, spatial=True)
+    exhaustive_time = time.perf_counter() - t0
+
+    ### Proxy rankings on the exhaustive incumbents
+    agreement = []
+    selected = []
+    for h in exhaustive.history[1:]:
+        state = fs.ForwardSelection(list(h['candidates']), base_dims=selected)
+        state.incumbent = exhaustive.cache[fs.ForwardSelection.key(selected)]
+
+        for method in methods:
+            t0 = time.perf_counter()
+            proxy = fs.screen_candidates(state, xtrain, xval, ytrain_tr, yval_tr, method=method, spatial=True)
+            proxy_time = time.perf_counter() - t0
+            ranked = sorted(proxy, key=proxy.get, reverse=True)
+            agreement.append({'step': h['step'], 'method': method, 'n_candidates': len(proxy),
+                              'top1_agrees': ranked[0] == h['added'], 'topk_hit': h['added'] in ranked[:top_k],
+                              'proxy_time': proxy_time})
+        selected = selected + [h['added']]
+
+    df_agreement = pd.DataFrame(agreement)
+    df_agreement.to_csv('experiments/wbm/feature_screening_agreement.csv')
+
+    ### Screened selection
+    runs = [{'method': 'exhaustive', 'time': exhaustive_time, 'n_fits': exhaustive.n_fits,
+             'selected': exhaustive.selected, 'best_R2': exhaustive.best['score']}]
+    for method in methods:
+        t0 = time.perf_counter()
+        state = fs.forward_selection(xtrain, xval, ytrain_tr, yval_tr, candidates, spatial=True,
+                                     screen=method, top_k=top_k)
+        runs.append({'method': method, 'time': time.perf_counter() - t0, 'n_fits': state.n_fits,
+                     'selected': state.selected, 'best_R2': state.best['score']})
+
+    df_runs = pd.DataFrame(runs).set_index('method')
+    df_runs['speed_up'] = exhaustive_time / df_runs['time']
+    df_runs['same_order'] = [s == exhaustive.selected for s in df_runs['selected']]
+    df_runs.to_csv('experiments/wbm/feature_screening_runs.csv')
+
+    print(df_agreement.groupby('method')[['top1_agrees', 'topk_hit', 'proxy_time']].mean())
+    print(df_runs.drop(columns='selected'))
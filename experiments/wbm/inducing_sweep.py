@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Inducing point sweep for the non-stationary model
+# Training time per iteration and validation MLL as a function of the number of inducing points
+
+import sys
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction/')
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code')
+
+import time
+import numpy as np
+import pandas as pd
+import gpytorch
+import torch
+
+import utils.metrics as me
+import gp.data_prep as dp
+from gp.gibbs_gp import MultiGibbsKernel, inducing_grid
+
+
+inducing_counts = [25, 50, 100, 200, None]  # None -> every unique location
+methods = ['kmeans', 'grid', 'greedy']
+n_iter = 50
+
+### Load data
+dataset = dp.areal_model_new('uib', var="uib")
+xtrain, xval, xtest, ytrain_tr, yval_tr, ytest_tr = dataset.sets()
+
+Xtrain = torch.as_tensor(xtrain * 20, dtype=torch.float64)
+Ytrain_tr = torch.as_tensor(ytrain_tr.reshape(-1), dtype=torch.float64)
+
+results = []
+
+for method in methods:
+    for num_inducing in inducing_counts:
+
+        torch.manual_seed(42)
+        z = inducing_grid(xtrain * 20, num_inducing=num_inducing, method=method)
+
+        likelihood = gpytorch.likelihoods.GaussianLikelihood()
+        likelihood.noise_covar.raw_noise.requires_grad = False
+        model = MultiGibbsKernel(Xtrain, Ytrain_tr, z, likelihood)
+        Xval = model.tensor(xval * 20)
+
+        model.train()
+        likelihood.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        mll = gpytorch.mlls.ExactMarginalLogLikelihood(likelihood, model)
+
+        t0 = time.perf_counter()
+        for i in range(n_iter):
+            optimizer.zero_grad()
+            loss = -mll(model(model.train_inputs[0]), model.train_targets)
+            loss.backward()
+            optimizer.step()
+        time_per_iter = (time.perf_counter() - t0) / n_iter
+
+        model.eval()
+        likelihood.eval()
+        with torch.no_grad(), gpytorch.settings.fast_pred_var():
+            preds = likelihood(model(Xval))
+            y_mean = preds.mean.numpy()
+            y_var = preds.variance.numpy()
+
+        results.append([method, len(z), time_per_iter,
+                        me.MLL(yval_tr.reshape(-1), y_mean, y_var),
+                        me.R2(yval_tr.reshape(-1), y_mean)])
+        print(results[-1])
+
+df = pd.DataFrame(results, columns=['method', 'num_inducing', 'time_per_iter', 'val_MLL', 'val_R2'])
+df.to_csv('experiments/wbm/inducing_sweep.csv')
+print(df)
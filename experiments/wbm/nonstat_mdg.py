@@ -27,12 +27,16 @@ import torch
 
 import matplotlib.pylab as plt
 from sklearn.metrics import root_mean_squared_error, r2_score
-from gp.gibbs_gp import MultiGibbsKernel
+from gp.gibbs_gp import MultiGibbsKernel, inducing_grid, lengthscale_field_dataset
+from gp.multivariate_gibbs_kernel import precision_policy
 
 ##############################
 
 
 iteration = "_01"
+num_inducing = None  # None uses every unique location, fewer points trade accuracy for speed
+inducing_method = 'kmeans'  # 'kmeans', 'grid' or 'greedy'
+precision = 'float64'  # 'float32' (with larger jitters) or 'float64'
 
 
 ##############
@@ -55,16 +59,18 @@ xtest_log = xtest *20
 ### Model
 
 # Training data
-Xtrain, Ytrain_tr = torch.Tensor(xtrain_log).float(), torch.Tensor(ytrain_tr.reshape(-1)).float()
+dtype = precision_policy(precision)['dtype']
+Xtrain = torch.as_tensor(np.asarray(xtrain_log), dtype=dtype)
+Ytrain_tr = torch.as_tensor(np.asarray(ytrain_tr).reshape(-1), dtype=dtype)
 
 # Create inducing points for coordinate lengthscales
-new_array = [tuple(row) for row in xtrain_log[:,1:3]]
-z =  torch.Tensor(np.unique(new_array,axis=0))
+z = inducing_grid(xtrain_log, num_inducing=num_inducing, method=inducing_method, precision=precision)
 
 # Model initialisation
 likelihood = gpytorch.likelihoods.GaussianLikelihood() #noise=1e-3 * torch.ones(Xtrain.shape[0]))
 likelihood.noise_covar.raw_noise.requires_grad = False
-model = MultiGibbsKernel(Xtrain, Ytrain_tr, z, likelihood).double()
+model = MultiGibbsKernel(Xtrain, Ytrain_tr, z, likelihood, precision=precision)
+Xtrain, Ytrain_tr = model.train_inputs[0], model.train_targets
 
 def MLL(y:np.ndarray, y_pred:np.ndarray, y_var:np.ndarray)-> float:
     """ Returns the mean log-loss score """
@@ -84,7 +90,7 @@ mll = gpytorch.mlls.ExactMarginalLogLikelihood(likelihood, model)
 losses = []
 
 for i in tqdm.tqdm_notebook(range(n_iter)):
-    with gpytorch.settings.max_cg_iterations(6000):
+    with gpytorch.settings.max_cg_iterations(6000), model.settings():
         optimizer.zero_grad()
         output = model(Xtrain)
         loss = -mll(output, Ytrain_tr)
@@ -98,7 +104,7 @@ for i in tqdm.tqdm_notebook(range(n_iter)):
             means = preds.loc.detach().numpy()
             r2 = r2_score(means, ytrain_tr[:2000])
             rmse = root_mean_squared_error(means, ytrain_tr[:2000])
-            yvar = np.absolute(preds.covariance_matrix.diag().detach().numpy())
+            yvar = np.absolute(preds.variance.detach().numpy())
             mlloss = MLL(yval_tr, means, yvar)
             print(f'Iter {i + 1}/{n_iter} - Loss: {loss.item():.3f}, R2: {r2:.3f}, RMSE: {rmse:.3f}, MLL:{mlloss:.3f}, Noise: {model.likelihood.noise.item():.3f}, Var:{np.mean(yvar):.3f}')
         model.train()
@@ -108,18 +114,21 @@ for i in tqdm.tqdm_notebook(range(n_iter)):
 
 
 ### Lengthscales
-H = model.base_covar_module.base_kernel.H
-lengthscales = []
-
-for l in range(394):
-    l_loc = []
-    for i in range(4):
-        l_loc.append(H[i, l].detach().numpy())
-    Xi = np.array(l_loc).reshape(2,2)
-    lengthscales.append(np.sqrt(np.diagonal(Xi*Xi.T)))
-lengthscales = np.array(lengthscales)
+# Coordinates in the model are standardised and multiplied by 20: (coords - mean) / std * 20
+offset = xscaler.mean_[1:3]
+scale = 20 / xscaler.scale_[1:3]
+gibbs_kernel = model.base_covar_module.base_kernel
+
+lengthscales = gibbs_kernel.lengthscale_field(z, scale=scale)['lengthscales'].numpy()
 np.save(f'lengthscales{iteration}.npy', lengthscales)
 
+# 0.25 degree grid over the training locations, in degrees
+lonlat_train = xscaler.inverse_transform(xtrain)[:, 1:3]
+lon = np.arange(lonlat_train[:, 0].min(), lonlat_train[:, 0].max() + 0.125, 0.25)
+lat = np.arange(lonlat_train[:, 1].min(), lonlat_train[:, 1].max() + 0.125, 0.25)
+lengthscale_ds = lengthscale_field_dataset(gibbs_kernel, lon, lat, offset=offset, scale=scale,
+                                           filepath=f'lengthscales{iteration}.nc')
+
 
 ### Predict
 
@@ -130,7 +139,7 @@ ytest = np.nan_to_num(inv_boxcox(yscaler.inverse_transform(ytest_tr[:].reshape(-
 model.eval()
 likelihood.eval()
 
-pred_yval = likelihood(model(torch.Tensor(xval_log).float()))
+pred_yval = likelihood(model(model.tensor(xval_log)))
 y_mean0_val = pred_yval.loc.detach()
 y_var0_val = np.absolute(pred_yval.covariance_matrix.diag().detach())
 y_mean_val = np.nan_to_num(inv_boxcox(yscaler.inverse_transform(y_mean0_val.reshape(-1,1)), lmbda), nan=0)
@@ -140,7 +149,7 @@ y_mean0_train = pred_ytrain.loc.detach()
 y_var0_train = np.absolute(pred_ytrain.covariance_matrix.diag().detach())
 y_mean_train = np.nan_to_num(inv_boxcox(yscaler.inverse_transform(y_mean0_train.reshape(-1,1)), lmbda), nan=0)
 
-pred_ytest = likelihood(model(torch.Tensor(xtest_log).float()))
+pred_ytest = likelihood(model(model.tensor(xtest_log)))
 y_var0_test = np.absolute(pred_ytest.covariance_matrix.diag().detach())
 y_mean0_test = pred_ytest.loc.detach()
 y_mean_test = np.nan_to_num(inv_boxcox(yscaler.inverse_transform(y_mean0_test.reshape(-1,1)), lmbda), nan=0)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Non-stationary model, multi-start training with successive halving
+
+import sys
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction/')
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code')
+
+import numpy as np
+
+import gp.data_prep as dp
+from gp.gibbs_training import multi_start_train, predictive_metrics
+
+
+iteration = "_01"
+
+if __name__ == '__main__':
+
+    ### Load data
+    dataset = dp.areal_model_new('uib', var="uib")
+    xtrain, xval, xtest, ytrain_tr, yval_tr, ytest_tr = dataset.sets()
+
+    ### Train K starts, keep the best
+    model, likelihood, history = multi_start_train(
+        xtrain * 20, ytrain_tr.reshape(-1), n_starts=8, n_iter=600, checkpoints=(25, 50, 100),
+        lr=[0.001, 0.003, 0.01], model_kwargs={'num_inducing': None, 'precision': 'float64'})
+    history.to_csv(f'experiments/wbm/multistart_history{iteration}.csv')
+
+    print(predictive_metrics(model, likelihood, model.tensor(xval * 20), yval_tr.reshape(-1)))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Non-stationary model, sparse variational training on minibatches
+
+import sys
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction/')
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code')
+
+import numpy as np
+import gpytorch
+import torch
+
+import gp.data_prep as dp
+from gp.gibbs_gp import VariationalMultiGibbsKernel, inducing_grid, variational_inducing_inputs
+from gp.gibbs_training import monitor_batch, train_variational
+from gp.multivariate_gibbs_kernel import precision_policy
+
+
+iteration = "_01"
+precision = 'float64'
+
+### Load data
+dataset = dp.areal_model_new('uib', var="uib")
+xtrain, xval, xtest, ytrain_tr, yval_tr, ytest_tr = dataset.sets()
+
+dtype = precision_policy(precision)['dtype']
+Xtrain = torch.as_tensor(xtrain * 20, dtype=dtype)
+Ytrain_tr = torch.as_tensor(ytrain_tr.reshape(-1), dtype=dtype)
+xmon, ymon = monitor_batch(xval * 20, yval_tr.reshape(-1), size=500)
+
+### Model
+z = inducing_grid(xtrain * 20, num_inducing=100, precision=precision)
+inducing_x = variational_inducing_inputs(Xtrain, num_inducing=500)
+
+model = VariationalMultiGibbsKernel(inducing_x, z, precision=precision)
+likelihood = gpytorch.likelihoods.GaussianLikelihood().to(model.dtype)
+
+with model.settings():
+    history = train_variational(model, likelihood, model.tensor(Xtrain), model.tensor(Ytrain_tr),
+                                model.tensor(xmon), ymon, batch_size=256, n_iter=5000, lr=0.01, patience=10)
+history.to_csv(f'experiments/wbm/nonstat_variational_history{iteration}.csv')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Precision benchmark for the non-stationary model
+# Time per iteration, peak memory and UIB validation accuracy with float32 and float64
+
+import sys
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction/')
+sys.path.append('/Users/kenzatazi/Documents/CDT/Code')
+
+import time
+import resource
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+n_iter = 100
+
+
+def run(precision, queue):
+    """ Trains the model with a given precision, in its own process so that peak RSS is not shared """
+    import gpytorch
+    import torch
+    import utils.metrics as me
+    import gp.data_prep as dp
+    from gp.gibbs_gp import MultiGibbsKernel, inducing_grid
+    from scipy.special import inv_boxcox
+
+    torch.manual_seed(42)
+    dataset = dp.areal_model_new('uib', var="uib")
+    xtrain, xval, xtest, ytrain_tr, yval_tr, ytest_tr = dataset.sets()
+
+    z = inducing_grid(xtrain * 20, precision=precision)
+    likelihood = gpytorch.likelihoods.GaussianLikelihood()
+    likelihood.noise_covar.raw_noise.requires_grad = False
+    model = MultiGibbsKernel(xtrain * 20, ytrain_tr.reshape(-1), z, likelihood, precision=precision)
+
+    model.train()
+    likelihood.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    mll = gpytorch.mlls.ExactMarginalLogLikelihood(likelihood, model)
+
+    with model.settings():
+        t0 = time.perf_counter()
+        for i in range(n_iter):
+            optimizer.zero_grad()
+            loss = -mll(model(model.train_inputs[0]), model.train_targets)
+            loss.backward()
+            optimizer.step()
+        time_per_iter = (time.perf_counter() - t0) / n_iter
+
+        model.eval()
+        likelihood.eval()
+        with torch.no_grad():
+            preds = likelihood(model(model.tensor(xval * 20)))
+            y_mean0 = preds.mean.double().numpy()
+            y_var0 = preds.variance.double().numpy()
+
+    yscaler, lmbda = dataset.yscaler, dataset.l
+    yval = np.nan_to_num(inv_boxcox(yscaler.inverse_transform(yval_tr.reshape(-1, 1)), lmbda), nan=0)
+    y_mean = np.nan_to_num(inv_boxcox(yscaler.inverse_transform(y_mean0.reshape(-1, 1)), lmbda), nan=0)
+
+    queue.put({'precision': precision,
+               'time_per_iter': time_per_iter,
+               'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               'final_loss': loss.item(),
+               'val_R2': me.R2(yval, y_mean),
+               'val_RMSE': me.RMSE(yval, y_mean),
+               'val_MLL': me.MLL(yval_tr.reshape(-1), y_mean0, y_var0)})
+
+
+if __name__ == '__main__':
+
+    ctx = mp.get_context('spawn')
+    results = []
+    for precision in ['float64', 'float32']:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run, args=(precision, queue))
+        p.start()
+        results.append(queue.get())
+        p.join()
+
+    df = pd.DataFrame(results).set_index('precision')
+    print(df)
+    print('float32 - float64:')
+    print(df.loc['float32'] - df.loc['float64'])
+    df.to_csv('experiments/wbm/precision_benchmark.csv')
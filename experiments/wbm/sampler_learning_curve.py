@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Training set samplers
+# Validation R2 per training set size for random, stratified, Latin hypercube and max-min sampling
+
+import sys
+sys.path.append('/data/hpcdata/users/kenzi22/')
+sys.path.append('/data/hpcdata/users/kenzi22/precip-prediction')
+
+import time
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import tensorflow as tf
+from scipy.special import inv_boxcox
+
+import utils.metrics as me
+import gp.data_prep as dp
+import gp.gp_models as gpm
+
+
+samplers = ['random', 'stratified', 'lhs', 'maxmin']
+sizes = [500, 1000, 2000, 3000, 5000]
+
+tf.random.set_seed(42)
+
+results = []
+for sampler in samplers:
+    for length in sizes:
+        t0 = time.perf_counter()
+        dataset = dp.areal_model_new('uib', length=length, var='uib', sampler=sampler)
+        xtrain, xval, xtest, ytrain_tr, yval_tr, ytest_tr = dataset.sets()
+        sample_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        m = gpm.multi_gp(xtrain, xval, ytrain_tr, yval_tr, dataset.l, dataset.yscaler, kernel='areal')
+        fit_time = time.perf_counter() - t0
+
+        y_pred, _ = m.predict_y(xval)
+        yval = inv_boxcox(dataset.yscaler.inverse_transform(yval_tr), dataset.l)
+        ypred = inv_boxcox(dataset.yscaler.inverse_transform(y_pred.numpy()), dataset.l)
+
+        results.append({'sampler': sampler, 'length': length, 'val_R2': me.R2(yval, ypred),
+                        'val_RMSE': me.RMSE(yval, ypred), 'sample_time': sample_time, 'fit_time': fit_time})
+        print(results[-1])
+
+df = pd.DataFrame(results)
+df.to_csv('experiments/wbm/sampler_learning_curve.csv')
+
+plt.figure(figsize=(8, 5))
+for sampler, df_s in df.groupby('sampler'):
+    plt.plot(df_s['length'], df_s['val_R2'], marker='o', label=sampler)
+plt.xscale('log')
+plt.xlabel('Training set size')
+plt.ylabel('Validation R$^2$')
+plt.legend()
+plt.savefig('experiments/wbm/sampler_learning_curve.png', bbox_inches='tight')
@@ -1,90 +1,156 @@
 # GP ensemble
 
-import pandas as pd
+"""
+Areal GP models trained on each member of the ERA5 ensemble. Nothing runs on import:
+
+    ds_ensemble = load_ensemble('uib')
+    datasets = member_datasets(ds_ensemble, length=10000)  # with one shared target transformation
+    results = train_members(datasets)
+    summary = aggregate(results, datasets)
+"""
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import scipy as sp
+from sklearn.preprocessing import StandardScaler
 
 import gp.gp_models as gpm
 import gp.data_prep as dp
+import utils.metrics as me
+from load import era5
+
+
+def load_ensemble(location='uib'):
+    """ Returns the ERA5 ensemble Dataset, with a 'number' dimension for the members """
+    return era5.download_data(location, xarray=True, ensemble=True)
+
+
+def member_datasets(ds_ensemble, location='uib', members=None, shared_transform=True, **dataset_kwargs) -> list:
+    """
+    Returns one data_prep.areal_model_new dataset per ensemble member, each built from a slice
+    of the already loaded ensemble rather than downloading it again.
+
+    Args:
+        ds_ensemble (xr.Dataset): ensemble Dataset, see load_ensemble.
+        location (str, optional): area, used for the mask. Defaults to 'uib'.
+        members (list, optional): member numbers. Defaults to all members.
+        shared_transform (bool, optional): refit the target transformation on all the members,
+            see share_target_transform. Defaults to True.
+        **dataset_kwargs: passed to data_prep.areal_model_new (e.g. length, var).
+    """
+    if members is None:
+        members = range(ds_ensemble.sizes['number'])
+    datasets = [dp.areal_model_new(location, ds=ds_ensemble.isel(number=i, drop=True), **dataset_kwargs)
+                for i in members]
+    return share_target_transform(datasets) if shared_transform is True else datasets
+
+
+def share_target_transform(datasets: list) -> list:
+    """
+    Refits the Box-Cox lambda and target scaler of the member datasets on their pooled training
+    targets, in place, so that the targets and predictions of all members are in the same
+    transformed space and can be averaged.
+    """
+    ytrain = np.concatenate([d.ytrain for d in datasets]).astype(np.float64)
+    ytrain_tr, lmbda = sp.stats.boxcox(ytrain)
+    yscaler = StandardScaler().fit(ytrain_tr.reshape(-1, 1))
 
+    for d in datasets:
+        for split in ['train', 'val', 'test']:
+            y_tr = sp.stats.boxcox(getattr(d, 'y' + split).astype(np.float64), lmbda=lmbda)
+            setattr(d, 'y' + split + '_tr', y_tr)
+            setattr(d, 'y' + split + '_sc', yscaler.transform(y_tr.reshape(-1, 1)))
+        d.l, d.yscaler = lmbda, yscaler
+    return datasets
 
-# Empty lists
-model_list = []
 
-ytrain_list = []
-ytrain_pred_list = []
-ytrain_std_pred_list = []
+def _check_shared_transform(datasets: list):
+    """ Raises a ValueError if the member datasets do not share one target transformation """
+    if any(d.yscaler is not datasets[0].yscaler or d.l != datasets[0].l for d in datasets):
+        raise ValueError('Member datasets must share one target transformation, see share_target_transform')
 
-yval_list = []
-yval_pred_list = []
-yval_std_pred_list = []
 
+def _train_member(task: dict) -> dict:
+    """ Worker: trains one member model and returns its predictions and hyperparameters """
+    import gpflow
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(task['n_threads'])
 
-# Runs
+    m = gpm.multi_gp(task['xtrain'], task['xval'], task['ytrain'], task['yval'], task['lmbda'], task['yscaler'],
+                     kernel='areal')
+    ytrain_pred, ytrain_var = m.predict_y(task['xtrain'])
+    yval_pred, yval_var = m.predict_y(task['xval'])
 
-for i in range(10):
+    return {'member': task['member'],
+            'ytrain_pred': ytrain_pred.numpy().reshape(-1),
+            'ytrain_var': ytrain_var.numpy().reshape(-1),
+            'yval_pred': yval_pred.numpy().reshape(-1),
+            'yval_var': yval_var.numpy().reshape(-1),
+            'params': {k: np.array(v) for k, v in gpflow.utilities.read_values(m).items()}}
 
-    xtrain, xval, xtest, ytrain, yval, ytest = dp.areal_model(
-        'uib', number=i, length=10000)
 
-    ytrain_list.append(ytrain)
-    yval_list.append(yval)
+def train_members(datasets: list, n_workers=None) -> list:
+    """
+    Trains the member models in parallel processes, with the CPU threads split between them.
+
+    Returns:
+        list: per member dict of training and validation predictive means and variances and
+            fitted parameter values, in the order of datasets.
     """
-    model = gpm.multi_gp(xtrain, xval, ytrain, yval)
-    model_list.append(model)
+    n_workers = n_workers or min(len(datasets), mp.cpu_count())
+    n_threads = max(1, mp.cpu_count() // n_workers)
 
-    ytrain_pred, ytrain_std_pred = model.predict_y(xtrain)
-    ytrain_pred_list.append(ytrain_pred)
-    ytrain_std_pred_list.append(ytrain_std_pred)
+    tasks = []
+    for i, d in enumerate(datasets):
+        xtrain, xval, _, ytrain, yval, _ = d.sets()
+        tasks.append({'member': i, 'xtrain': xtrain, 'xval': xval, 'ytrain': ytrain, 'yval': yval,
+                      'lmbda': d.l, 'yscaler': d.yscaler, 'n_threads': n_threads})
 
-    yval_pred, yval_std_pred = model.predict_y(xval)
-    yval_pred_list.append(yval_pred)
-    yval_std_pred_list.append(yval_std_pred)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('spawn')) as executor:
+        return list(executor.map(_train_member, tasks))
+
+
+def aggregate(results: list, datasets: list) -> dict:
     """
+    Ensemble predictions as a mixture of the member predictive distributions: the mean of the
+    member means, and the mean of the member variances plus the variance of the member means.
+    Metrics compare these to the ensemble mean of the (standardised) targets. The members must
+    share one target transformation (see share_target_transform).
 
-# Ensemble
+    Returns:
+        dict: ensemble targets, means, variances, and training and validation R2 and RMSE.
+    """
+    _check_shared_transform(datasets)
+    summary = {}
+    for split in ['train', 'val']:
+        y = np.stack([getattr(d, 'y' + split + '_sc').reshape(-1) for d in datasets])
+        pred = np.stack([r['y' + split + '_pred'] for r in results])
+        var = np.stack([r['y' + split + '_var'] for r in results])
 
-yval_array = np.array(yval_list)
-yval_df = pd.DataFrame(yval_array.reshape(10, -1))
-yval_df = yval_df.T
-yval_df["mean"] = yval_df.mean(axis=1)
+        y_mean = y.mean(axis=0)
+        pred_mean = pred.mean(axis=0)
+        pred_var = var.mean(axis=0) + pred.var(axis=0)
 
-ytrain_array = np.array(ytrain_list)
-ytrain_df = pd.DataFrame(ytrain_array.reshape(10, -1))
-ytrain_df = ytrain_df.T
-ytrain_df["mean"] = ytrain_df.mean(axis=1)
-"""
-yval_pred_array = np.array(yval_pred_list)
-yval_pred_df = pd.DataFrame(yval_pred_array.reshape(10, -1))
-yval_pred_df = yval_pred_df.T
-yval_pred_df['mean'] = yval_pred_df.mean(axis=1)
-
-yval_std_pred_array = np.array(yval_std_pred_list)
-yval_std_pred_df = pd.DataFrame(yval_std_pred_array.reshape(10, -1))
-yval_std_pred_df = yval_std_pred_df.T
-yval_std_pred_df['mean'] = yval_std_pred_df.mean(axis=1)
-
-ytrain_pred_array = np.array(ytrain_pred_list)
-ytrain_pred_df = pd.DataFrame(ytrain_pred_array.reshape(10, -1))
-ytrain_pred_df = ytrain_pred_df.T
-ytrain_pred_df['mean'] = ytrain_pred_df.mean(axis=1)
-
-ytrain_std_pred_array = np.array(ytrain_std_pred_list)
-ytrain_std_pred_df = pd.DataFrame(ytrain_std_pred_array.reshape(10, -1))
-ytrain_std_pred_df = ytrain_std_pred_df.T
-ytrain_std_pred_df['mean'] = ytrain_std_pred_df.mean(axis=1)
-
-RMSE_train = mean_squared_error(ytrain_df['mean'], ytrain_pred_df['mean'])
-R2_train = r2_score(ytrain_df['mean'], ytrain_pred_df['mean'])
-
-RMSE_val = mean_squared_error(yval_df['mean'], yval_pred_df['mean'])
-R2_val = r2_score(yval_df['mean'], yval_pred_df['mean'])
-
-y_mean = np.concatenate((ytrain_pred_df['mean'], yval_pred_df['mean'])).mean()
-std_mean = np.concatenate((ytrain_std_pred_df['mean'],
-        yval_std_pred_df['mean'])).mean()
-"""
-# me.ensemble_model_plot(model_list)
+        summary.update({'y' + split: y_mean,
+                        'y' + split + '_pred': pred_mean,
+                        'y' + split + '_var': pred_var,
+                        'R2_' + split: me.R2(y_mean, pred_mean),
+                        'RMSE_' + split: me.RMSE(y_mean, pred_mean)})
+
+    summary['y_mean'] = np.concatenate([summary['ytrain_pred'], summary['yval_pred']]).mean()
+    summary['std_mean'] = np.sqrt(np.concatenate([summary['ytrain_var'], summary['yval_var']])).mean()
+    return summary
 
-# Averaged EDA Data
-m_a = gpm.multi_gp(
-    xtrain, xval, ytrain_df["mean"].values, yval_df["mean"].values)
+
+def mean_target_model(datasets: list):
+    """
+    Returns a single GP trained on the ensemble mean of the member targets (averaged EDA data),
+    which must share one target transformation (see share_target_transform)
+    """
+    _check_shared_transform(datasets)
+    xtrain, xval, _, _, _, _ = datasets[0].sets()
+    ytrain = np.mean([d.ytrain_sc for d in datasets], axis=0)
+    yval = np.mean([d.yval_sc for d in datasets], axis=0)
+    return gpm.multi_gp(xtrain, xval, ytrain, yval, datasets[0].l, datasets[0].yscaler, kernel='areal')
@@ -0,0 +1,151 @@
+# Active learning
+
+"""
+Active selection of training points for the areal GPs. Starting from a small random
+seed set, the pool points with the largest predictive variance are added in batches.
+The exact GP posterior is updated by extending its Cholesky factor with each batch,
+so a round costs O(n^2 k) rather than the O(n^3) of a refit, and the hyperparameters
+are only re-optimised every few rounds.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+import scipy.linalg
+import gpflow
+
+from utils.streaming import evaluate_in_chunks
+from gp.feature_selection import build_kernel
+
+
+class IncrementalGPR():
+    """ Exact GP regression posterior with fixed hyperparameters and an extendable Cholesky factor """
+
+    def __init__(self, kernel: gpflow.kernels.Kernel, noise_variance: float, x, y):
+        self.kernel = kernel
+        self.noise_variance = noise_variance
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64).reshape(-1)
+        K = self.kernel(self.x).numpy()
+        K[np.diag_indices_from(K)] += noise_variance
+        self.L = scipy.linalg.cholesky(K, lower=True)
+
+    def add(self, x_new, y_new):
+        """
+        Appends points by a block Cholesky update:
+        L_new = [[L, 0], [L12^T, chol(K22 - L12^T L12)]] with L12 = L^-1 K12.
+        """
+        x_new = np.asarray(x_new, dtype=np.float64)
+        K12 = self.kernel(self.x, x_new).numpy()
+        K22 = self.kernel(x_new).numpy()
+        K22[np.diag_indices_from(K22)] += self.noise_variance
+
+        L12 = scipy.linalg.solve_triangular(self.L, K12, lower=True)
+        L22 = scipy.linalg.cholesky(K22 - L12.T @ L12, lower=True)
+
+        n, k = len(self.x), len(x_new)
+        L = np.zeros((n + k, n + k))
+        L[:n, :n] = self.L
+        L[n:, :n] = L12.T
+        L[n:, n:] = L22
+
+        self.L = L
+        self.x = np.concatenate([self.x, x_new])
+        self.y = np.concatenate([self.y, np.asarray(y_new, dtype=np.float64).reshape(-1)])
+
+    def predict_f(self, x, chunk_size=5000, full_output=True) -> tuple:
+        """
+        Returns the latent predictive mean and variance at x, computed in chunks of chunk_size. If
+        full_output is False only the variance is computed and the mean is None.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        alpha = scipy.linalg.cho_solve((self.L, True), self.y) if full_output else None
+        mean = np.empty(len(x)) if full_output else None
+        var = np.empty(len(x))
+
+        for start in range(0, len(x), chunk_size):
+            xc = x[start:start + chunk_size]
+            Ks = self.kernel(self.x, xc).numpy()
+            v = scipy.linalg.solve_triangular(self.L, Ks, lower=True)
+            var[start:start + chunk_size] = self.kernel(xc, full_cov=False).numpy() - np.sum(v**2, axis=0)
+            if full_output:
+                mean[start:start + chunk_size] = Ks.T @ alpha
+
+        return mean, np.maximum(var, 0)
+
+
+def fit_hyperparameters(kernel, x, y, noise_variance=1.0, maxiter=200) -> float:
+    """ Optimises the kernel (in place) and noise on (x, y), returns the noise variance """
+    m = gpflow.models.GPR(data=(x, y.reshape(-1, 1)), kernel=kernel, noise_variance=noise_variance)
+    opt = gpflow.optimizers.Scipy()
+    opt.minimize(m.training_loss, m.trainable_variables, options={'maxiter': maxiter})
+    return float(m.likelihood.variance.numpy())
+
+
+def active_learning(xpool, ypool, xval, yval, kernel=None, n_seed=200, batch_size=50, budget=3000,
+                    target_r2=None, refit_every=5, maxiter=200, chunk_size=5000, seed=42,
+                    verbose=True) -> tuple:
+    """
+    Selects training points from a pool by maximum predictive variance.
+
+    Args:
+        xpool, ypool (np.ndarray): candidate pool, e.g. the whole training period of areal_model_new.
+        xval, yval (np.ndarray): validation set used for the stopping criterion.
+        kernel (gpflow.kernels.Kernel, optional): kernel, trained in place. Defaults to the areal
+            kernel over all inputs (build_kernel with the coordinates).
+        n_seed (int, optional): size of the random seed set. Defaults to 200.
+        batch_size (int, optional): points added per round. Defaults to 50.
+        budget (int, optional): maximum number of training points. Defaults to 3000.
+        target_r2 (float, optional): stop once the validation R2 reaches it. Defaults to None.
+        refit_every (int, optional): rounds between hyperparameter refits, which also rebuild the
+            factor. Defaults to 5.
+        maxiter (int, optional): L-BFGS iterations per refit. Defaults to 200.
+        chunk_size (int, optional): pool points per predictive variance chunk. Defaults to 5000.
+        seed (int, optional): random seed. Defaults to 42.
+        verbose (bool, optional): print progress. Defaults to True.
+
+    Returns:
+        tuple: IncrementalGPR model, indices of the selected pool points and history DataFrame.
+    """
+    rng = np.random.default_rng(seed)
+    ypool, yval = np.asarray(ypool).reshape(-1), np.asarray(yval).reshape(-1)
+    if kernel is None:
+        kernel = build_kernel(range(3, xpool.shape[1]), spatial=True)
+
+    selected = rng.choice(len(xpool), size=min(n_seed, len(xpool)), replace=False)
+    available = np.ones(len(xpool), dtype=bool)
+    available[selected] = False
+
+    noise_variance = fit_hyperparameters(kernel, xpool[selected], ypool[selected], maxiter=maxiter)
+    model = IncrementalGPR(kernel, noise_variance, xpool[selected], ypool[selected])
+
+    history = []
+    round_ = 0
+    while True:
+        r2 = evaluate_in_chunks(lambda x: model.predict_f(x)[0], xval, yval, chunk_size=chunk_size)['R2']
+        history.append({'round': round_, 'n_train': len(selected), 'val_R2': r2, 'time': time.perf_counter()})
+        if verbose:
+            print(f"Round {round_}: {len(selected)} points, R2: {r2:.3f}")
+
+        if len(selected) >= budget or not available.any() or (target_r2 is not None and r2 >= target_r2):
+            break
+
+        # Largest predictive variances among the remaining pool points
+        candidates = np.flatnonzero(available)
+        _, var = model.predict_f(xpool[candidates], chunk_size=chunk_size, full_output=False)
+        k = min(batch_size, budget - len(selected), len(candidates))
+        new = candidates[np.argpartition(-var, k - 1)[:k]]
+        available[new] = False
+        selected = np.concatenate([selected, new])
+        round_ += 1
+
+        if refit_every and round_ % refit_every == 0:
+            noise_variance = fit_hyperparameters(kernel, xpool[selected], ypool[selected],
+                                                 noise_variance=noise_variance, maxiter=maxiter)
+            model = IncrementalGPR(kernel, noise_variance, xpool[selected], ypool[selected])
+        else:
+            model.add(xpool[new], ypool[new])
+
+    df_history = pd.DataFrame(history)
+    df_history['time'] -= df_history['time'].iloc[0]
+    return model, selected, df_history
@@ -374,7 +374,7 @@ class areal_model_new():
     """ Class for generating data for areal models"""
 
     def __init__(self, location, number=None, EDA_average=False, length=3000, seed=42,
-                maxyear=None, minyear='1970', var=False):
+                maxyear=None, minyear='1970', var=False, sampler='random', ds=None):
         """
         Inputs
             location: specify area to train model
@@ -383,6 +383,9 @@ class areal_model_new():
                 ensemble runs, boolean
             length, optional: specify number of points to sample for training, integer
             seed, optional: specify seed, integer
+            sampler, optional: training sampler in gp.sampling.SAMPLERS, string
+            ds, optional: already loaded ERA5 Dataset (e.g. one ensemble member) used instead of
+                downloading the data, xarray Dataset
 
         Outputs
             x_train: training feature vector, numpy array
@@ -393,13 +396,14 @@ class areal_model_new():
         if maxyear is None:
             maxyear = '2020'
 
-        if number is not None:
-            da_ensemble = era5.download_data(location, xarray=True, ensemble=True)
-            da = da_ensemble.sel(number=number).drop("number")
-
-        if EDA_average is True:
-            da_ensemble = era5.download_data(location, xarray=True, ensemble=True)
-            da = da_ensemble.mean(dim="number")
+        if ds is not None:
+            pass
+        elif number is not None:
+            ds_ensemble = era5.download_data(location, xarray=True, ensemble=True)
+            ds = ds_ensemble.sel(number=number).drop("number")
+        elif EDA_average is True:
+            ds_ensemble = era5.download_data(location, xarray=True, ensemble=True)
+            ds = ds_ensemble.mean(dim="number")
         else:
             ds = era5.collect_ERA5(location, minyear="1970", maxyear=maxyear, all_var=True)
 
@@ -433,7 +437,7 @@ class areal_model_new():
         df_train['tp'].loc[df_train['tp'] <= 0.0] = 0.0001
 
         # Sample training
-        df_train_samp = sa.random_location_and_time_sampler(df_train, by_loc=False, length=length, seed=123)  
+        df_train_samp = sa.training_sampler(df_train, length=length, method=sampler, seed=123)
         xtrain = df_train_samp.drop(columns=["tp"]).values
         ytrain = df_train_samp['tp'].values
 
@@ -0,0 +1,384 @@
+# Feature selection
+
+"""
+Greedy forward selection of GP input features. The incumbent (best model so
+far) is fitted once and cached, and at each step every remaining candidate
+feature is added to it and fitted, in parallel if a pool of workers is given.
+Candidates can first be screened with a cheap proxy so that only the top few
+are fitted in full.
+"""
+
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+import numpy as np
+import scipy.linalg
+import gpflow
+
+import utils.metrics as me
+
+
+def build_kernel(dims, spatial=False) -> gpflow.kernels.Kernel:
+    """
+    Locally periodic kernel over time (column 0), an optional Matern 3/2 over the
+    coordinates (columns 1 and 2) and one Matern 3/2 kernel per feature in dims.
+    """
+    ka = gpflow.kernels.Periodic(gpflow.kernels.Matern32(lengthscales=1e-2, variance=1, active_dims=[0]), period=1./35.)
+    kb = gpflow.kernels.Matern32(lengthscales=1e-2, variance=1, active_dims=[0])
+    kernel = ka * kb
+
+    if spatial is True:
+        kernel += gpflow.kernels.Matern32(lengthscales=[1e-2, 1e-2], active_dims=[1, 2])
+
+    for d in dims:
+        kernel += gpflow.kernels.Matern32(lengthscales=1e-2, active_dims=[int(d)])
+
+    return kernel
+
+
+def fit_kernel(xtrain, xval, ytrain_tr, yval_tr, dims, spatial=False, maxiter=200) -> dict:
+    """
+    Train a GPR model with the kernel for dims and score it on the validation set.
+
+    Returns:
+        dict: dims, validation R2 ('score'), the other scores of utils.metrics.score_model
+            (computed from the same factorisation) and fitted parameter values ('params').
+    """
+    kernel = build_kernel(dims, spatial=spatial)
+    m = gpflow.models.GPR(data=(xtrain, ytrain_tr.reshape(-1, 1)), kernel=kernel)
+    opt = gpflow.optimizers.Scipy()
+    opt.minimize(m.training_loss, m.trainable_variables, options={'maxiter': maxiter})
+
+    scores = me.score_model(m, xval, yval_tr)
+    params = {k: np.array(v) for k, v in gpflow.utilities.read_values(m).items()}
+
+    return {'dims': tuple(dims), 'score': scores['R2'], **scores, 'params': params}
+
+
+class ForwardSelection():
+    """
+    State of a greedy forward selection for one dataset.
+
+    Fits are keyed by their (order independent) set of dims and cached, so the incumbent
+    is never refitted and no kernel is fitted twice. Each step needs one fit per remaining
+    candidate (see pending), which can be run in any order or in parallel before advance.
+    """
+
+    def __init__(self, candidates, base_dims=(), n_steps=None, stop_on_no_improvement=False):
+        """
+        Args:
+            candidates (list): candidate feature columns.
+            base_dims (tuple, optional): features always included. Defaults to ().
+            n_steps (int, optional): maximum number of features to add. Defaults to all candidates.
+            stop_on_no_improvement (bool, optional): stop when the best candidate does not improve
+                on the incumbent. Defaults to False, i.e. rank every candidate.
+        """
+        self.remaining = [int(c) for c in candidates]
+        self.selected = [int(d) for d in base_dims]
+        self.n_steps = len(self.remaining) if n_steps is None else n_steps
+        self.stop_on_no_improvement = stop_on_no_improvement
+
+        self.cache = {}
+        self.incumbent = None
+        self.best = None
+        self.history = []
+        self.n_fits = 0
+        self.done = False
+
+        self.shortlist = None
+        self.proxy_scores = None
+        self.screen_time = 0.
+
+    @staticmethod
+    def key(dims):
+        return frozenset(dims)
+
+    def pending(self) -> list:
+        """ Returns the dims that still need to be fitted for the current step """
+        if self.done:
+            return []
+        if self.incumbent is None:
+            dims_list = [tuple(self.selected)]
+        else:
+            dims_list = [tuple(self.selected + [c]) for c in self.step_candidates()]
+        return [dims for dims in dims_list if self.key(dims) not in self.cache]
+
+    def step_candidates(self) -> list:
+        """ Returns the candidates fitted at the current step, the shortlist if screened """
+        return self.remaining if self.shortlist is None else self.shortlist
+
+    def screen(self, scores: dict, top_k: int, screen_time=0.):
+        """ Restricts the current step to the top_k candidates by proxy score (higher is better) """
+        ranked = sorted(self.remaining, key=lambda c: np.nan_to_num(scores[c], nan=-np.inf), reverse=True)
+        self.shortlist = ranked[:top_k]
+        self.proxy_scores = scores
+        self.screen_time = screen_time
+
+    def record(self, result: dict):
+        """ Stores the result of fit_kernel """
+        self.cache[self.key(result['dims'])] = result
+        self.n_fits += 1
+
+    def advance(self):
+        """ Completes the current step once all pending fits have been recorded """
+        if self.pending():
+            raise RuntimeError('Not all candidates of the current step have been fitted')
+
+        if self.incumbent is None:
+            self.incumbent = self.best = self.cache[self.key(self.selected)]
+            self.history.append({'step': 0, 'added': None, 'score': self.incumbent['score'],
+                                 'incumbent_score': self.incumbent['score'], 'candidates': {}})
+        else:
+            scores = {c: self.cache[self.key(self.selected + [c])]['score'] for c in self.step_candidates()}
+            added = max(scores, key=lambda c: np.nan_to_num(scores[c], nan=-np.inf))
+            result = self.cache[self.key(self.selected + [added])]
+
+            self.history.append({'step': len(self.history), 'added': added, 'score': scores[added],
+                                 'incumbent_score': self.incumbent['score'], 'candidates': scores,
+                                 'proxy': self.proxy_scores, 'screen_time': self.screen_time})
+            self.shortlist, self.proxy_scores, self.screen_time = None, None, 0.
+
+            if self.stop_on_no_improvement and not scores[added] > self.incumbent['score']:
+                self.done = True
+                return
+
+            self.selected.append(added)
+            self.remaining.remove(added)
+            self.incumbent = result
+            if result['score'] > self.best['score']:
+                self.best = result
+
+        if not self.remaining or len(self.history) > self.n_steps:
+            self.done = True
+
+    def score_array(self) -> np.ndarray:
+        """ Returns steps x 2 array of [score of the new kernel, score of the previous incumbent] """
+        return np.array([[h['score'], h['incumbent_score']] for h in self.history])
+
+
+def fitted_model(xtrain, ytrain_tr, result: dict, spatial=False) -> gpflow.models.GPR:
+    """ Rebuilds the trained GPR model of a fit_kernel result from its parameter values """
+    m = gpflow.models.GPR(data=(xtrain, ytrain_tr.reshape(-1, 1)), kernel=build_kernel(result['dims'], spatial=spatial))
+    gpflow.utilities.multiple_assign(m, result['params'])
+    return m
+
+
+def mll_increment_scores(xtrain, ytrain_tr, incumbent: dict, candidates, spatial=False) -> dict:
+    """
+    Increase in log marginal likelihood from adding a linear kernel v * x_c x_c^T on each candidate
+    to the fitted incumbent, with the incumbent hyperparameters fixed and v profiled out.
+
+    The increment is rank one, so with the incumbent covariance K factorised once the change in
+    log determinant and data fit follow from a = x^T K^-1 x and b = x^T K^-1 y (matrix determinant
+    lemma and Sherman-Morrison). Maximising over v >= 0 gives 0.5 (r - 1 - log r) with r = b^2 / a
+    if r > 1 and zero otherwise. One Cholesky factorisation serves all candidates.
+    """
+    m = fitted_model(xtrain, ytrain_tr, incumbent, spatial=spatial)
+    K = m.kernel(xtrain).numpy()
+    K[np.diag_indices_from(K)] += m.likelihood.variance.numpy()
+    factor = scipy.linalg.cho_factor(K, lower=True)
+
+    x = xtrain[:, list(candidates)]
+    x = x - x.mean(axis=0)
+    a = np.sum(x * scipy.linalg.cho_solve(factor, x), axis=0)
+    b = x.T @ scipy.linalg.cho_solve(factor, ytrain_tr.reshape(-1))
+
+    r = b**2 / np.maximum(a, 1e-12)
+    gain = np.where(r > 1, 0.5 * (r - 1 - np.log(np.maximum(r, 1))), 0.)
+    return dict(zip(candidates, gain))
+
+
+def rff_scores(xtrain, xval, ytrain_tr, yval_tr, selected, candidates, spatial=False, n_features=500,
+               lengthscale=0.1, alpha=1e-2, seed=42) -> dict:
+    """
+    Validation R2 of a ridge regression on random Fourier features of the selected dims plus each
+    candidate, an O(n n_features^2) stand-in for a GP fit with an RBF kernel of fixed lengthscale.
+    """
+    base = [0, 1, 2] if spatial is True else [0]
+    base += [d for d in selected if d not in base]
+
+    scores = {}
+    for c in candidates:
+        dims = base + [c]
+        rng = np.random.default_rng(seed)
+        W = rng.normal(scale=1 / lengthscale, size=(len(dims), n_features))
+        b = rng.uniform(0, 2 * np.pi, n_features)
+        phi_train = np.sqrt(2 / n_features) * np.cos(xtrain[:, dims] @ W + b)
+        phi_val = np.sqrt(2 / n_features) * np.cos(xval[:, dims] @ W + b)
+
+        A = phi_train.T @ phi_train + alpha * np.eye(n_features)
+        w = scipy.linalg.solve(A, phi_train.T @ ytrain_tr.reshape(-1), assume_a='pos')
+        scores[c] = me.R2(yval_tr.reshape(-1), phi_val @ w)
+    return scores
+
+
+def ard_scores(xtrain, ytrain_tr, selected, candidates, spatial=False, num_inducing=200, maxiter=200,
+               seed=42) -> dict:
+    """
+    Inverse ARD lengthscales of the candidates from a single SGPR fit with one Matern 3/2 kernel
+    over the selected and candidate dims (plus the time and coordinate kernels).
+    """
+    dims = list(selected) + list(candidates)
+    ard = gpflow.kernels.Matern32(lengthscales=np.ones(len(dims)), active_dims=dims)
+    kernel = build_kernel([], spatial=spatial) + ard
+
+    rng = np.random.default_rng(seed)
+    Z = xtrain[rng.choice(len(xtrain), size=min(num_inducing, len(xtrain)), replace=False)].copy()
+    m = gpflow.models.SGPR(data=(xtrain, ytrain_tr.reshape(-1, 1)), kernel=kernel, inducing_variable=Z)
+    gpflow.utilities.set_trainable(m.inducing_variable, False)
+    opt = gpflow.optimizers.Scipy()
+    opt.minimize(m.training_loss, m.trainable_variables, options={'maxiter': maxiter})
+
+    lengthscales = ard.lengthscales.numpy()
+    return {c: 1 / lengthscales[dims.index(c)] for c in candidates}
+
+
+def screen_candidates(state: ForwardSelection, xtrain, xval, ytrain_tr, yval_tr, method='mll', spatial=False) -> dict:
+    """
+    Proxy scores (higher is better) for the remaining candidates of a forward selection.
+
+    Args:
+        state (ForwardSelection): selection state with a fitted incumbent.
+        method (str, optional): 'mll' for the rank-one marginal likelihood increment on the fitted
+            incumbent, 'rff' for a random Fourier feature ridge regression or 'ard' for the ARD
+            lengthscales of one sparse GP fit. Defaults to 'mll'.
+
+    Returns:
+        dict: candidate -> proxy score.
+    """
+    if method == 'mll':
+        return mll_increment_scores(xtrain, ytrain_tr, state.incumbent, state.remaining, spatial=spatial)
+    if method == 'rff':
+        return rff_scores(xtrain, xval, ytrain_tr, yval_tr, state.selected, state.remaining, spatial=spatial)
+    if method == 'ard':
+        return ard_scores(xtrain, ytrain_tr, state.selected, state.remaining, spatial=spatial)
+    raise ValueError(f"Unknown screening method '{method}', use 'mll', 'rff' or 'ard'")
+
+
+def _init_worker():
+    """ One TensorFlow thread per worker, the parallelism comes from the pool """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _executor(n_workers):
+    """ Process pool for parallel fits, None runs them in the calling process """
+    if n_workers is None or n_workers > 1:
+        return ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('spawn'),
+                                   initializer=_init_worker)
+    return None
+
+
+def forward_selection(xtrain, xval, ytrain_tr, yval_tr, candidates, base_dims=(), spatial=False,
+                      n_steps=None, stop_on_no_improvement=False, maxiter=200, n_workers=None,
+                      executor=None, screen=None, top_k=3) -> ForwardSelection:
+    """
+    Greedy forward selection of input features, scored by validation R2.
+
+    Args:
+        xtrain, xval (np.ndarray): training and validation inputs, time in column 0.
+        ytrain_tr, yval_tr (np.ndarray): training and validation outputs.
+        candidates (list): candidate feature columns.
+        base_dims (tuple, optional): features always included. Defaults to ().
+        spatial (bool, optional): include the coordinate kernel on columns 1 and 2. Defaults to False.
+        n_steps (int, optional): maximum number of features to add. Defaults to all candidates.
+        stop_on_no_improvement (bool, optional): see ForwardSelection. Defaults to False.
+        maxiter (int, optional): L-BFGS iterations per fit. Defaults to 200.
+        n_workers (int, optional): processes for the candidate fits, 1 fits sequentially.
+            Defaults to None, i.e. one per CPU.
+        executor (concurrent.futures.Executor, optional): existing pool to use instead.
+        screen (str, optional): proxy used to shortlist candidates before the full fits, see
+            screen_candidates. Defaults to None, i.e. fit every remaining candidate.
+        top_k (int, optional): number of screened candidates fitted in full. Defaults to 3.
+
+    Returns:
+        ForwardSelection: final state with history, selected features and best fit.
+    """
+    state = ForwardSelection(candidates, base_dims=base_dims, n_steps=n_steps,
+                             stop_on_no_improvement=stop_on_no_improvement)
+    pool = executor or _executor(n_workers)
+
+    try:
+        while not state.done:
+            if screen is not None and state.incumbent is not None and len(state.remaining) > top_k:
+                t0 = time.perf_counter()
+                scores = screen_candidates(state, xtrain, xval, ytrain_tr, yval_tr, method=screen, spatial=spatial)
+                state.screen(scores, top_k, screen_time=time.perf_counter() - t0)
+            if pool is None:
+                for dims in state.pending():
+                    state.record(fit_kernel(xtrain, xval, ytrain_tr, yval_tr, dims, spatial, maxiter))
+            else:
+                futures = [pool.submit(fit_kernel, xtrain, xval, ytrain_tr, yval_tr, dims, spatial, maxiter)
+                           for dims in state.pending()]
+                for f in as_completed(futures):
+                    state.record(f.result())
+            state.advance()
+    finally:
+        if executor is None and pool is not None:
+            pool.shutdown()
+
+    return state
+
+
+def multi_forward_selection(datasets: dict, candidates, base_dims=(), spatial=False, n_steps=None,
+                            stop_on_no_improvement=False, maxiter=200, n_workers=None, callback=None) -> dict:
+    """
+    Forward selection for several datasets (e.g. one per location) on one process pool.
+
+    The (dataset, step, candidate) fits are scheduled as a task graph: the fits of a step only
+    depend on the previous step of the same dataset, so as soon as a dataset's step is complete
+    its next step is submitted while the other datasets' fits are still running. The pool is
+    kept busy until the last step of the last dataset, rather than waiting on each location.
+
+    Args:
+        datasets (dict): key -> (xtrain, xval, ytrain_tr, yval_tr).
+        candidates (list): candidate feature columns, shared by all datasets.
+        base_dims, spatial, n_steps, stop_on_no_improvement, maxiter: see forward_selection.
+        n_workers (int, optional): number of processes. Defaults to None, i.e. one per CPU.
+        callback (callable, optional): called as callback(key, state) after every completed
+            step, e.g. to save results incrementally.
+
+    Returns:
+        dict: key -> final ForwardSelection state.
+    """
+    states = {key: ForwardSelection(candidates, base_dims=base_dims, n_steps=n_steps,
+                                    stop_on_no_improvement=stop_on_no_improvement) for key in datasets}
+    in_flight = {key: 0 for key in datasets}
+    futures = {}
+
+    def submit(key):
+        xtrain, xval, ytrain_tr, yval_tr = datasets[key]
+        for dims in states[key].pending():
+            f = executor.submit(fit_kernel, xtrain, xval, ytrain_tr, yval_tr, dims, spatial, maxiter)
+            futures[f] = key
+            in_flight[key] += 1
+
+    def complete_steps(key):
+        # Advance while the current step is fully cached (e.g. a base kernel already fitted)
+        while not states[key].done and in_flight[key] == 0:
+            if states[key].pending():
+                submit(key)
+                return
+            states[key].advance()
+            if callback is not None:
+                callback(key, states[key])
+
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('spawn'),
+                                   initializer=_init_worker)
+    try:
+        for key in datasets:
+            submit(key)
+
+        while futures:
+            finished, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for f in finished:
+                key = futures.pop(f)
+                in_flight[key] -= 1
+                states[key].record(f.result())
+                complete_steps(key)
+    finally:
+        executor.shutdown()
+
+    return states
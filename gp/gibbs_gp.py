@@ -4,22 +4,68 @@ sys.path.append('/Users/kenzatazi/Documents/CDT/Code/precip-prediction/')
 import gpytorch 
 import torch
 import numpy as np
+import xarray as xr
 from gpytorch.kernels import InducingPointKernel,  ScaleKernel, PeriodicKernel, MaternKernel
-from gp.multivariate_gibbs_kernel import MultivariateGibbsKernel
-
-gpytorch.settings.cholesky_jitter(1e-4)
+from gp.multivariate_gibbs_kernel import MultivariateGibbsKernel, precision_policy
+from gp.inducing_points import select_inducing_points
 
 ## Declaring model class -- its easier to have this in the script as one can experiment with different settings - for instance, fixing or training inducing locations
 
-class MultiGibbsKernel(gpytorch.models.ExactGP):
+def inducing_grid(train_x, num_inducing=None, method='kmeans', seed=42, precision='float64'):
+    """
+    Inducing points for the spatial (lon, lat) kernel, also used as support of the Gibbs H field.
+
+    Args:
+        train_x (np.ndarray | torch.Tensor): training inputs, coordinates in columns 1 and 2.
+        num_inducing (int, optional): number of inducing points, trades accuracy for speed. 
+            Defaults to None, i.e. every unique training location.
+        method (str, optional): 'kmeans', 'grid' or 'greedy'. Defaults to 'kmeans'.
+        seed (int, optional): random state. Defaults to 42.
+        precision (str, optional): 'float32' or 'float64', dtype of the points. Defaults to 'float64'.
+
+    Returns:
+        torch.Tensor: M x 2 inducing points.
+    """
+    coords = np.asarray(train_x)[:, 1:3]
+    return torch.as_tensor(select_inducing_points(coords, num_inducing=num_inducing, method=method, seed=seed),
+                           dtype=precision_policy(precision)['dtype'])
+
+
+class PrecisionMixin:
+    """ 
+    Precision policy ('float32' with larger jitters or 'float64') configured once on the model: 
+    parameters, kernel internals and inputs all use self.dtype.
+    """
+
+    def set_precision(self, precision):
+        policy = precision_policy(precision)
+        self.precision = precision
+        self.dtype = policy['dtype']
+        self.cholesky_jitter = policy['cholesky_jitter']
+
+    def tensor(self, array):
+        """ Converts an array to a tensor with the model dtype """
+        return torch.as_tensor(np.asarray(array), dtype=self.dtype)
+
+    def settings(self):
+        """ Context manager setting the Cholesky jitter of the precision policy """
+        return gpytorch.settings.cholesky_jitter(self.cholesky_jitter, self.cholesky_jitter)
+
+
+class MultiGibbsKernel(PrecisionMixin, gpytorch.models.ExactGP):
     
-    def __init__(self, train_x, train_y, Z_init, likelihood):
+    def __init__(self, train_x, train_y, Z_init, likelihood, learn_inducing=False, precision='float64'):
+        dtype = precision_policy(precision)['dtype']
+        train_x, train_y, Z_init = [torch.as_tensor(a).to(dtype) for a in (train_x, train_y, Z_init)]
         super().__init__(train_x, train_y, likelihood)
+        self.set_precision(precision)
         self.mean_module = gpytorch.means.ConstantMean()
 
-        self.base_covar_module = ScaleKernel(MultivariateGibbsKernel(Z_init, 2))
+        # H is supported on Z_init and interpolated to the training locations, so a reduced
+        # inducing grid (see inducing_grid) sets the cost of the spatial kernel.
+        self.base_covar_module = ScaleKernel(MultivariateGibbsKernel(Z_init, 2, precision=precision))
         self.spatial_covar_module = InducingPointKernel(self.base_covar_module, inducing_points=Z_init, likelihood=likelihood)
-        self.spatial_covar_module.inducing_points.requires_grad_(False)
+        self.spatial_covar_module.inducing_points.requires_grad_(learn_inducing)
         #self.spatial_covar_module = ScaleKernel(MaternKernel(nu=1.5, active_dims=(1,2)))
 
         self.temporal_covar_module = ScaleKernel(PeriodicKernel(active_dims=[0]) * MaternKernel(nu=1.5, active_dims=[0]))
@@ -27,8 +73,112 @@ class MultiGibbsKernel(gpytorch.models.ExactGP):
         for i in range(4, train_x.shape[1]):
              self.clim_covar_module += ScaleKernel(MaternKernel(nu=1.5, active_dims=[i]))
 
+        self.to(self.dtype)
         
     def forward(self, x):
+        x = x.to(self.dtype)
+        mean = self.mean_module(x)
+        covar = self.temporal_covar_module(x) + self.spatial_covar_module(x[:,(1,2)]) + self.clim_covar_module(x)
+        return gpytorch.distributions.MultivariateNormal(mean, covar)
+
+
+def build_multi_gibbs(xtrain, ytrain, num_inducing=None, inducing_method='kmeans', precision='float64', seed=42,
+                      z=None):
+    """
+    Builds a MultiGibbsKernel model and its likelihood from numpy arrays. The seed sets the random
+    initialisation of H, so different seeds give independent starts. Inducing points z chosen
+    before (see inducing_grid) skip the selection.
+    """
+    torch.manual_seed(seed)
+    dtype = precision_policy(precision)['dtype']
+    if z is None:
+        z = inducing_grid(xtrain, num_inducing=num_inducing, method=inducing_method, precision=precision)
+    likelihood = gpytorch.likelihoods.GaussianLikelihood()
+    likelihood.noise_covar.raw_noise.requires_grad = False
+    model = MultiGibbsKernel(torch.as_tensor(np.asarray(xtrain), dtype=dtype),
+                             torch.as_tensor(np.asarray(ytrain).reshape(-1), dtype=dtype), z, likelihood,
+                             precision=precision)
+    return model, likelihood
+
+
+def variational_inducing_inputs(train_x, num_inducing=500, seed=42):
+    """ Random subset of the training inputs used to initialise the SVGP inducing inputs """
+    train_x = torch.as_tensor(train_x)
+    generator = torch.Generator().manual_seed(seed)
+    idx = torch.randperm(len(train_x), generator=generator)[:num_inducing]
+    return train_x[idx].clone()
+
+
+class VariationalMultiGibbsKernel(PrecisionMixin, gpytorch.models.ApproximateGP):
+    """
+    Sparse variational version of MultiGibbsKernel, trained on minibatches with the ELBO.
+    The inducing inputs live in the full input space, the H field of the Gibbs kernel is 
+    supported on the 2D points Z_h.
+    """
+
+    def __init__(self, inducing_x, Z_h, learn_inducing=True, precision='float64'):
+        dtype = precision_policy(precision)['dtype']
+        inducing_x, Z_h = [torch.as_tensor(a).to(dtype) for a in (inducing_x, Z_h)]
+        variational_distribution = gpytorch.variational.CholeskyVariationalDistribution(inducing_x.size(0))
+        variational_strategy = gpytorch.variational.VariationalStrategy(
+            self, inducing_x, variational_distribution, learn_inducing_locations=learn_inducing)
+        super().__init__(variational_strategy)
+        self.set_precision(precision)
+        self.mean_module = gpytorch.means.ConstantMean()
+
+        self.spatial_covar_module = ScaleKernel(MultivariateGibbsKernel(Z_h, 2, precision=precision))
+        self.temporal_covar_module = ScaleKernel(PeriodicKernel(active_dims=[0]) * MaternKernel(nu=1.5, active_dims=[0]))
+        self.clim_covar_module = ScaleKernel(MaternKernel(nu=1.5, active_dims=[3]))
+        for i in range(4, inducing_x.shape[1]):
+             self.clim_covar_module += ScaleKernel(MaternKernel(nu=1.5, active_dims=[i]))
+
+        self.to(self.dtype)
+
+    def forward(self, x):
+        x = x.to(self.dtype)
         mean = self.mean_module(x)
         covar = self.temporal_covar_module(x) + self.spatial_covar_module(x[:,(1,2)]) + self.clim_covar_module(x)
         return gpytorch.distributions.MultivariateNormal(mean, covar)
+
+
+def lengthscale_field_dataset(kernel, lon, lat, offset=(0., 0.), scale=(1., 1.), filepath=None) -> xr.Dataset:
+    """
+    Gridded lengthscale and anisotropy field of a MultivariateGibbsKernel.
+
+    Args:
+        kernel (MultivariateGibbsKernel): trained kernel, e.g. model.base_covar_module.base_kernel.
+        lon (np.ndarray): grid longitudes in degrees.
+        lat (np.ndarray): grid latitudes in degrees.
+        offset (tuple, optional): (lon, lat) mapped to zero in model coordinates. Defaults to (0, 0).
+        scale (tuple, optional): model units per degree for (lon, lat), model coordinates being
+            (coords - offset) * scale. Defaults to (1, 1).
+        filepath (str, optional): NetCDF file to write the field to. Defaults to None.
+
+    Returns:
+        xr.Dataset: lengthscales in degrees and anisotropy on the (lat, lon) grid.
+    """
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    coords = np.stack([lon2d.ravel(), lat2d.ravel()], axis=1)
+    x = (coords - np.asarray(offset)) * np.asarray(scale)
+
+    field = kernel.lengthscale_field(torch.as_tensor(x), scale=scale)
+    shape = lon2d.shape
+
+    data_vars = {
+        'lengthscale_lon': field['lengthscales'][:, 0],
+        'lengthscale_lat': field['lengthscales'][:, 1],
+        'major_lengthscale': field['major'],
+        'minor_lengthscale': field['minor'],
+        'anisotropy': field['anisotropy'],
+        'angle': field['angle'],
+    }
+    ds = xr.Dataset({k: (('lat', 'lon'), v.cpu().numpy().reshape(shape)) for k, v in data_vars.items()},
+                    coords={'lat': lat, 'lon': lon})
+    ds['angle'].attrs['units'] = 'radians'
+    for k in ['lengthscale_lon', 'lengthscale_lat', 'major_lengthscale', 'minor_lengthscale']:
+        ds[k].attrs['units'] = 'degrees'
+
+    if filepath is not None:
+        ds.to_netcdf(filepath)
+
+    return ds
@@ -0,0 +1,255 @@
+# Training loops for the non-stationary (Gibbs) models
+
+import os
+import copy
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import gpytorch
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+
+import utils.metrics as me
+
+
+def monitor_batch(x, y, size=500, seed=42):
+    """ Returns a fixed random subset of held-out data used for monitoring during training """
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(len(x), size=min(size, len(x)), replace=False)
+    return x[idx], y[idx]
+
+
+def predictive_metrics(model, likelihood, x, y) -> dict:
+    """
+    R2, RMSE and MLL of the predictive distribution on (x, y). Only the predictive
+    variances are computed, never the full predictive covariance.
+    """
+    model.eval()
+    likelihood.eval()
+    with torch.no_grad(), gpytorch.settings.fast_pred_var():
+        preds = likelihood(model(x))
+        y_mean = preds.mean.cpu().numpy()
+        y_var = preds.variance.cpu().numpy()
+    model.train()
+    likelihood.train()
+
+    y = np.asarray(y).reshape(-1)
+    return {'R2': me.R2(y, y_mean), 'RMSE': me.RMSE(y, y_mean), 'MLL': me.MLL(y, y_mean, y_var),
+            'var': np.mean(y_var)}
+
+
+def train_variational(model, likelihood, xtrain, ytrain, xmonitor, ymonitor, batch_size=256,
+                      n_iter=5000, lr=0.01, eval_every=50, patience=10, seed=42, verbose=True) -> pd.DataFrame:
+    """
+    Minibatch training of a variational model (e.g. VariationalMultiGibbsKernel) on the ELBO.
+
+    The cost of a step only depends on batch_size and the number of inducing points, and the
+    monitoring metrics are computed on a fixed small held-out batch, so steps per second do not
+    depend on the size of the training set. Training stops early when the monitoring MLL has not
+    improved for `patience` evaluations and the best parameters are restored.
+
+    Args:
+        model (gpytorch.models.ApproximateGP): variational GP model.
+        likelihood (gpytorch.likelihoods.Likelihood): likelihood.
+        xtrain (torch.Tensor): training inputs.
+        ytrain (torch.Tensor): training outputs.
+        xmonitor (torch.Tensor): monitoring inputs, see monitor_batch.
+        ymonitor (np.ndarray | torch.Tensor): monitoring outputs.
+        batch_size (int, optional): minibatch size, the whole training set if it is smaller.
+            Defaults to 256.
+        n_iter (int, optional): maximum number of optimisation steps. Defaults to 5000.
+        lr (float, optional): Adam learning rate. Defaults to 0.01.
+        eval_every (int, optional): steps between monitoring evaluations. Defaults to 50.
+        patience (int, optional): evaluations without improvement before stopping. Defaults to 10.
+            None disables early stopping.
+        seed (int, optional): minibatch shuffling seed. Defaults to 42.
+        verbose (bool, optional): print monitoring metrics. Defaults to True.
+
+    Returns:
+        pd.DataFrame: training history with loss, monitoring metrics and steps per second.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    loader = DataLoader(TensorDataset(xtrain, ytrain.reshape(-1)), batch_size=batch_size,
+                        shuffle=True, drop_last=len(ytrain) > batch_size, generator=generator)
+
+    optimizer = torch.optim.Adam([{'params': model.parameters()}, {'params': likelihood.parameters()}], lr=lr)
+    elbo = gpytorch.mlls.VariationalELBO(likelihood, model, num_data=len(ytrain))
+
+    model.train()
+    likelihood.train()
+
+    history = []
+    best_mll, best_state, bad_evals = np.inf, None, 0
+    batches = iter(loader)
+    t0 = time.perf_counter()
+
+    for i in range(n_iter):
+        try:
+            x_batch, y_batch = next(batches)
+        except StopIteration:
+            batches = iter(loader)
+            x_batch, y_batch = next(batches)
+
+        optimizer.zero_grad()
+        loss = -elbo(model(x_batch), y_batch)
+        loss.backward()
+        optimizer.step()
+
+        if (i + 1) % eval_every == 0:
+            steps_per_sec = eval_every / (time.perf_counter() - t0)
+            metrics = predictive_metrics(model, likelihood, xmonitor, ymonitor)
+            history.append({'iter': i + 1, 'loss': loss.item(), **metrics, 'steps_per_sec': steps_per_sec})
+
+            if verbose:
+                print(f"Iter {i + 1}/{n_iter} - Loss: {loss.item():.3f}, R2: {metrics['R2']:.3f}, "
+                      f"RMSE: {metrics['RMSE']:.3f}, MLL: {metrics['MLL']:.3f}, Var: {metrics['var']:.3f}, "
+                      f"{steps_per_sec:.1f} it/s")
+
+            if metrics['MLL'] < best_mll:
+                best_mll, bad_evals = metrics['MLL'], 0
+                best_state = (copy.deepcopy(model.state_dict()), copy.deepcopy(likelihood.state_dict()))
+            else:
+                bad_evals += 1
+                if patience is not None and bad_evals >= patience:
+                    if verbose:
+                        print(f"Early stopping at iteration {i + 1}")
+                    break
+            t0 = time.perf_counter()
+
+    if best_state is not None:
+        model.load_state_dict(best_state[0])
+        likelihood.load_state_dict(best_state[1])
+
+    model.eval()
+    likelihood.eval()
+    return pd.DataFrame(history)
+
+
+def train_exact(model, likelihood, n_iter=600, lr=0.001, optimizer_state=None):
+    """
+    Full-batch Adam training of an exact GP (e.g. MultiGibbsKernel) on the marginal likelihood.
+
+    Returns:
+        tuple: final loss and optimizer state, so that training can be resumed.
+    """
+    model.train()
+    likelihood.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    if optimizer_state is not None:
+        optimizer.load_state_dict(optimizer_state)
+    mll = gpytorch.mlls.ExactMarginalLogLikelihood(likelihood, model)
+
+    loss = torch.tensor(np.nan)
+    with gpytorch.settings.max_cg_iterations(6000), model.settings():
+        for i in range(n_iter):
+            optimizer.zero_grad()
+            loss = -mll(model(*model.train_inputs), model.train_targets)
+            loss.backward()
+            optimizer.step()
+
+    return loss.item(), optimizer.state_dict()
+
+
+_start_data = {}
+
+
+def _init_start_worker(xtrain, ytrain, z, model_kwargs):
+    """ Worker initialiser: keeps the training data and inducing points shared by every start and stage """
+    _start_data.update(xtrain=xtrain, ytrain=ytrain, z=z, model_kwargs=model_kwargs)
+
+
+def _train_start(task: dict) -> dict:
+    """ Worker: builds (or restores) one start and trains it for task['n_iter'] iterations """
+    from gp.gibbs_gp import build_multi_gibbs
+
+    torch.set_num_threads(task['n_threads'])
+    model, likelihood = build_multi_gibbs(_start_data['xtrain'], _start_data['ytrain'], seed=task['seed'],
+                                          z=_start_data['z'], **_start_data['model_kwargs'])
+    if task['state'] is not None:
+        model.load_state_dict(task['state']['model'])
+        optimizer_state = task['state']['optimizer']
+    else:
+        optimizer_state = None
+
+    t0 = time.perf_counter()
+    loss, optimizer_state = train_exact(model, likelihood, n_iter=task['n_iter'], lr=task['lr'],
+                                        optimizer_state=optimizer_state)
+    if not np.isfinite(loss):
+        loss = np.inf
+
+    return {'seed': task['seed'], 'loss': loss, 'time': time.perf_counter() - t0,
+            'state': {'model': model.state_dict(), 'optimizer': optimizer_state}}
+
+
+def multi_start_train(xtrain, ytrain, n_starts=8, n_iter=600, checkpoints=(25, 50, 100), eta=2, lr=0.001,
+                      n_workers=None, model_kwargs=None, verbose=True) -> tuple:
+    """
+    Trains n_starts independent initialisations of MultiGibbsKernel in parallel processes and prunes
+    them by successive halving: at each checkpoint (cumulative iterations) only the best 1/eta of 
+    the surviving starts, ranked by training loss, carry on. The last survivor is trained to n_iter.
+    Starts run concurrently with the CPU threads split between them (torch.set_num_threads), so the
+    wall time for n_starts is close to that of a single start on a multi-core machine. The inducing
+    points are selected once and, with the training data, sent once to each worker process.
+
+    Args:
+        xtrain (np.ndarray): training inputs.
+        ytrain (np.ndarray): training outputs.
+        n_starts (int, optional): number of starts (seeds 0 to n_starts - 1). Defaults to 8.
+        n_iter (int, optional): total iterations of the best start. Defaults to 600.
+        checkpoints (tuple, optional): cumulative iterations at which starts are pruned. Defaults to (25, 50, 100).
+        eta (int, optional): pruning factor. Defaults to 2.
+        lr (float | list, optional): Adam learning rate, or list of rates cycled over starts. Defaults to 0.001.
+        n_workers (int, optional): number of processes. Defaults to min(n_starts, cpu count).
+        model_kwargs (dict, optional): keyword arguments for gp.gibbs_gp.build_multi_gibbs.
+        verbose (bool, optional): print losses at each checkpoint. Defaults to True.
+
+    Returns:
+        tuple: best model, its likelihood and a DataFrame of losses per start and checkpoint.
+    """
+    from gp.gibbs_gp import build_multi_gibbs, inducing_grid
+
+    model_kwargs = dict(model_kwargs or {})
+    z = inducing_grid(xtrain, num_inducing=model_kwargs.get('num_inducing'),
+                      method=model_kwargs.get('inducing_method', 'kmeans'),
+                      precision=model_kwargs.get('precision', 'float64'))
+    lrs = list(lr) if np.iterable(lr) else [lr]
+    n_cpus = os.cpu_count() or 1
+    n_workers = n_workers or min(n_starts, n_cpus)
+
+    survivors = {seed: {'state': None, 'lr': lrs[seed % len(lrs)]} for seed in range(n_starts)}
+    stops = sorted(c for c in checkpoints if c < n_iter) + [n_iter]
+    done = 0
+    history = []
+
+    ctx = mp.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=_init_start_worker,
+                             initargs=(xtrain, ytrain, z, model_kwargs)) as executor:
+        for stop in stops:
+            n_threads = max(1, n_cpus // len(survivors))
+            tasks = [{'seed': seed, 'state': s['state'], 'lr': s['lr'], 'n_iter': stop - done,
+                      'n_threads': n_threads} for seed, s in survivors.items()]
+            results = list(executor.map(_train_start, tasks))
+            done = stop
+
+            for r in results:
+                survivors[r['seed']]['state'] = r['state']
+                survivors[r['seed']]['loss'] = r['loss']
+                history.append({'seed': r['seed'], 'lr': survivors[r['seed']]['lr'], 'iter': stop,
+                                'loss': r['loss'], 'time': r['time']})
+            if verbose:
+                print(f"Iter {stop}: " + ", ".join(f"start {r['seed']}: {r['loss']:.3f}" for r in results))
+
+            # Successive halving
+            n_keep = max(1, int(np.ceil(len(survivors) / eta))) if stop < n_iter else 1
+            ranked = sorted(survivors, key=lambda seed: survivors[seed]['loss'])
+            survivors = {seed: survivors[seed] for seed in ranked[:n_keep]}
+
+    best_seed = next(iter(survivors))
+    model, likelihood = build_multi_gibbs(xtrain, ytrain, seed=best_seed, z=z, **model_kwargs)
+    model.load_state_dict(survivors[best_seed]['state']['model'])
+    model.eval()
+    likelihood.eval()
+
+    return model, likelihood, pd.DataFrame(history)
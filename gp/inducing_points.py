@@ -0,0 +1,131 @@
+# Inducing points
+
+"""
+Selection of reduced inducing grids for the spatial part of the non-stationary
+models. The Gibbs H field is supported on the inducing points and interpolated
+to every other location through the conditional mean of its GP prior.
+"""
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+
+def unique_coordinates(coords: np.ndarray) -> np.ndarray:
+    """ Returns the unique rows of an N x 2 array of coordinates """
+    return np.unique(np.asarray(coords, dtype=np.float64), axis=0)
+
+
+def kmeans_inducing_points(coords: np.ndarray, num_inducing: int, seed=42) -> np.ndarray:
+    """
+    Inducing points as k-means centroids of the unique coordinates.
+
+    Args:
+        coords (np.ndarray): N x 2 coordinates.
+        num_inducing (int): number of inducing points.
+        seed (int, optional): k-means random state. Defaults to 42.
+
+    Returns:
+        np.ndarray: num_inducing x 2 inducing points.
+    """
+    unique = unique_coordinates(coords)
+    kmeans = KMeans(n_clusters=num_inducing, random_state=seed).fit(unique)
+    return kmeans.cluster_centers_
+
+
+def grid_inducing_points(coords: np.ndarray, num_inducing: int) -> np.ndarray:
+    """
+    Inducing points on a regular coarse grid over the bounding box of the
+    coordinates. Empty grid cells are dropped and each occupied cell is
+    represented by the centroid of the coordinates it contains, so at most
+    num_inducing points are returned.
+
+    Args:
+        coords (np.ndarray): N x 2 coordinates.
+        num_inducing (int): target number of inducing points.
+
+    Returns:
+        np.ndarray: M x 2 inducing points with M <= num_inducing.
+    """
+    unique = unique_coordinates(coords)
+    lower = unique.min(axis=0)
+    extent = np.maximum(unique.max(axis=0) - lower, 1e-12)
+
+    # Grid shape following the aspect ratio of the domain
+    n0 = max(int(np.round(np.sqrt(num_inducing * extent[0] / extent[1]))), 1)
+    n1 = max(num_inducing // n0, 1)
+
+    cells = np.floor((unique - lower) / extent * [n0, n1]).astype(int)
+    cells = np.minimum(cells, [n0 - 1, n1 - 1])
+    cell_id = cells[:, 0] * n1 + cells[:, 1]
+
+    _, inverse, counts = np.unique(cell_id, return_inverse=True, return_counts=True)
+    centroids = np.zeros((len(counts), 2))
+    np.add.at(centroids, inverse, unique)
+    return centroids / counts[:, None]
+
+
+def greedy_variance_inducing_points(coords: np.ndarray, num_inducing: int,
+                                    lengthscales=(1.0, 3.0), variance=0.25) -> np.ndarray:
+    """
+    Greedy variance-based selection: repeatedly adds the unique coordinate with
+    the largest conditional prior variance given the points already selected
+    (a pivoted Cholesky of the RBF prior used for the Gibbs H field).
+
+    Args:
+        coords (np.ndarray): N x 2 coordinates.
+        num_inducing (int): number of inducing points.
+        lengthscales (tuple, optional): RBF lengthscales. Defaults to the H prior (1.0, 3.0).
+        variance (float, optional): RBF variance. Defaults to the H prior 0.25.
+
+    Returns:
+        np.ndarray: num_inducing x 2 inducing points.
+    """
+    unique = unique_coordinates(coords)
+    n = len(unique)
+    num_inducing = min(num_inducing, n)
+
+    scaled = unique / np.asarray(lengthscales)
+    residual = np.full(n, float(variance))
+    L = np.zeros((num_inducing, n))
+    selected = []
+
+    for m in range(num_inducing):
+        i = int(np.argmax(residual))
+        if residual[i] <= 1e-12:
+            break
+        selected.append(i)
+        sqdist = np.sum((scaled - scaled[i]) ** 2, axis=1)
+        k_i = variance * np.exp(-0.5 * sqdist)
+        L[m] = (k_i - L[:m, i] @ L[:m]) / np.sqrt(residual[i])
+        residual = np.maximum(residual - L[m] ** 2, 0.0)
+        residual[selected] = -np.inf
+
+    return unique[selected]
+
+
+def select_inducing_points(coords: np.ndarray, num_inducing=None, method='kmeans', seed=42) -> np.ndarray:
+    """
+    Returns inducing points for the spatial kernel.
+
+    Args:
+        coords (np.ndarray): N x 2 coordinates (e.g. xtrain[:, 1:3]).
+        num_inducing (int, optional): number of inducing points, the accuracy/speed knob.
+            Defaults to None, in which case every unique coordinate is used.
+        method (str, optional): 'kmeans', 'grid' or 'greedy'. Defaults to 'kmeans'.
+        seed (int, optional): random state for k-means. Defaults to 42.
+
+    Returns:
+        np.ndarray: M x 2 inducing points.
+    """
+    unique = unique_coordinates(coords)
+    if num_inducing is None or num_inducing >= len(unique):
+        return unique
+
+    if method == 'kmeans':
+        return kmeans_inducing_points(unique, num_inducing, seed=seed)
+    if method == 'grid':
+        return grid_inducing_points(unique, num_inducing)
+    if method == 'greedy':
+        return greedy_variance_inducing_points(unique, num_inducing)
+
+    raise ValueError("method must be 'kmeans', 'grid' or 'greedy'")
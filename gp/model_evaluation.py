@@ -1,8 +1,17 @@
 # Model evaluation
 
+import os
+import json
+import time
 import datetime
+import traceback
+import multiprocessing as mp
+from queue import Empty
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import pandas as pd
+import gpflow
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 
@@ -17,83 +26,149 @@ import sampling as sa
 mask_filepath = "_Data/ERA5_Upper_Indus_mask.nc"
 
 
-def single_loc_evaluation(location, perf_plot=False, hpar_plot=False):
-
-    metric_list = []
-    coord_list = sa.random_location_generator(location)
-    n = len(coord_list)
-
-    for i in tqdm(range(n)):
-        try:
-            xtrain, xval, _, ytrain, yval, _ = dp.point_model(
-                coords=list(coord_list[i])
-            )
-            m = gpm.multi_gp(xtrain, xval, ytrain, yval)
-
-            training_R2 = me.R2(m, xtrain, ytrain)
-            training_RMSE = me.RMSE(m, xtrain, ytrain)
-            val_R2 = me.R2(m, xval, yval)
-            val_RMSE = me.RMSE(m, xval, yval)
-            time_kernel_lengthscale = float(
-                m.kernel.kernels[0].base_kernel.variance.value())
-            time_kernel_variance = float(
-                m.kernel.kernels[0].base_kernel.lengthscales.value())
-            time_kernel_periodicity = float(m.kernel.kernels[0].period.value())
-            N34_lengthscale = np.array(
-                m.kernel.kernels[1].lengthscales.value())[2]
-            d2m_lengthscale = np.array(
-                m.kernel.kernels[1].lengthscales.value())[0]
-            tcwv_lengthscale = np.array(
-                m.kernel.kernels[1].lengthscales.value())[1]
-            rbf_kernel_variance = float(m.kernel.kernels[1].variance.value())
-
-            metric_list.append(
-                [
-                    coord_list[i, 0],
-                    coord_list[i, 1],
-                    training_R2,
-                    training_RMSE,
-                    val_R2,
-                    val_RMSE,
-                    time_kernel_lengthscale,
-                    time_kernel_variance,
-                    time_kernel_periodicity,
-                    N34_lengthscale,
-                    d2m_lengthscale,
-                    tcwv_lengthscale,
-                    rbf_kernel_variance
-                ]
-            )
-
-        except Exception:
-            pass
-
-    df = pd.DataFrame(
-        metric_list,
-        columns=[
-            "latitude",
-            "longitude",
-            "training_R2",
-            "training_RMSE",
-            "val_R2",
-            "val_RMSE",
-            "time_kernel_lengthscale",
-            "time_kernel_variance",
-            "time_kernel_periodicity",
-            "N34_lengthscale",
-            "d2m_lengthscale",
-            "tcwv_lengthscale",
-            "rbf_kernel_variance"
-        ],
-    )
+def flat_parameters(model) -> dict:
+    """ Returns the model hyperparameters as scalar columns, e.g. kernel.kernels[1].lengthscales """
+    params = {}
+    for key, value in gpflow.utilities.read_values(model).items():
+        value = np.asarray(value)
+        name = key.lstrip(".")
+        if value.size == 1:
+            params[name] = float(value)
+        else:
+            params.update({f"{name}_{j}": float(v) for j, v in enumerate(value.reshape(-1))})
+    return params
+
+
+def evaluate_location(coords) -> dict:
+    """ Fits the single location model at [lat, lon] and returns its metrics, hyperparameters and timings """
+
+    t0 = time.perf_counter()
+    dataset = dp.point_model(np.array([coords[1], coords[0]]))
+    xtrain, xval, _, ytrain, yval, _ = dataset.sets()
+    t1 = time.perf_counter()
+    m = gpm.multi_gp(xtrain, xval, ytrain, yval, dataset.l, dataset.yscaler, kernel="point")
+    t2 = time.perf_counter()
+    ytrain_pred, _ = m.predict_y(xtrain)
+    yval_pred, _ = m.predict_y(xval)
+    t3 = time.perf_counter()
+
+    params = flat_parameters(m)
+
+    return {"latitude": coords[0],
+            "longitude": coords[1],
+            "training_R2": me.R2(ytrain, ytrain_pred.numpy()),
+            "training_RMSE": me.RMSE(ytrain, ytrain_pred.numpy()),
+            "val_R2": me.R2(yval, yval_pred.numpy()),
+            "val_RMSE": me.RMSE(yval, yval_pred.numpy()),
+            "time_kernel_periodicity": params.get("kernel.kernels[0].kernels[0].period", np.nan),
+            "n_train": len(xtrain),
+            "load_time": t1 - t0,
+            "fit_time": t2 - t1,
+            "predict_time": t3 - t2,
+            **params}
+
+
+def _evaluation_task(evaluate, task) -> tuple:
+    """ Worker: runs evaluate(task) and returns its status and row, with the traceback on failure """
+    t0 = time.perf_counter()
+    try:
+        row = evaluate(task)
+        row["task_time"] = time.perf_counter() - t0
+        return "ok", row
+    except Exception:
+        return "failed", {"task": repr(task), "task_time": time.perf_counter() - t0,
+                          "traceback": traceback.format_exc()}
+
+
+def _append_row(row: dict, filepath: str):
+    """ Appends a row to a CSV file, keeping the columns of the existing header """
+    df = pd.DataFrame([row])
+    if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+        columns = pd.read_csv(filepath, nrows=0).columns
+        extra = [c for c in df.columns if c not in columns]
+        if extra:
+            print("Columns not in " + filepath + " are dropped: " + str(extra))
+        df.reindex(columns=columns).to_csv(filepath, mode="a", header=False, index=False)
+    else:
+        df.to_csv(filepath, index=False)
+
+
+def evaluation_driver(tasks, filepath, evaluate=evaluate_location, failures_filepath=None, key=("latitude", "longitude"),
+                      n_workers=None, resume=True) -> pd.DataFrame:
+    """
+    Runs evaluate over tasks in parallel processes, appending each result to a CSV file as soon
+    as it completes, so that an interrupted run keeps its results and can be resumed.
+
+    Args:
+        tasks (list): task arguments, e.g. [lat, lon] coordinates. Their values form the key.
+        filepath (str): append-only CSV of results, one row per task with a task_time column.
+        evaluate (callable, optional): module level function of one task returning a dict of
+            columns that includes the key columns. Defaults to evaluate_location.
+        failures_filepath (str, optional): append-only CSV of failed tasks with their tracebacks
+            and timings. Defaults to filepath with a -failures suffix.
+        key (tuple, optional): result columns identifying a task. Defaults to ("latitude", "longitude").
+        n_workers (int, optional): number of processes. Defaults to None, i.e. one per CPU.
+        resume (bool, optional): skip tasks already in filepath. Defaults to True.
+
+    Returns:
+        pd.DataFrame: all results in filepath.
+    """
+    if failures_filepath is None:
+        failures_filepath = os.path.splitext(filepath)[0] + "-failures.csv"
+
+    todo = list(tasks)
+    if resume is True and os.path.exists(filepath):
+        done = set(map(tuple, pd.read_csv(filepath)[list(key)].round(6).values.tolist()))
+        todo = [t for t in todo if tuple(np.round(np.asarray(t, dtype=float), 6).tolist()) not in done]
+        print(str(len(tasks) - len(todo)) + " tasks already completed")
+
+    ctx = mp.get_context("spawn")
+    n_failed = 0
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+        futures = [executor.submit(_evaluation_task, evaluate, t) for t in todo]
+        for f in tqdm(as_completed(futures), total=len(futures)):
+            status, row = f.result()
+            if status == "ok":
+                _append_row(row, filepath)
+            else:
+                n_failed += 1
+                _append_row(row, failures_filepath)
+                print("Task " + row["task"] + " failed:\n" + row["traceback"])
+
+    if n_failed > 0:
+        print(str(n_failed) + " tasks failed, see " + failures_filepath)
+
+    return pd.read_csv(filepath) if os.path.exists(filepath) else pd.DataFrame()
+
+
+def single_loc_evaluation(location, perf_plot=False, hpar_plot=False, filepath=None, n_workers=None, resume=True,
+                          seed=42):
+    """
+    Evaluates the single location model at random locations of an area, see evaluation_driver.
+
+    Args:
+        location (str): area to sample 50 distinct locations from (all of them if it has fewer).
+        perf_plot (bool, optional): plot validation performance maps. Defaults to False.
+        hpar_plot (bool, optional): plot hyperparameter maps. Defaults to False.
+        filepath (str, optional): results CSV. Defaults to a dated file in _Data/.
+        n_workers (int, optional): number of processes. Defaults to one per CPU.
+        resume (bool, optional): skip locations already in filepath. Defaults to True.
+        seed (int, optional): location sampling seed, fixed so that a resumed run draws the same
+            locations. Defaults to 42.
+    """
+    index = sa.location_index(location)
+    coord_list = sa.random_location_generator(location, N=min(50, len(index)), index=index, replace=False,
+                                              seed=seed)
 
-    now = datetime.datetime.now()
-    df.to_csv("_Data/single-locations-eval-" +
-              now.strftime("%Y-%m-%d") + ".csv")
+    if filepath is None:
+        now = datetime.datetime.now()
+        filepath = "_Data/single-locations-eval-" + now.strftime("%Y-%m-%d") + ".csv"
+
+    df = evaluation_driver(coord_list, filepath, n_workers=n_workers, resume=resume)
 
     print(df.mean(axis=0))
 
-    df_prep = df.set_index(["latitude", "longitude"])
+    df_prep = df.drop_duplicates(subset=["latitude", "longitude"]).set_index(["latitude", "longitude"])
     da = df_prep.to_xarray()
 
     if perf_plot is True:
@@ -103,94 +178,127 @@ def single_loc_evaluation(location, perf_plot=False, hpar_plot=False):
         slm_hpar_plots(da)
 
 
-def uib_evaluation(average=False):
-
-    metric_list = []
-
-    sample_list = [1000, 3000, 5000, 7000, 9000, 11000, 14000]
-
-    for i in tqdm(sample_list):
-        try:
-            xtrain, xval, _, ytrain, yval, _ = dp.areal_model(
-                length=i, EDA_average=average
-            )
-            m = gpm.multi_gp(xtrain, xval, ytrain, yval)
-
-            training_R2 = me.R2(m, xtrain, ytrain)
-            training_RMSE = me.RMSE(m, xtrain, ytrain)
-            val_R2 = me.R2(m, xval, yval)
-            val_RMSE = me.RMSE(m, xval, yval)
-
-            metric_list.append(
-                [i, training_R2, training_RMSE, val_R2, val_RMSE])
-
-        except Exception:
-            print(i + 100)
-            xtrain, xval, _, ytrain, yval, _ = dp.areal_model(
-                length=i + 100, EDA_average=average
-            )
-            m = gpm.multi_gp(xtrain, xval, ytrain, yval)
-
-            training_R2 = me.R2(m, xtrain, ytrain)
-            training_RMSE = me.RMSE(m, xtrain, ytrain)
-            val_R2 = me.R2(m, xval, yval)
-            val_RMSE = me.RMSE(m, xval, yval)
-
-            metric_list.append(
-                [i, training_R2, training_RMSE, val_R2, val_RMSE])
-
-    df = pd.DataFrame(
-        metric_list,
-        columns=["samples", "training_R2",
-                 "training_RMSE", "val_R2", "val_RMSE"],
-    )
-    df.to_csv("uib-eval-2020-07-22.csv")
-
-
-def cluster_evaluation(mask):
+def _learning_curve_task(task: dict, queue):
+    """ Worker: fits the areal model on the first n training rows, in its own process so that peak RSS is per size """
+    import resource
+    from scipy.special import inv_boxcox
+
+    n = task["n"]
+    xtrain, ytrain = task["xtrain"][:n], task["ytrain"][:n]
+    xval, yval = task["xval"], task["yval"]
+    lmbda, yscaler = task["lmbda"], task["yscaler"]
+
+    row = {"region": task["region"], "samples": n}
+    try:
+        t0 = time.perf_counter()
+        m = gpm.multi_gp(xtrain, xval, ytrain, yval, lmbda, yscaler, kernel="areal")
+        t1 = time.perf_counter()
+        ytrain_pred, _ = m.predict_y(xtrain)
+        yval_pred, _ = m.predict_y(xval)
+        t2 = time.perf_counter()
+
+        ytrain_inv = inv_boxcox(yscaler.inverse_transform(ytrain), lmbda)
+        yval_inv = inv_boxcox(yscaler.inverse_transform(yval), lmbda)
+        ytrain_pred_inv = inv_boxcox(yscaler.inverse_transform(ytrain_pred.numpy()), lmbda)
+        yval_pred_inv = inv_boxcox(yscaler.inverse_transform(yval_pred.numpy()), lmbda)
+
+        row.update({"training_R2": me.R2(ytrain_inv, ytrain_pred_inv),
+                    "training_RMSE": me.RMSE(ytrain_inv, ytrain_pred_inv),
+                    "val_R2": me.R2(yval_inv, yval_pred_inv),
+                    "val_RMSE": me.RMSE(yval_inv, yval_pred_inv),
+                    "fit_time": t1 - t0,
+                    "predict_time": t2 - t1})
+    except Exception:
+        row["error"] = traceback.format_exc()
+
+    row["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(row)
+
+
+def learning_curve(location, sizes=(1000, 3000, 5000, 7000, 9000, 11000, 14000), name=None, filepath=None,
+                   **dataset_kwargs) -> dict:
+    """
+    Fit time, predict time, peak RSS and training/validation metrics of the areal model per training set size.
+
+    The data is loaded and masked once, with a random training sample of the largest size, and each
+    size uses the first n rows of that sample, so that the training sets are nested and the validation
+    set is shared. Each size is fitted in its own process. Failed sizes are reported with their
+    traceback rather than retried on a different size.
+
+    Args:
+        location (str): area or mask passed to data_prep.areal_model_new.
+        sizes (tuple, optional): training set sizes. Defaults to (1000, 3000, ..., 14000).
+        name (str, optional): region name in the report. Defaults to location.
+        filepath (str, optional): JSON report. Defaults to "<name>-eval-<date>.json".
+        **dataset_kwargs: passed to data_prep.areal_model_new (e.g. EDA_average, var).
+
+    Returns:
+        dict: report with the region, date, sizes and one result per size, see cheapest_size.
+    """
+    name = location if name is None else name
+    sizes = sorted(sizes)
+
+    dataset = dp.areal_model_new(location, length=sizes[-1], **dataset_kwargs)
+    xtrain, xval, _, ytrain, yval, _ = dataset.sets()
+    data = {"xtrain": xtrain, "ytrain": ytrain, "xval": xval, "yval": yval, "lmbda": dataset.l,
+            "yscaler": dataset.yscaler, "region": name}
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for n in tqdm(sizes):
+        queue = ctx.Queue()
+        p = ctx.Process(target=_learning_curve_task, args=({**data, "n": n}, queue))
+        p.start()
+        while True:
+            try:
+                results.append(queue.get(timeout=10))
+                break
+            except Empty:
+                # e.g. killed when running out of memory
+                if not p.is_alive():
+                    results.append({"region": name, "samples": n,
+                                    "error": "Process exited with code " + str(p.exitcode)})
+                    break
+        p.join()
+        if "error" in results[-1]:
+            print(str(n) + " samples failed:\n" + results[-1]["error"])
 
-    metric_list = []
+    now = datetime.datetime.now()
+    report = {"region": name, "date": now.strftime("%Y-%m-%d"), "sizes": sizes, "n_val": len(yval),
+              "results": results}
 
-    name = mask[0:6]
+    if filepath is None:
+        filepath = name + "-eval-" + now.strftime("%Y-%m-%d") + ".json"
+    with open(filepath, "w") as f:
+        json.dump(report, f, indent=2, default=float)
 
-    sample_list = [1000, 3000, 5000, 7000, 9000, 11000, 14000]
+    return report
 
-    for i in tqdm(sample_list):
-        try:
-            xtrain, xval, _, ytrain, yval, _ = dp.areal_model(
-                length=i, mask=mask
-            )
-            m = gpm.multi_gp(xtrain, xval, ytrain, yval)
 
-            training_R2 = me.R2(m, xtrain, ytrain)
-            training_RMSE = me.RMSE(m, xtrain, ytrain)
-            val_R2 = me.R2(m, xval, yval)
-            val_RMSE = me.RMSE(m, xval, yval)
+def cheapest_size(report, target=0.5, metric="val_R2", cost="fit_time", higher_is_better=True):
+    """
+    Returns the result (dict) of the cheapest training set size whose metric meets the target,
+    or None if no size does. report is a learning_curve report or the path to its JSON file.
+    """
+    if isinstance(report, str):
+        with open(report) as f:
+            report = json.load(f)
 
-            metric_list.append(
-                [i, training_R2, training_RMSE, val_R2, val_RMSE])
+    ok = [r for r in report["results"] if "error" not in r
+          and (r[metric] >= target if higher_is_better else r[metric] <= target)]
+    if not ok:
+        return None
+    return min(ok, key=lambda r: (r[cost], r["samples"]))
 
-        except Exception:
-            print(i + 100)
-            xtrain, xval, _, ytrain, yval, _ = dp.areal_model(
-                length=i + 100, mask=mask
-            )
-            m = gpm.multi_gp(xtrain, xval, ytrain, yval)
 
-            training_R2 = me.R2(m, xtrain, ytrain)
-            training_RMSE = me.RMSE(m, xtrain, ytrain)
-            val_R2 = me.R2(m, xval, yval)
-            val_RMSE = me.RMSE(m, xval, yval)
+def uib_evaluation(average=False, sizes=(1000, 3000, 5000, 7000, 9000, 11000, 14000), filepath=None):
+    """ Learning curve of the areal model over the Upper Indus Basin, see learning_curve """
+    return learning_curve("uib", sizes=sizes, name="uib", filepath=filepath, EDA_average=average, var="uib")
 
-            metric_list.append(
-                [i, training_R2, training_RMSE, val_R2, val_RMSE])
 
-    df = pd.DataFrame(
-        metric_list,
-        columns=["samples", "training_R2",
-                 "training_RMSE", "val_R2", "val_RMSE"],
-    )
-    df.to_csv(name + "-eval-2020-07-22.csv")
+def cluster_evaluation(mask, sizes=(1000, 3000, 5000, 7000, 9000, 11000, 14000), filepath=None):
+    """ Learning curve of the areal model over a cluster mask, see learning_curve """
+    return learning_curve(mask, sizes=sizes, name=mask[0:6], filepath=filepath, var="uib")
 
 
 def sampled_points(
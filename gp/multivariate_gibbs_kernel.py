@@ -18,23 +18,41 @@ global jitter
 jitter = 1e-5
 softplus = torch.nn.Softplus()
 
+# Precision policy: dtype and jitters used by the prior, the kernel internals and the Cholesky 
+# decompositions. float32 needs larger jitters to keep the matrices positive definite.
+PRECISIONS = {
+    'float64': {'dtype': torch.float64, 'jitter': 1e-5, 'sigma_jitter': 1e-6, 'cholesky_jitter': 1e-6},
+    'float32': {'dtype': torch.float32, 'jitter': 1e-4, 'sigma_jitter': 1e-5, 'cholesky_jitter': 1e-4},
+}
+
+
+def precision_policy(precision='float64') -> dict:
+    """ Returns the dtype and jitters for 'float32' or 'float64' """
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be 'float32' or 'float64'")
+    return PRECISIONS[precision]
+
 class IndependentMatrixPrior(gpytorch.priors.MultivariateNormalPrior):
     
    ''' 
    Independent GP Priors for rows of  D^{2} x N matrix 
    
    '''
-   def __init__(self, X):
+   def __init__(self, X, precision='float64'):
        
+       policy = precision_policy(precision)
+       X = X.to(policy['dtype'])
+
        mean_module = gpytorch.means.ZeroMean()
-       covar_module = ScaleKernel(base_kernel=RBFKernel(ard_num_dims=2))
+       covar_module = ScaleKernel(base_kernel=RBFKernel(ard_num_dims=2)).to(policy['dtype'])
        covar_module.outputscale = 0.25
        covar_module.base_kernel.lengthscale = [1.0, 3.0]
        
-       covar_matrix = (covar_module(X).evaluate() + jitter*torch.eye(X.shape[0])).detach()
-       mean_vector = mean_module(X)
+       eye = torch.eye(X.shape[0], dtype=X.dtype, device=X.device)
+       covar_matrix = (covar_module(X).evaluate() + policy['jitter']*eye).detach()
+       mean_vector = mean_module(X).detach()
        
-       super().__init__(loc=mean_vector.double(), covariance_matrix=covar_matrix.double())
+       super().__init__(loc=mean_vector, covariance_matrix=covar_matrix)
        
        self.n = X.shape[0]
        self.d = X.shape[1]
@@ -50,7 +68,7 @@ class IndependentMatrixPrior(gpytorch.priors.MultivariateNormalPrior):
        return H
    
    def inverse(self):
-       return torch.linalg.inv(self.covar_matrix)
+       return torch.cholesky_inverse(self.scale_tril)
 
 class MultivariateGibbsKernel(gpytorch.kernels.Kernel):
     
@@ -60,10 +78,15 @@ class MultivariateGibbsKernel(gpytorch.kernels.Kernel):
     is_stationary = False
 
     # We will register the parameter when initializing the kernel
-    def __init__(self, x, input_dim, **kwargs):
+    def __init__(self, x, input_dim, precision='float64', **kwargs):
         super().__init__(**kwargs)
         
-        self.x = x
+        policy = precision_policy(precision)
+        self.jitter = policy['jitter']
+        self.sigma_jitter = policy['sigma_jitter']
+
+        # support of H, fixed even if the inducing points are trained
+        self.register_buffer('x', x.detach().clone().to(policy['dtype']))
         self.n = len(x)
         self.d = input_dim
         
@@ -75,9 +98,9 @@ class MultivariateGibbsKernel(gpytorch.kernels.Kernel):
         
         else: 
             
-            self.H_matrix_prior = IndependentMatrixPrior(self.x) 
+            self.H_matrix_prior = IndependentMatrixPrior(self.x, precision=precision) 
             H_init = self.H_matrix_prior.sample_h()
-            self.register_parameter(name='H', parameter=torch.nn.Parameter(H_init.to(torch.float64)))
+            self.register_parameter(name='H', parameter=torch.nn.Parameter(H_init))
             self.register_prior('prior_H', self.H_matrix_prior, 'H')
             
             #D_init = torch.diag(torch.randn(2))
@@ -85,92 +108,98 @@ class MultivariateGibbsKernel(gpytorch.kernels.Kernel):
             
     def expectation_conditional_matrix_variate_dist(self, x_star):
         
-        K_h_inv =  self.prior_H.covariance_matrix.inverse()    # N x N / M x M
-        K_star_h = self.prior_H.covar_module(x_star, self.x).evaluate() # N* x N        
-        pre_prod = torch.matmul(K_star_h, K_h_inv)
-        cond_mean = torch.Tensor(np.array([torch.matmul(pre_prod, h.T).detach().numpy() for h in self.H]))
+        K_star_h = self.prior_H.covar_module(x_star, self.x).evaluate() # N* x N
+        h_weights = torch.cholesky_solve(self.H.T, self.prior_H.scale_tril) # K_h^{-1} H^T, N x D^2
+        cond_mean = torch.matmul(K_star_h, h_weights).T # D^2 x N*
         return cond_mean
-                
+
+    def h_at(self, x):
+        """
+        H field at x: H itself on the support points (the inducing points), otherwise 
+        interpolated through the conditional mean of the matrix prior.
+        """
+        if x.shape == self.x.shape and torch.equal(x, self.x.to(x.dtype)):
+            return self.H
+        return self.expectation_conditional_matrix_variate_dist(x)
+
+    def sigmas(self, Hx):
+        """ D x D kernel matrices Sigma(x) = L(x)L(x)^T from the D^2 x N H field """
+        raw_sigmas = Hx.T.reshape(-1, self.d, self.d) # N x D x D
+        eye = torch.eye(self.d, dtype=Hx.dtype, device=Hx.device)
+        return torch.matmul(raw_sigmas, raw_sigmas.transpose(-1, -2)) + self.sigma_jitter*eye
+
+    def lengthscale_field(self, x, scale=None, chunk_size=10000) -> dict:
+        """
+        Lengthscale and anisotropy field of the kernel at N x D coordinates, computed in batched
+        ops on chunks of x (H is interpolated through its conditional mean away from the support).
+
+        Args:
+            x (torch.Tensor): N x D coordinates in model units.
+            scale (array-like, optional): model units per output unit for each dimension, e.g. to
+                report lengthscales in degrees. Defaults to None (model units).
+            chunk_size (int, optional): number of points per batch. Defaults to 10000.
+
+        Returns:
+            dict: tensors 'sigma' (N x D x D), 'lengthscales' (N x D, sqrt of the diagonal of Sigma),
+            'major' and 'minor' principal lengthscales (N), 'anisotropy' major/minor ratio (N) and, 
+            for D = 2, 'angle' of the major axis in radians from the first dimension (N).
+        """
+        x = torch.as_tensor(x, dtype=self.x.dtype, device=self.x.device)
+
+        with torch.no_grad():
+            sigma = torch.cat([self.sigmas(self.h_at(xc)) for xc in torch.split(x, chunk_size)])
+            if scale is not None:
+                inv_scale = 1. / torch.as_tensor(scale, dtype=sigma.dtype, device=sigma.device)
+                sigma = sigma * inv_scale[:, None] * inv_scale[None, :]
+
+            eigvals, eigvecs = torch.linalg.eigh(sigma) # ascending eigenvalues
+            principal = eigvals.clamp(min=0).sqrt()
+
+            field = {'sigma': sigma,
+                     'lengthscales': torch.diagonal(sigma, dim1=-2, dim2=-1).sqrt(),
+                     'major': principal[..., -1],
+                     'minor': principal[..., 0],
+                     'anisotropy': principal[..., -1] / principal[..., 0]}
+            if self.d == 2:
+                field['angle'] = torch.atan2(eigvecs[..., 1, -1], eigvecs[..., 0, -1])
+
+        return field
+
     def forward(self, x1, x2, diag=False, **params):
-                
-        if torch.equal(x1, x2):
-            
-            try: 
-                
-                assert(len(x1) == self.H.shape[1])
-            
-                Hx = self.H.detach()
-                N1 = N2 = len(x1)
-                
-            except AssertionError: 
-                
-                # this means the size of the H matrix and size of the inputs don't match but the two 
-                # inputs are the same -> kernel on test inputs K_{**} is being computed.
-                
-                Hx = self.expectation_conditional_matrix_variate_dist(x1).detach()
-                N1 = N2 = len(x1)
-                
-            # x1 is NxD
-            
-            raw_sigmas = torch.Tensor(np.array([x.reshape(self.d, self.d).numpy() for x in Hx.T])) # N x D x D or N* x D x D.
-            sigma_xs = torch.Tensor(np.array([np.array(torch.matmul(x, x.T) + 1e-6*torch.eye(self.d)) for x in raw_sigmas]))
-            
-            ## expanding to get dimensions NxN
-            self.sigma_matrix_i = torch.einsum('ijkl->jikl', sigma_xs.expand(N1,N1,self.d,self.d)) # each row has a DxD matrix
-            self.sigma_matrix_j = torch.einsum('ijkl->jikl', self.sigma_matrix_i)
-            
-            sigma_dets_matrix = torch.det(self.sigma_matrix_i).pow(0.25) 
-            det_product = torch.mul(sigma_dets_matrix, sigma_dets_matrix.T) ## N x N
-        
+
+        # The inputs do not need to be the support of H: with a reduced inducing grid the kernel
+        # is evaluated at the training inputs through the interpolated H field.
+        same_inputs = x1.shape == x2.shape and torch.equal(x1, x2)
+
+        sigma_x1 = self.sigmas(self.h_at(x1).detach()) # N1 x D x D
+        sigma_x2 = sigma_x1 if same_inputs else self.sigmas(self.h_at(x2).detach()) # N2 x D x D
+
+        if diag:
+            ## only the pairs (x1_i, x2_i) are needed
+            self.sigma_matrix_i = sigma_x1
+            self.sigma_matrix_j = sigma_x2
+            self.diff = x1 - x2
         else:
-            
-            ## x1 and x2 are different data blocks -- computing the test-train cross covariance
-            #print('Detected x1 and x2 are different - need cross covariance computation')
-                    
-            if x1.shape[0] == self.H.shape[1]: ## x1 is training as its length matches the column length of H
-            
-                x_star = x2
-                Hx1 = self.H.detach() 
-                Hx2 = self.expectation_conditional_matrix_variate_dist(x_star).detach()
-                
-            elif x2.shape[0] == self.H.shape[1]:
-                
-                x_star = x1
-                Hx2 = self.H.detach()
-                Hx1 = self.expectation_conditional_matrix_variate_dist(x_star).detach()
-                            
-            N1 = len(x1)
-            N2 = len(x2)
-            
-            raw_sigmas1 = torch.Tensor(np.array([x.reshape(self.d, self.d).numpy() for x in Hx1.T]))
-            sigma_x1 = torch.Tensor(np.array([np.array(torch.matmul(x, x.T) + 1e-5*torch.eye(self.d)) for x in raw_sigmas1])) # N1 x D x D
-            
-            raw_sigmas2 = torch.Tensor(np.array([x.reshape(self.d, self.d).numpy() for x in Hx2.T]))
-            sigma_x2 = torch.Tensor(np.array([np.array(torch.matmul(x, x.T) + 1e-5*torch.eye(self.d)) for x in raw_sigmas2])) # N2 x D x D
-        
-            ## expanding to get dimensions NxN
-            
-            sigma_matrix_i = torch.einsum('ijkl->jikl', sigma_x1.expand(N1,N1,self.d,self.d)) # each row has a DxD matrix
-            self.sigma_matrix_i = sigma_matrix_i[:, 0:N2, :,:]
-            self.sigma_matrix_j = sigma_x2.expand(N1,N2,self.d, self.d)
-            
-            sigma_dets_matrix_i = torch.det(self.sigma_matrix_i).pow(0.25) 
-            sigma_dets_matrix_j = torch.det(self.sigma_matrix_j).pow(0.25) 
-            det_product = torch.mul(sigma_dets_matrix_i, sigma_dets_matrix_j) ## N1 x N2
-            
+            ## expanding to get dimensions N1 x N2
+            N1, N2 = len(x1), len(x2)
+            self.sigma_matrix_i = sigma_x1.unsqueeze(1).expand(N1, N2, self.d, self.d) # each row has a DxD matrix
+            self.sigma_matrix_j = sigma_x2.unsqueeze(0).expand(N1, N2, self.d, self.d) # each column has a DxD matrix
+            self.diff = (x1.unsqueeze(-2) - x2.unsqueeze(-3))
+
+        det_product = torch.mul(torch.det(self.sigma_matrix_i).pow(0.25), torch.det(self.sigma_matrix_j).pow(0.25))
+
         avg_kernel_matrix = (self.sigma_matrix_i + self.sigma_matrix_j)/2
         avg_kernel_det = torch.det(avg_kernel_matrix).pow(-0.5) 
         self.prefactor = torch.mul(det_product, avg_kernel_det) ## N1 x N2
         
-        self.sig_inv = torch.inverse(avg_kernel_matrix + jitter*torch.eye(self.d)).double() ## N1 x N2 x D x D
-        self.diff = (x1.unsqueeze(-2) - x2.unsqueeze(-3)) 
+        eye = torch.eye(self.d, dtype=avg_kernel_matrix.dtype, device=avg_kernel_matrix.device)
+        self.sig_inv = torch.inverse(avg_kernel_matrix + self.jitter*eye) ## N1 x N2 x D x D
         self.first_prod = torch.matmul(self.diff.unsqueeze(-2), self.sig_inv)
-        self.final_prod = torch.matmul(self.first_prod, self.diff.unsqueeze(-1)).reshape(N1,N2) ## N1xN2
+        self.final_prod = torch.matmul(self.first_prod, self.diff.unsqueeze(-1)).squeeze(-1).squeeze(-1) ## N1xN2
 
-        if torch.equal(x1, x2):
-            
-            return torch.mul(self.prefactor, torch.exp(-self.final_prod)) + 1e-4*torch.eye(len(x1)) ## N1 x N2
+        covar = torch.mul(self.prefactor, torch.exp(-self.final_prod))
+
+        if same_inputs:
+            return covar + 1e-4 if diag else covar + 1e-4*torch.eye(len(x1), dtype=covar.dtype, device=covar.device) ## N1 x N2
         
-        else:
-            
-            return torch.mul(self.prefactor, torch.exp(-self.final_prod))
\ No newline at end of file
+        return covar
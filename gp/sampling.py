@@ -1,64 +1,274 @@
 # Sampling
 
+import heapq
+from functools import lru_cache
+
 import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
 from load import era5
 
 mask_filepath = "_Data/ERA5_Upper_Indus_mask.nc"
 
 
-def random_location_sampler(df):
-    """ Returns DataFrame of random location, apply to clean df only """
+class LocationIndex():
+    """
+    Unique (lat, lon) coordinates of a DataFrame and the positions of the rows at each of them.
 
-    df_squished = df[["lat", "lon"]].reset_index()
-    df_s_reset = df_squished.drop_duplicates()
-    i = np.random.randint(len(df_s_reset), size=1)
+    Built once in O(n log n), after which drawing k locations is a single Generator.choice call
+    and gathering their rows is a vectorized lookup, with no boolean filtering of the frame.
+    """
 
-    df_location = df_s_reset.iloc[i]
-    lat = df_location["lat"].values[0]
-    lon = df_location["lon"].values[0]
-    print("lat=" + str(lat) + ", lon=" + str(lon))
+    def __init__(self, df):
+        codes, uniques = pd.MultiIndex.from_arrays([df["lat"].values, df["lon"].values]).factorize()
+        self.coords = np.column_stack([uniques.get_level_values(0), uniques.get_level_values(1)])
+        self.order = np.argsort(codes, kind="stable")
+        self.counts = np.bincount(codes, minlength=len(self.coords))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.lookup = {(lat, lon): k for k, (lat, lon) in enumerate(self.coords)}
+
+    def __len__(self):
+        return len(self.coords)
+
+    def sample(self, n=1, replace=True, rng=None) -> np.ndarray:
+        """ Returns n random location indices """
+        rng = np.random.default_rng(rng)
+        return rng.choice(len(self), size=n, replace=replace)
 
-    df1 = df[df["lat"] == lat]
-    df2 = df1[df1["lon"] == lon]
+    def location(self, lat, lon) -> int:
+        """ Returns the location index of a coordinate pair """
+        return self.lookup[(lat, lon)]
 
-    return df2
+    def rows(self, locations) -> np.ndarray:
+        """ Returns the row positions (in frame order) of all the rows at the given locations """
+        locations = np.asarray(locations).reshape(-1)
+        counts = self.counts[locations]
+        starts = self.offsets[locations]
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.order[np.repeat(starts, counts) + within]
 
 
-def random_location_generator(location, N=50):
+@lru_cache(maxsize=None)
+def location_index(location) -> LocationIndex:
+    """ Returns the LocationIndex of a downloaded area, cached per location """
+    return LocationIndex(era5.download_data(location))
+
+
+def random_location_sampler(df, index=None, seed=None):
     """ Returns DataFrame of random location, apply to clean df only """
 
-    coord_list = []
+    if index is None:
+        index = LocationIndex(df)
+    k = index.sample(1, rng=seed)
+
+    lat, lon = index.coords[k[0]]
+    print("lat=" + str(lat) + ", lon=" + str(lon))
+
+    return df.iloc[index.rows(k)]
 
-    df = era5.download_data(location)
-    df_squished = df[["lat", "lon"]].reset_index()
-    df_s_reset = df_squished.drop_duplicates(subset=["lat", "lon"])
 
-    indices = np.random.randint(len(df_s_reset), size=N)
+def random_location_generator(location, N=50, df=None, index=None, replace=True, seed=None):
+    """
+    Returns list of N random [lat, lon] coordinates. The coordinates are drawn from index if
+    given, otherwise from df, otherwise from the (cached) downloaded data for location.
+    """
+    if index is None:
+        index = LocationIndex(df) if df is not None else location_index(location)
 
-    for i in indices:
-        df_location = df_s_reset.iloc[i]
-        lat = df_location["lat"]
-        lon = df_location["lon"]
-        coord_list.append([lat, lon])
+    return index.coords[index.sample(N, replace=replace, rng=seed)].tolist()
 
-    return coord_list
 
+def block_starts(df_sorted, length, block=36, within_location=False, rng=None) -> np.ndarray:
+    """
+    Returns the first row positions of length // block contiguous windows of df_sorted. If
+    within_location, df_sorted must be sorted by location first and windows do not cross locations.
+    """
+    rng = np.random.default_rng(rng)
+    n_blocks = int(length / block)
 
-def random_location_and_time_sampler(df, length=1000, by_loc=False, seed=42):
-    """Return DataFrame of random locations and times."""
+    if within_location is False:
+        return rng.integers(len(df_sorted) - block + 1, size=n_blocks)
 
-    np.random.seed(seed)
-    df_sorted = df.sort_values(by='time')
+    counts = df_sorted.groupby(["lat", "lon"], sort=False).size().values
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    n_valid = np.maximum(counts - block + 1, 0)
+    within = np.arange(n_valid.sum()) - np.repeat(np.cumsum(n_valid) - n_valid, n_valid)
+    valid_starts = np.repeat(offsets, n_valid) + within
+    return rng.choice(valid_starts, size=n_blocks)
 
-    if by_loc==False:
-        i = np.random.randint(len(df), size=length)
+
+def random_location_and_time_sampler(df, length=1000, by_loc=False, seed=42, block=36, within_location=False):
+    """
+    Return DataFrame of random locations and times.
+
+    Args:
+        df (pd.DataFrame): clean DataFrame with time, lat and lon columns.
+        length (int, optional): number of rows to sample. Defaults to 1000.
+        by_loc (bool, optional): sample contiguous windows of block rows instead of single rows.
+            Defaults to False.
+        seed (int, optional): random seed. Defaults to 42.
+        block (int, optional): window length in rows (months). Defaults to 36.
+        within_location (bool, optional): windows run over the time series of a single location
+            rather than over the time-sorted frame. Defaults to False.
+    """
+    if by_loc is False:
+        # Same draws as with the global np.random.seed, without touching the global state
+        df_sorted = df.sort_values(by='time')
+        i = np.random.RandomState(seed).randint(len(df), size=length)
         df_sampled = df_sorted.iloc[i]
 
-    if by_loc==True:
-        J = np.random.randint(len(df)-36, size=int(length/36))
-        for j in J:
-            J = np.append(J, np.arange(j+1, j+36))
-        print(J.shape)
+    if by_loc is True:
+        if within_location is True:
+            df_sorted = df.sort_values(by=['lat', 'lon', 'time'])
+        else:
+            df_sorted = df.sort_values(by='time')
+        start = block_starts(df_sorted, length, block=block, within_location=within_location, rng=seed)
+        J = (start[:, None] + np.arange(block)).reshape(-1)
         df_sampled = df_sorted.iloc[J]
 
     return df_sampled
+
+
+def _unit_scale(df, columns) -> np.ndarray:
+    """ Returns the columns of df min-max scaled to [0, 1] """
+    x = df[list(columns)].values.astype(np.float64)
+    span = x.max(axis=0) - x.min(axis=0)
+    return (x - x.min(axis=0)) / np.where(span > 0, span, 1)
+
+
+def season(time) -> np.ndarray:
+    """ Returns season codes (0: DJF, 1: MAM, 2: JJA, 3: SON) of numeric or datetime times """
+    month = pd.DatetimeIndex(pd.to_datetime(np.asarray(time))).month.values
+    return (month % 12) // 3
+
+
+def stratified_sampler(df, length=1000, strata=("cluster", "season"), n_clusters=5, seed=42):
+    """
+    Return DataFrame of rows sampled without replacement in proportion to the size of each stratum.
+
+    Args:
+        df (pd.DataFrame): clean DataFrame with time, lat and lon columns.
+        length (int, optional): number of rows to sample. Defaults to 1000.
+        strata (tuple, optional): columns defining the strata. 'season' is derived from time and
+            'cluster' from a KMeans clustering of the coordinates if not in df. Defaults to ("cluster", "season").
+        n_clusters (int, optional): number of spatial clusters if 'cluster' is derived. Defaults to 5.
+        seed (int, optional): random seed. Defaults to 42.
+    """
+    rng = np.random.default_rng(seed)
+    keys = []
+    for s in strata:
+        if s in df.columns:
+            keys.append(pd.factorize(df[s])[0])
+        elif s == "season":
+            keys.append(season(df["time"]))
+        elif s == "cluster":
+            from sklearn.cluster import KMeans
+            index = LocationIndex(df)
+            labels = KMeans(n_clusters=n_clusters, n_init=10, random_state=seed).fit_predict(index.coords)
+            codes = np.empty(len(df), dtype=int)
+            codes[index.order] = np.repeat(labels, index.counts)
+            keys.append(codes)
+        else:
+            raise ValueError(f"Unknown stratum '{s}'")
+    stratum = pd.MultiIndex.from_arrays(keys).factorize()[0] if keys else np.zeros(len(df), dtype=int)
+
+    # Proportional allocation, largest remainders first
+    sizes = np.bincount(stratum)
+    quota = length * sizes / len(df)
+    n = np.floor(quota).astype(int)
+    n[np.argsort(n - quota)[:length - n.sum()]] += 1
+    n = np.minimum(n, sizes)
+
+    # Random order within each stratum, keep the first n
+    order = np.lexsort((rng.random(len(df)), stratum))
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.arange(len(df)) - np.repeat(starts, sizes)
+    keep = order[rank < n[stratum[order]]]
+
+    return df.iloc[np.sort(keep)]
+
+
+def latin_hypercube_sampler(df, length=1000, columns=("lat", "lon", "time"), seed=42):
+    """
+    Return DataFrame of the rows nearest to a Latin hypercube design over columns (scaled to
+    [0, 1]), each row used at most once. Nearest unused rows are found with a KD-tree, querying
+    more neighbours only for the design points whose nearest rows are already taken.
+    """
+    rng = np.random.default_rng(seed)
+    x = _unit_scale(df, columns)
+    tree = cKDTree(x)
+    length = min(length, len(df))
+
+    design = (np.array([rng.permutation(length) for _ in columns]).T + rng.random((length, len(columns)))) / length
+
+    used = np.zeros(len(df), dtype=bool)
+    chosen = np.full(length, -1)
+    todo = np.arange(length)
+    k = 8
+    while len(todo) > 0:
+        _, neighbours = tree.query(design[todo], k=min(k, len(df)))
+        neighbours = neighbours.reshape(len(todo), -1)
+        for i, row in zip(todo, neighbours):
+            free = row[~used[row]]
+            if len(free) > 0:
+                chosen[i] = free[0]
+                used[free[0]] = True
+        todo = todo[chosen[todo] < 0]
+        k *= 4
+
+    return df.iloc[np.sort(chosen)]
+
+
+def maxmin_sampler(df, length=1000, columns=("lat", "lon", "time"), n_candidates=None, seed=42):
+    """
+    Return DataFrame of rows chosen greedily to maximise the minimum distance to the rows already
+    chosen (farthest point sampling) over columns scaled to [0, 1].
+
+    Distances to the chosen set only decrease, so candidates are kept in a lazy max-heap: the top
+    candidate is only updated against the points chosen since its last update, and is accepted if
+    it is still at the top. Exact duplicates are dropped first with a KD-tree.
+
+    Args:
+        n_candidates (int, optional): size of a random candidate pool drawn first, e.g. 20 * length
+            on the full basin record. Defaults to None, i.e. all rows.
+    """
+    rng = np.random.default_rng(seed)
+    x = _unit_scale(df, columns)
+
+    candidates = np.arange(len(df))
+    if n_candidates is not None and n_candidates < len(df):
+        candidates = np.sort(rng.choice(len(df), size=n_candidates, replace=False))
+    pairs = cKDTree(x[candidates]).query_pairs(r=0, output_type='ndarray')
+    candidates = np.delete(candidates, np.unique(pairs[:, 1])) if len(pairs) > 0 else candidates
+    length = min(length, len(candidates))
+
+    first = candidates[rng.integers(len(candidates))]
+    chosen = [first]
+    d = np.linalg.norm(x[candidates] - x[first], axis=1)
+    heap = [(-di, 1, c) for di, c in zip(d, candidates) if c != first]
+    heapq.heapify(heap)
+
+    while len(chosen) < length:
+        neg_d, stamp, c = heapq.heappop(heap)
+        if stamp < len(chosen):
+            new = x[chosen[stamp:]]
+            d_c = min(-neg_d, np.sqrt(np.min(np.sum((new - x[c])**2, axis=1))))
+            if heap and d_c < -heap[0][0]:
+                heapq.heappush(heap, (-d_c, len(chosen), c))
+                continue
+        chosen.append(c)
+
+    return df.iloc[np.sort(chosen)]
+
+
+SAMPLERS = {"random": lambda df, length, seed: random_location_and_time_sampler(df, length=length, seed=seed),
+            "stratified": lambda df, length, seed: stratified_sampler(df, length=length, seed=seed),
+            "lhs": lambda df, length, seed: latin_hypercube_sampler(df, length=length, seed=seed),
+            "maxmin": lambda df, length, seed: maxmin_sampler(df, length=length, n_candidates=20 * length, seed=seed)}
+
+
+def training_sampler(df, length=1000, method="random", seed=42):
+    """ Return DataFrame of length training rows drawn with one of SAMPLERS """
+    if method not in SAMPLERS:
+        raise ValueError(f"Unknown sampler '{method}', use one of {list(SAMPLERS)}")
+    return SAMPLERS[method](df, length, seed)
@@ -0,0 +1,133 @@
+# Figures
+
+"""
+Headless figure pipeline. Predictions are computed once and cached on disk under a hash of
+the model parameters and inputs, figures are built as matplotlib Figure objects with the Agg
+canvas (no pyplot state, nothing blocks) and many figures can be rendered to files in
+parallel processes:
+
+    tasks = [{'kind': 'model', 'filepath': f'figures/slm_{i}.png', **plot_data} for i, ... in ...]
+    render_many(tasks)
+"""
+
+import os
+import hashlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def prediction_key(model, x: np.ndarray, n_samples=0) -> str:
+    """ Returns a hash of the model parameter values, the inputs and the number of samples """
+    import gpflow
+
+    h = hashlib.sha1()
+    for name, value in sorted(gpflow.utilities.read_values(model).items()):
+        h.update(name.encode())
+        h.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    h.update(str(n_samples).encode())
+    return h.hexdigest()
+
+
+def cached_predictions(model, x: np.ndarray, n_samples=5, cache_dir='_Data/prediction_cache') -> dict:
+    """
+    Returns the predictive mean, variance and n_samples latent samples of model at x, loaded from
+    cache_dir if the same model and inputs have been predicted before.
+    """
+    filepath = os.path.join(cache_dir, prediction_key(model, x, n_samples) + '.npz')
+    if os.path.exists(filepath):
+        with np.load(filepath) as f:
+            return dict(f)
+
+    y_mean, y_var = model.predict_y(x)
+    predictions = {'mean': y_mean.numpy(), 'var': y_var.numpy()}
+    if n_samples > 0:
+        predictions['samples'] = model.predict_f_samples(x, n_samples).numpy()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(filepath, **predictions)
+    return predictions
+
+
+def model_figure(t, y_mean, y_lower, y_upper, t_train, y_train, t_val, y_val, samples=None, title="GP fit",
+                 train_label="ERA5 training data", val_label="ERA5 validation data", fig=None) -> Figure:
+    """
+    Draws a single location model fit (prediction, 95% interval, data and posterior samples
+    against time) on fig, or on a new headless Figure.
+    """
+    if fig is None:
+        fig = Figure(figsize=(8, 5))
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    y_mean = np.asarray(y_mean).reshape(-1)
+    ax.fill_between(t, np.asarray(y_lower).reshape(-1), np.asarray(y_upper).reshape(-1), alpha=0.5,
+                    color="lightblue", label="95% confidence interval")
+    ax.scatter(t_train, y_train, color="green", label=train_label, s=10)
+    ax.scatter(t_val, y_val, color="orange", label=val_label, s=10)
+    ax.plot(t, y_mean, color="C0", linestyle="-", label="Prediction")
+    if samples is not None:
+        ax.plot(t, np.asarray(samples)[:, :, 0].T, "C0", linewidth=0.5)
+
+    ax.set_title(title)
+    ax.set_ylabel("Precipitation [mm/day]")
+    ax.set_xlabel("Year")
+    ax.legend()
+    return fig
+
+
+def ensemble_figure(members: list, title="GPflow fit", fig=None) -> Figure:
+    """
+    Draws the fits of ensemble members on fig, or on a new headless Figure. Each member is a dict
+    with t, y, y_mean, y_lower and y_upper (95% interval) arrays.
+    """
+    import seaborn as sns
+
+    if fig is None:
+        fig = Figure(figsize=(8, 5))
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    palette = sns.color_palette("husl", len(members))
+
+    for i, member in enumerate(members):
+        ax.scatter(member['t'], member['y'], label="ERA5 data", color=palette[i])
+        ax.plot(member['t'], np.asarray(member['y_mean']).reshape(-1), color=palette[i], linestyle="-",
+                label="Prediction")
+        ax.fill_between(member['t'], np.asarray(member['y_lower']).reshape(-1),
+                        np.asarray(member['y_upper']).reshape(-1), alpha=0.2, color=palette[i],
+                        label="95% confidence interval")
+
+    ax.set_title(title)
+    ax.set_ylabel("Precipitation [mm/day]")
+    ax.set_xlabel("Year")
+    ax.legend()
+    return fig
+
+
+FIGURES = {'model': model_figure, 'ensemble': ensemble_figure}
+
+
+def render(task: dict) -> str:
+    """ Builds the figure of task['kind'] from the other task entries and saves it to task['filepath'] """
+    task = dict(task)
+    kind, filepath = task.pop('kind'), task.pop('filepath')
+    dpi = task.pop('dpi', 150)
+
+    fig = FIGURES[kind](**task)
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fig.savefig(filepath, dpi=dpi, bbox_inches="tight")
+    return filepath
+
+
+def render_many(tasks: list, n_workers=None) -> list:
+    """ Renders figure tasks (see render) in parallel processes and returns their file paths """
+    if n_workers == 1:
+        return [render(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('spawn')) as executor:
+        return list(executor.map(render, tasks, chunksize=max(1, len(tasks) // (8 * (n_workers or mp.cpu_count())))))
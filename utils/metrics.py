@@ -1,12 +1,15 @@
 # Metrics
 
+import os
 import numpy as np
 import gpflow
 import matplotlib.pyplot as plt
-import seaborn as sns
 import tensorflow as tf
+from scipy.special import inv_boxcox
 
 import gp.data_prep as dp
+import utils.probabilistic_metrics as pm
+import utils.figures as figures
 
 from sklearn.metrics import root_mean_squared_error, r2_score
 
@@ -27,7 +30,52 @@ def MLL(y:np.ndarray, y_pred:np.ndarray, y_var:np.ndarray)-> float:
     return MLL
 
 
-def BIC(model: gpflow.models.GPR, x:np.ndarray, y:np.ndarray)-> float:
+class GPRFactor():
+    """
+    Cholesky factorisation of the training covariance of a fitted GPR model, computed once and
+    shared by the likelihood based scores (BIC, log marginal likelihood) and the predictions.
+    """
+
+    def __init__(self, model: gpflow.models.GPR, x: np.ndarray = None, y: np.ndarray = None):
+        """
+        Args:
+            model (gpflow.models.GPR): fitted GP model
+            x (np.ndarray, optional): observation locations. Defaults to the model training data.
+            y (np.ndarray, optional): observation values. Defaults to the model training data.
+        """
+        if x is None or y is None:
+            x, y = model.data
+        self.model = model
+        self.x = tf.convert_to_tensor(x, dtype=gpflow.default_float())
+        y = tf.reshape(tf.convert_to_tensor(y, dtype=gpflow.default_float()), (-1, 1))
+
+        K = model.kernel(self.x)
+        ks = gpflow.utilities.add_likelihood_noise_cov(K, model.likelihood, self.x)
+        self.L = tf.linalg.cholesky(ks)
+        self.m = model.mean_function(self.x)
+        self.y = y
+        self.alpha = tf.linalg.cholesky_solve(self.L, y - self.m)
+
+    def log_marg_likelihood(self) -> float:
+        """ Returns the log marginal likelihood log p(Y | theta) """
+        return float(tf.reduce_sum(gpflow.logdensities.multivariate_normal(self.y, self.m, self.L)))
+
+    def predict_f(self, xnew: np.ndarray) -> tuple:
+        """ Returns the latent predictive mean and variance at xnew """
+        xnew = tf.convert_to_tensor(xnew, dtype=gpflow.default_float())
+        Kmn = self.model.kernel(self.x, xnew)
+        A = tf.linalg.triangular_solve(self.L, Kmn, lower=True)
+        mean = tf.linalg.matmul(Kmn, self.alpha, transpose_a=True) + self.model.mean_function(xnew)
+        var = self.model.kernel(xnew, full_cov=False) - tf.reduce_sum(tf.square(A), axis=0)
+        return mean.numpy(), var.numpy().reshape(-1, 1)
+
+    def predict_y(self, xnew: np.ndarray) -> tuple:
+        """ Returns the predictive mean and variance of observations at xnew """
+        mean, var = self.predict_f(xnew)
+        return mean, var + self.model.likelihood.variance.numpy()
+
+
+def BIC(model: gpflow.models.GPR, x:np.ndarray, y:np.ndarray, factor:GPRFactor=None)-> float:
     """
     Returns BIC score using the marginal likelihood
 
@@ -35,16 +83,17 @@ def BIC(model: gpflow.models.GPR, x:np.ndarray, y:np.ndarray)-> float:
         x (np.ndarray): observations locations
         y (np.ndarray): observed values
         model (gpflow.models.GPR): GP model
+        factor (GPRFactor, optional): factorisation of the model on (x, y) to reuse. Defaults to None.
 
     Returns:
-        float: _description_
+        float: BIC score
     """
-    marginal_likelihood = log_marg_likelihood(model, x, y)
+    marginal_likelihood = log_marg_likelihood(model, x, y, factor=factor)
     BIC =  len(model.trainable_variables) * np.log(len(x)) - 2 * marginal_likelihood
     return BIC
 
 
-def log_marg_likelihood(model: gpflow.models.GPR, x: np.ndarray, y: np.ndarray) -> float:
+def log_marg_likelihood(model: gpflow.models.GPR, x: np.ndarray, y: np.ndarray, factor: GPRFactor = None) -> float:
     """_    computes the log marginal likelihood.
 
     .. math::   \log p(Y | \theta).
@@ -53,162 +102,210 @@ def log_marg_likelihood(model: gpflow.models.GPR, x: np.ndarray, y: np.ndarray)
         model (gpflow.models.GPR): a GPFlow model of a GP regression
         x (np.ndarray): observation locations
         y (np.ndarray): observation values
+        factor (GPRFactor, optional): factorisation of the model on (x, y) to reuse. Defaults to None.
 
     Returns:
         (float): The log marginal likelihood
         
     """
-    K = model.kernel(x)
-    ks = gpflow.utilities.add_likelihood_noise_cov(K, model.likelihood, x)
-    L = tf.linalg.cholesky(ks)
-    m = model.mean_function(x)
-    log_prob = gpflow.logdensities.multivariate_normal(y, m, L)
+    if factor is None:
+        factor = GPRFactor(model, x, y)
+    return factor.log_marg_likelihood()
 
-    return tf.reduce_sum(log_prob)
 
+def score_model(model: gpflow.models.GPR, xval: np.ndarray, yval: np.ndarray, x: np.ndarray = None,
+                y: np.ndarray = None) -> dict:
+    """
+    Returns BIC and log marginal likelihood on (x, y), and R2, RMSE and MLL on (xval, yval),
+    all from a single factorisation of the training covariance.
 
-def model_plot(model, location, number=None, posteriors=True, slm=True):
-    """ Returns plot for multivariate GP for a single loation """
-
-    if slm is True:
-        if number is None:
-            xtrain, xval, xtest, ytrain, yval, ytest = dp.point_model(
-                location, number=number)
-        else:
-            xtrain, xval, xtest, ytrain, yval, ytest = dp.point_model(location)
-    else:
-        if number is None:
-            xtrain, xval, xtest, ytrain, yval, ytest = dp.point_model(
-                location, number=number)
-        else:
-            xtrain, xval, xtest, ytrain, yval, ytest = dp.point_model(location)
-
-    xtr = np.concatenate((xtrain, xval), axis=0)
-    y_gpr, y_std = model.predict_y(xtr)
-    samples = model.predict_f_samples(xtr, 5)
+    Args:
+        model (gpflow.models.GPR): fitted GP model
+        xval (np.ndarray): validation locations
+        yval (np.ndarray): validation values
+        x (np.ndarray, optional): observation locations. Defaults to the model training data.
+        y (np.ndarray, optional): observation values. Defaults to the model training data.
 
-    # to mm/day
-    y_gpr_t = dp.inverse_log_transform(y_gpr)
-    y_std_t = dp.inverse_log_transform(y_std)
-    samples_t = dp.inverse_log_transform(samples)
-    ytrain_t = dp.inverse_log_transform(ytrain)
-    yval_t = dp.inverse_log_transform(yval)
+    Returns:
+        dict: scores
+    """
+    factor = GPRFactor(model, x, y)
+    y_pred, y_var = factor.predict_y(xval)
+    yval = np.asarray(yval).reshape(-1)
+    y_pred, y_var = y_pred.reshape(-1), y_var.reshape(-1)
+    return {'BIC': BIC(model, factor.x, factor.y, factor=factor),
+            'log_marg_likelihood': factor.log_marg_likelihood(),
+            'R2': R2(yval, y_pred),
+            'RMSE': RMSE(yval, y_pred),
+            'MLL': MLL(yval, y_pred, y_var)}
 
-    plt.figure()
 
-    plt.fill_between(
-        xtr[:, 0] + 1979,
-        y_gpr_t[:, 0] - 1.9600 * y_std_t[:, 0],
-        y_gpr_t[:, 0] + 1.9600 * y_std_t[:, 0],
-        alpha=0.5,
-        color="lightblue",
-        label="95% confidence interval",
-    )
+def to_mm_day(y: np.ndarray, lmbda: float, yscaler) -> np.ndarray:
+    """ Returns standardised Box-Cox precipitation y in mm/day, in the shape of y """
+    y = np.asarray(y)
+    return inv_boxcox(yscaler.inverse_transform(y.reshape(-1, 1)), lmbda).reshape(y.shape)
 
-    plt.scatter(
-        xtrain[:, 0] + 1979, ytrain_t, color="green",
-        label="ERA5 training data", s=10
-    )
-    plt.scatter(
-        xval[:, 0] + 1979, yval_t, color="orange",
-        label="ERA5 validation data", s=10
-    )
 
-    plt.plot(xtr[:, 0] + 1979, y_gpr_t, color="C0",
-             linestyle="-", label="Prediction")
+def to_years(x: np.ndarray, xscaler) -> np.ndarray:
+    """ Returns the time of standardised inputs x (nanoseconds since 1970 before scaling) in years """
+    return 1970 + xscaler.inverse_transform(x)[:, 0] / (365.25 * 24 * 3600 * 1e9)
 
-    if posteriors is True:
-        plt.plot(xtr[:, 0] + 1979, samples_t[:, :, 0].T, "C0", linewidth=0.5)
 
-    if location is None:
-        plt.title("GP fit")
-    else:
-        plt.title("GP fit for " +
-                  str(location[0]) + "°N " + str(location[1]) + "°E")
+def model_plot_data(model, location, number=None, posteriors=True, data=None, predictions=None) -> dict:
+    """
+    Returns the arrays plotted by model_plot, as keyword arguments of utils.figures.model_figure.
 
-    plt.ylabel("Precipitation [mm/day]")
-    plt.xlabel("Year")
-    plt.legend()
+    Args:
+        data (optional): data_prep dataset of the model (point_model or areal_model_new), with
+            its Box-Cox lambda and scalers. Built with data_prep.point_model if None.
+        predictions (dict, optional): precomputed predictions at the concatenated training and
+            validation inputs, see utils.figures.cached_predictions. Defaults to cached predictions.
+    """
+    if data is None:
+        data = dp.point_model(location, number=number)
+    xtrain, xval, _, ytrain, yval, _ = data.sets()
 
-    plt.show()
+    xtr = np.concatenate((xtrain, xval), axis=0)
+    if predictions is None:
+        predictions = figures.cached_predictions(model, xtr, n_samples=5 if posteriors else 0)
+
+    # to mm/day, the 95% interval is mapped through the (monotonic) inverse transform
+    y_std = np.sqrt(predictions["var"])
+    plot_data = {"t": to_years(xtr, data.xscaler),
+                 "y_mean": to_mm_day(predictions["mean"], data.l, data.yscaler),
+                 "y_lower": to_mm_day(predictions["mean"] - 1.9600 * y_std, data.l, data.yscaler),
+                 "y_upper": to_mm_day(predictions["mean"] + 1.9600 * y_std, data.l, data.yscaler),
+                 "t_train": to_years(xtrain, data.xscaler),
+                 "y_train": to_mm_day(ytrain, data.l, data.yscaler),
+                 "t_val": to_years(xval, data.xscaler),
+                 "y_val": to_mm_day(yval, data.l, data.yscaler),
+                 "samples": None,
+                 "title": "GP fit"}
+    if posteriors is True and "samples" in predictions:
+        plot_data["samples"] = to_mm_day(predictions["samples"], data.l, data.yscaler)
+    if location is not None:
+        plot_data["title"] = "GP fit for " + str(location[0]) + "°N " + str(location[1]) + "°E"
+
+    return plot_data
+
+
+def model_plot(model, location, number=None, posteriors=True, data=None, predictions=None, filepath=None):
+    """
+    Returns plot for multivariate GP for a single loation
 
+    The data and predictions can be passed in (see model_plot_data), otherwise predictions are cached
+    by model and inputs. With a filepath the figure is rendered headless to the file instead of shown.
+    """
+    plot_data = model_plot_data(model, location, number=number, posteriors=posteriors, data=data,
+                                predictions=predictions)
 
-def ensemble_model_plot(location, model, slm=True):
-    """ Returns plot for ensemble of multivariate GP for a single loation """
+    if filepath is not None:
+        return figures.render({"kind": "model", "filepath": filepath, **plot_data})
 
-    palette = sns.color_palette("husl", 10)
+    figures.model_figure(**plot_data, fig=plt.figure())
+    plt.show()
 
-    plt.figure()
 
-    for i in range(10):
+def ensemble_model_plot(location, model, slm=True, data=None, predictions=None, filepath=None):
+    """
+    Returns plot for ensemble of multivariate GP for a single loation
 
+    Args:
+        data (list, optional): data_prep dataset per member, built with data_prep.point_model
+            (slm) or data_prep.areal_model_new if None.
+        predictions (list, optional): predictions per member, see utils.figures.cached_predictions.
+        filepath (str, optional): render headless to this file instead of showing the figure.
+    """
+    if data is None:
         if slm is True:
-            xtrain, xval, xtest, ytrain, yval, ytest = dp.point_model(
-                location, number=i)
+            data = [dp.point_model(location, number=i) for i in range(10)]
         else:
-            xtrain, xval, xtest, ytrain, yval, ytest = dp.areal_model_eval(
-                location, number=i)
-
-        xtr = np.concatenate((xtrain, xval), axis=0)
-        ytr = np.concatenate((ytrain, yval), axis=0)
-
-        log_y_gpr, log_y_std = model.predict_y(xtr)
-        log_samples = model.m.predict_f_samples(xtr)
-
-        # to mm/day
-        y_gpr_t = dp.inverse_log_transform(log_y_gpr)
-        y_std_t = dp.inverse_log_transform(log_y_std)
-        samples_t = dp.inverse_log_transform(log_samples)
-        ytr_t = dp.inverse_log_transform(ytr)
-        # yval_t = dp.inverse_log_transform(yval)
-
-        plt.scatter(xtr[:, 0] + 1979, ytr_t,
-                    label="ERA5 data", color=palette[i])
-        plt.plot(samples_t)
-
-        plt.plot(
-            xtr[:, 0] + 1981, y_gpr_t, color=palette[i], linestyle="-",
-            label="Prediction"
-        )
-        plt.fill_between(
-            xtr[:, 0] + 1981,
-            y_gpr_t[:, 0] - 1.9600 * y_std_t[:, 0],
-            y_gpr_t[:, 0] + 1.9600 * y_std_t[:, 0],
-            alpha=0.2,
-            color=palette[i],
-            label="95% confidence interval",
-        )
-
-    plt.title("GPflow fit")
-    plt.ylabel("Precipitation [mm/day]")
-    plt.xlabel("Year")
-    plt.legend()
-
+            data = [dp.areal_model_new(location, number=i) for i in range(10)]
+
+    xtrs, ytrs = [], []
+    for d in data:
+        xtrain, xval, _, ytrain, yval, _ = d.sets()
+        xtrs.append(np.concatenate((xtrain, xval), axis=0))
+        ytrs.append(np.concatenate((ytrain, yval), axis=0))
+
+    if predictions is None:
+        predictions = [figures.cached_predictions(model, xtr, n_samples=0) for xtr in xtrs]
+
+    # to mm/day, each member with its own transformation
+    members = []
+    for d, xtr, ytr, pred in zip(data, xtrs, ytrs, predictions):
+        y_std = np.sqrt(pred["var"])
+        members.append({"t": to_years(xtr, d.xscaler),
+                        "y": to_mm_day(ytr, d.l, d.yscaler),
+                        "y_mean": to_mm_day(pred["mean"], d.l, d.yscaler),
+                        "y_lower": to_mm_day(pred["mean"] - 1.9600 * y_std, d.l, d.yscaler),
+                        "y_upper": to_mm_day(pred["mean"] + 1.9600 * y_std, d.l, d.yscaler)})
+
+    if filepath is not None:
+        return figures.render({"kind": "ensemble", "filepath": filepath, "members": members})
+
+    figures.ensemble_figure(members, fig=plt.figure())
     plt.show()
 
 
-def spread_skill(y:np.ndarray, y_pred_samples:np.ndarray) -> float:
+def cell_model_plots(model, data, directory, n_workers=None) -> list:
+    """
+    Renders one diagnostic plot per grid cell of an areal model, in parallel processes. The model
+    is evaluated once on all the validation and test inputs (cached by model and inputs) and the
+    predictions are split by cell, so nothing is refitted or predicted again per plot.
+
+    Args:
+        model: GP model trained on data.
+        data: data_prep.areal_model_new dataset, with lon and lat as its second and third inputs.
+        directory (str): output directory, one PNG per cell.
+        n_workers (int, optional): number of processes. Defaults to one per CPU.
+
+    Returns:
+        list: file paths of the plots.
+    """
+    _, xval, xtest, _, yval, ytest = data.sets()
+    x = np.concatenate((xval, xtest), axis=0)
+    y = np.concatenate((yval, ytest), axis=0).reshape(-1)
+    is_val = np.arange(len(x)) < len(xval)
+
+    predictions = figures.cached_predictions(model, x, n_samples=0)
+    y_mean, y_std = predictions["mean"].reshape(-1), np.sqrt(predictions["var"]).reshape(-1)
+    t = to_years(x, data.xscaler)
+    lonlat = data.xscaler.inverse_transform(x)[:, 1:3]
+
+    cells, cell_of_row = np.unique(np.round(lonlat, 4), axis=0, return_inverse=True)
+    tasks = []
+    for c, (lon, lat) in enumerate(cells):
+        rows = np.flatnonzero(cell_of_row.reshape(-1) == c)
+        rows = rows[np.argsort(t[rows])]
+        val, test = rows[is_val[rows]], rows[~is_val[rows]]
+        tasks.append({"kind": "model",
+                      "filepath": os.path.join(directory, "cell_" + str(lat) + "N_" + str(lon) + "E.png"),
+                      "t": t[rows],
+                      "y_mean": to_mm_day(y_mean[rows], data.l, data.yscaler),
+                      "y_lower": to_mm_day(y_mean[rows] - 1.9600 * y_std[rows], data.l, data.yscaler),
+                      "y_upper": to_mm_day(y_mean[rows] + 1.9600 * y_std[rows], data.l, data.yscaler),
+                      "t_train": t[val], "y_train": to_mm_day(y[val], data.l, data.yscaler),
+                      "t_val": t[test], "y_val": to_mm_day(y[test], data.l, data.yscaler),
+                      "train_label": "ERA5 validation data", "val_label": "ERA5 test data",
+                      "title": "GP fit for " + str(lat) + "°N " + str(lon) + "°E"})
+
+    return figures.render_many(tasks, n_workers=n_workers)
+
+
+def spread_skill(y:np.ndarray, y_pred_samples:np.ndarray, chunk_size=None) -> float:
     """
-    Returns spread-skill ratio 
+    Returns spread-skill ratio, see utils.probabilistic_metrics.spread_skill
 
     Args:
         y (np.ndarray): observations (T x 1)
         y_pred_samples (np.ndarray): prediction samples (T x N)
+        chunk_size (int, optional): rows per chunk. Defaults to None.
 
     Returns:
         float: skill-spread ration
     """
-    T = y_pred_samples.shape[0]
-    N = y_pred_samples.shape[1]
-
-    mu_t = np.sum(y_pred_samples, axis=1)/N
-    S2 =  np.sum(
-            np.sum(y_pred_samples[:,n] - mu_t for n in range(N))/(N-1) 
-            for t in range(T))/T
-    eta2 = np.sum(np.sum(y-mu_t)/N)/T
-
-    SSR = np.sqrt(S2/(eta2- S2/N))
-    return SSR
+    return pm.spread_skill(y, y_pred_samples, chunk_size=chunk_size)
 
 def plot_vs_truth(x_train, y_train, x_test, y_test, m):
 
@@ -0,0 +1,121 @@
+# Probabilistic metrics
+
+"""
+Scores of probabilistic predictions, given either as samples (T x N arrays, one row per
+observation) or as Gaussian predictive means and variances. Sample based scores take a
+chunk_size to bound memory on very large ensembles, by processing chunk_size rows at a time.
+"""
+
+import numpy as np
+from scipy.stats import norm
+
+
+def _chunks(T: int, chunk_size=None):
+    """ Yields row slices of at most chunk_size rows """
+    chunk_size = T if not chunk_size else chunk_size
+    for start in range(0, T, chunk_size):
+        yield slice(start, min(start + chunk_size, T))
+
+
+def _column(y: np.ndarray) -> np.ndarray:
+    """ Returns y as a (T,) array """
+    return np.asarray(y, dtype=np.float64).reshape(-1)
+
+
+def spread_skill(y: np.ndarray, y_pred_samples: np.ndarray, chunk_size=None) -> float:
+    """
+    Returns spread-skill ratio, which is one for a reliable ensemble
+
+    SSR = sqrt(S2 / (eta2 - S2 / N)), with S2 the mean ensemble variance and eta2 the mean
+    squared error of the ensemble mean.
+
+    Args:
+        y (np.ndarray): observations (T x 1)
+        y_pred_samples (np.ndarray): prediction samples (T x N)
+        chunk_size (int, optional): rows per chunk. Defaults to None, i.e. all rows at once.
+
+    Returns:
+        float: spread-skill ratio
+    """
+    y = _column(y)
+    T, N = y_pred_samples.shape
+
+    S2, eta2 = 0., 0.
+    for rows in _chunks(T, chunk_size):
+        samples = y_pred_samples[rows]
+        mu_t = samples.mean(axis=1)
+        S2 += np.sum(samples.var(axis=1, ddof=1))
+        eta2 += np.sum((y[rows] - mu_t)**2)
+    S2, eta2 = S2 / T, eta2 / T
+
+    return np.sqrt(S2 / (eta2 - S2 / N))
+
+
+def crps_gaussian(y: np.ndarray, y_pred: np.ndarray, y_var: np.ndarray) -> np.ndarray:
+    """ Returns the closed form CRPS of Gaussian predictions for each observation """
+    y, y_pred = _column(y), _column(y_pred)
+    sigma = np.sqrt(_column(y_var))
+    z = (y - y_pred) / sigma
+    return sigma * (z * (2 * norm.cdf(z) - 1) + 2 * norm.pdf(z) - 1 / np.sqrt(np.pi))
+
+
+def crps_samples(y: np.ndarray, y_pred_samples: np.ndarray, chunk_size=None) -> np.ndarray:
+    """
+    Returns the CRPS of sample predictions (T x N) for each observation
+
+    CRPS = E|X - y| - E|X - X'| / 2, where the second term is computed from the sorted samples
+    x_(1) <= ... <= x_(N) as sum_i (2i - N - 1) x_(i) / N^2, in O(N log N) instead of O(N^2).
+    """
+    y = _column(y)
+    T, N = y_pred_samples.shape
+    weights = (2 * np.arange(1, N + 1) - N - 1) / N**2
+
+    crps = np.empty(T)
+    for rows in _chunks(T, chunk_size):
+        samples = y_pred_samples[rows]
+        crps[rows] = np.mean(np.abs(samples - y[rows, None]), axis=1) - np.sort(samples, axis=1) @ weights
+    return crps
+
+
+def pit_gaussian(y: np.ndarray, y_pred: np.ndarray, y_var: np.ndarray) -> np.ndarray:
+    """ Returns the probability integral transform of each observation under Gaussian predictions """
+    return norm.cdf((_column(y) - _column(y_pred)) / np.sqrt(_column(y_var)))
+
+
+def pit_samples(y: np.ndarray, y_pred_samples: np.ndarray, chunk_size=None) -> np.ndarray:
+    """ Returns the probability integral transform of each observation under sample predictions, ties count half """
+    y = _column(y)
+    T, N = y_pred_samples.shape
+
+    pit = np.empty(T)
+    for rows in _chunks(T, chunk_size):
+        samples = y_pred_samples[rows]
+        below = np.sum(samples < y[rows, None], axis=1)
+        equal = np.sum(samples == y[rows, None], axis=1)
+        pit[rows] = (below + 0.5 * equal) / N
+    return pit
+
+
+def pit_histogram(pit: np.ndarray, bins=10) -> tuple:
+    """ Returns the PIT histogram density (flat at one for a calibrated model) and bin edges """
+    return np.histogram(pit, bins=bins, range=(0, 1), density=True)
+
+
+def coverage_gaussian(y: np.ndarray, y_pred: np.ndarray, y_var: np.ndarray, levels=(0.5, 0.9, 0.95)) -> dict:
+    """ Returns the fraction of observations within the central interval of each level of Gaussian predictions """
+    pit = pit_gaussian(y, y_pred, y_var)
+    return {level: np.mean(np.abs(pit - 0.5) <= level / 2) for level in levels}
+
+
+def coverage_samples(y: np.ndarray, y_pred_samples: np.ndarray, levels=(0.5, 0.9, 0.95), chunk_size=None) -> dict:
+    """ Returns the fraction of observations within the central empirical interval of each level of samples """
+    y = _column(y)
+    T = y_pred_samples.shape[0]
+    q = np.concatenate([(1 - np.asarray(levels)) / 2, (1 + np.asarray(levels)) / 2])
+
+    inside = np.zeros(len(levels))
+    for rows in _chunks(T, chunk_size):
+        bounds = np.quantile(y_pred_samples[rows], q, axis=1)
+        lower, upper = bounds[:len(levels)], bounds[len(levels):]
+        inside += np.sum((y[rows] >= lower) & (y[rows] <= upper), axis=1)
+    return dict(zip(levels, inside / T))
@@ -0,0 +1,178 @@
+# Streaming metrics
+
+"""
+Mergeable accumulators for metrics over prediction sets too large to hold in memory.
+Accumulators are updated chunk by chunk, can be merged across worker processes
+(they pickle as plain numbers and arrays) and finalize to the values of the batch
+functions in utils.metrics.
+"""
+
+from functools import reduce
+
+import numpy as np
+
+
+class RegressionAccumulator():
+    """
+    Streaming R2, RMSE, MLL and bias.
+
+    The mean and sum of squared deviations of y are combined across chunks with the pairwise
+    update of Chan et al. (Welford's algorithm for blocks), so R2 = 1 - SSE / SST is stable for
+    long streams.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_y = 0.
+        self.m2_y = 0.
+        self.sse = 0.
+        self.sum_err = 0.
+        self.sum_log_loss = 0.
+        self.n_var = 0
+
+    def update(self, y: np.ndarray, y_pred: np.ndarray, y_var: np.ndarray = None):
+        """ Adds a chunk of observations, predictions and (optionally) predictive variances """
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        y_pred = np.asarray(y_pred, dtype=np.float64).reshape(-1)
+        if len(y) == 0:
+            return self
+
+        chunk = RegressionAccumulator()
+        chunk.n = len(y)
+        chunk.mean_y = y.mean()
+        chunk.m2_y = np.sum((y - chunk.mean_y)**2)
+        err = y_pred - y
+        chunk.sse = np.sum(err**2)
+        chunk.sum_err = np.sum(err)
+        if y_var is not None:
+            y_var = np.asarray(y_var, dtype=np.float64).reshape(-1)
+            chunk.sum_log_loss = np.sum(0.5 * np.log(2*np.pi*y_var) + 0.5 * err**2 / y_var)
+            chunk.n_var = len(y)
+
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """ Merges another accumulator into this one """
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean_y - self.mean_y
+        self.m2_y += other.m2_y + delta**2 * self.n * other.n / n
+        self.mean_y += delta * other.n / n
+        self.n = n
+        self.sse += other.sse
+        self.sum_err += other.sum_err
+        self.sum_log_loss += other.sum_log_loss
+        self.n_var += other.n_var
+        return self
+
+    def finalize(self) -> dict:
+        """ Returns R2, RMSE, MLL (if variances were given) and bias (mean of y_pred - y) """
+        return {'R2': 1 - self.sse / self.m2_y if self.m2_y > 0 else np.nan,
+                'RMSE': np.sqrt(self.sse / self.n) if self.n > 0 else np.nan,
+                'MLL': self.sum_log_loss / self.n_var if self.n_var > 0 else np.nan,
+                'bias': self.sum_err / self.n if self.n > 0 else np.nan,
+                'n': self.n}
+
+
+class HistogramSketch():
+    """
+    Mergeable fixed-bin histogram for approximate percentiles. Quantiles are exact to within one
+    bin width inside [lower, upper]; values outside fall in the end bins and the exact minimum and
+    maximum are tracked.
+    """
+
+    def __init__(self, lower: float, upper: float, bins=10000):
+        self.edges = np.linspace(lower, upper, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray):
+        """ Adds a chunk of values, NaNs are ignored """
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        idx = np.clip(np.searchsorted(self.edges, values, side='right') - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        return self
+
+    def merge(self, other):
+        """ Merges another sketch with the same bins into this one """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Sketches must have the same bins to be merged')
+        self.counts += other.counts
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q) -> np.ndarray:
+        """ Returns the approximate q-th percentiles (0 to 100), interpolated within bins """
+        cdf = np.concatenate([[0], np.cumsum(self.counts)]) / self.counts.sum()
+        edges = self.edges.copy()
+        edges[0], edges[-1] = min(edges[0], self.min), max(edges[-1], self.max)
+        values = np.interp(np.asarray(q) / 100, cdf, edges)
+        return np.clip(values, self.min, self.max)
+
+
+def merge_all(accumulators: list):
+    """ Returns the merge of a list of accumulators or sketches, e.g. one per worker """
+    return reduce(lambda a, b: a.merge(b), accumulators)
+
+
+def _slices(n: int, chunk_size=None):
+    chunk_size = n if not chunk_size else chunk_size
+    for start in range(0, n, chunk_size):
+        yield slice(start, min(start + chunk_size, n))
+
+
+def evaluate_in_chunks(predict, x: np.ndarray, y: np.ndarray, chunk_size=10000) -> dict:
+    """
+    Returns the RegressionAccumulator metrics of predict over (x, y) in chunks, never holding more
+    than chunk_size predictions. predict(x_chunk) returns a mean or a (mean, variance) tuple.
+    """
+    acc = RegressionAccumulator()
+    y = np.asarray(y).reshape(-1)
+    for rows in _slices(len(x), chunk_size):
+        out = predict(x[rows])
+        if isinstance(out, tuple):
+            acc.update(y[rows], np.asarray(out[0]), np.asarray(out[1]))
+        else:
+            acc.update(y[rows], np.asarray(out))
+    return acc.finalize()
+
+
+def regression_stats(y_true: np.ndarray, y_pred: np.ndarray, chunk_size=None, bins=10000) -> dict:
+    """
+    R2 and RMSE over all values and over the values at or below the 5th and at or above the 95th
+    percentile of y_true, in two passes over the chunks: the percentiles are found first (exactly
+    if chunk_size is None, otherwise from a HistogramSketch) and the tail metrics accumulated second.
+
+    Returns:
+        dict: R2, RMSE, R2_p5, RMSE_p5, R2_p95, RMSE_p95, p5 and p95.
+    """
+    y_true, y_pred = np.asarray(y_true).reshape(-1), np.asarray(y_pred).reshape(-1)
+
+    if chunk_size is None:
+        p5, p95 = np.percentile(y_true, [5.0, 95.0])
+    else:
+        sketch = HistogramSketch(np.nanmin(y_true), np.nanmax(y_true), bins=bins)
+        for rows in _slices(len(y_true), chunk_size):
+            sketch.update(y_true[rows])
+        p5, p95 = sketch.percentile([5.0, 95.0])
+
+    acc, acc_p5, acc_p95 = RegressionAccumulator(), RegressionAccumulator(), RegressionAccumulator()
+    for rows in _slices(len(y_true), chunk_size):
+        yt, yp = y_true[rows], y_pred[rows]
+        acc.update(yt, yp)
+        acc_p5.update(yt[yt <= p5], yp[yt <= p5])
+        acc_p95.update(yt[yt >= p95], yp[yt >= p95])
+
+    stats, stats_p5, stats_p95 = acc.finalize(), acc_p5.finalize(), acc_p95.finalize()
+    return {'R2': stats['R2'], 'RMSE': stats['RMSE'],
+            'R2_p5': stats_p5['R2'], 'RMSE_p5': stats_p5['RMSE'],
+            'R2_p95': stats_p95['R2'], 'RMSE_p95': stats_p95['RMSE'],
+            'p5': p5, 'p95': p95}